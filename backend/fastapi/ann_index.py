@@ -0,0 +1,210 @@
+import threading
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+try:
+    import hnswlib  # optional, https://github.com/nmslib/hnswlib
+except ImportError:
+    hnswlib = None
+
+from configuration.config import (ANN_HNSW_EF_CONSTRUCTION, ANN_HNSW_EF_SEARCH,
+                                  ANN_HNSW_M, ANN_IVF_NLIST, ANN_IVF_NPROBE)
+
+
+class ExactSearch:
+    """Brute force backend, every song of the mood is a candidate."""
+
+    name = "exact"
+
+    def __init__(self, vectors: np.ndarray):
+        pass
+
+    def add(self, row: int, vector: np.ndarray) -> None:
+        """Nothing to do, new rows are part of the vectors passed to
+        candidates.
+
+        :param row: row of the new vector
+        :type row: int
+        :param vector: normalized vector
+        :type vector: np.ndarray
+        """
+
+    def candidates(
+        self, vectors: np.ndarray, query_vector: np.ndarray, top_n: int
+    ) -> np.ndarray:
+        """Return the candidate rows to score exactly.
+
+        :param vectors: normalized vectors of all songs
+        :type vectors: np.ndarray
+        :param query_vector: normalized vector to find similar songs for
+        :type query_vector: np.ndarray
+        :param top_n: number of songs that will be returned
+        :type top_n: int
+        :return: None, which means all rows are candidates
+        :rtype: np.ndarray
+        """
+        return None
+
+
+class IVFSearch:
+    """Inverted file backend. The normalized vectors are clustered with
+    k-means and only the songs of the nprobe clusters closest to the query
+    are scored. Higher nprobe means better recall and higher latency.
+    """
+
+    name = "ivf"
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        nlist: int = ANN_IVF_NLIST,
+        nprobe: int = ANN_IVF_NPROBE,
+    ):
+        # default to roughly sqrt(number of songs) clusters
+        nlist = nlist or int(np.sqrt(len(vectors)))
+        self.nlist = max(1, min(nlist, len(vectors)))
+        self.nprobe = min(nprobe, self.nlist)
+
+        kmeans = MiniBatchKMeans(
+            n_clusters=self.nlist, random_state=42, n_init=3
+        ).fit(vectors)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = np.divide(
+            centroids, norms, out=np.zeros_like(centroids), where=norms != 0
+        )
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        self.lists = [
+            np.flatnonzero(assignments == cluster)
+            for cluster in range(self.nlist)
+        ]
+        # rows added after building, merged into lists lazily
+        self._added = [[] for _ in range(self.nlist)]
+        self._lock = threading.Lock()
+
+    def add(self, row: int, vector: np.ndarray) -> None:
+        """Assign a new row to the cluster with the closest centroid.
+
+        :param row: row of the new vector
+        :type row: int
+        :param vector: normalized vector
+        :type vector: np.ndarray
+        """
+        cluster = int(np.argmax(self.centroids @ vector))
+        with self._lock:
+            self._added[cluster].append(row)
+
+    def candidates(
+        self, vectors: np.ndarray, query_vector: np.ndarray, top_n: int
+    ) -> np.ndarray:
+        """Return the rows of the nprobe clusters closest to the query.
+
+        :param vectors: normalized vectors of all songs
+        :type vectors: np.ndarray
+        :param query_vector: normalized vector to find similar songs for
+        :type query_vector: np.ndarray
+        :param top_n: number of songs that will be returned
+        :type top_n: int
+        :return: candidate rows
+        :rtype: np.ndarray
+        """
+        centroid_scores = self.centroids @ query_vector
+        probes = np.argsort(centroid_scores)[::-1][: self.nprobe]
+        with self._lock:
+            rows = [self.lists[cluster] for cluster in probes] + [
+                np.asarray(self._added[cluster], dtype=np.int64)
+                for cluster in probes
+            ]
+        rows = np.concatenate(rows)
+        # rows added after the vectors have been read are not scored yet
+        return rows[rows < len(vectors)]
+
+
+class HNSWSearch:
+    """Hierarchical navigable small world graph backend (requires the
+    optional hnswlib package). Higher ef means better recall and higher
+    latency.
+    """
+
+    name = "hnsw"
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        m: int = ANN_HNSW_M,
+        ef_construction: int = ANN_HNSW_EF_CONSTRUCTION,
+        ef: int = ANN_HNSW_EF_SEARCH,
+    ):
+        if hnswlib is None:
+            raise ImportError("The hnsw backend requires the hnswlib package")
+        self.ef = ef
+        self.index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+        self.index.init_index(
+            max_elements=max(len(vectors), 1), ef_construction=ef_construction,
+            M=m
+        )
+        self.index.add_items(vectors, np.arange(len(vectors)))
+        self._lock = threading.Lock()
+
+    def add(self, row: int, vector: np.ndarray) -> None:
+        """Insert a new row into the graph.
+
+        :param row: row of the new vector
+        :type row: int
+        :param vector: normalized vector
+        :type vector: np.ndarray
+        """
+        with self._lock:
+            if self.index.get_current_count() >= self.index.get_max_elements():
+                self.index.resize_index(2 * self.index.get_max_elements())
+            self.index.add_items(vector[np.newaxis], [row])
+
+    def candidates(
+        self, vectors: np.ndarray, query_vector: np.ndarray, top_n: int
+    ) -> np.ndarray:
+        """Return the approximate nearest rows of the graph.
+
+        :param vectors: normalized vectors of all songs
+        :type vectors: np.ndarray
+        :param query_vector: normalized vector to find similar songs for
+        :type query_vector: np.ndarray
+        :param top_n: number of songs that will be returned
+        :type top_n: int
+        :return: candidate rows
+        :rtype: np.ndarray
+        """
+        with self._lock:
+            # query a few more rows, duplicates of the song are filtered later
+            k = min(top_n + 2, self.index.get_current_count())
+            if k == 0:
+                return np.zeros(0, dtype=np.int64)
+            self.index.set_ef(max(self.ef, k))
+            rows, _ = self.index.knn_query(query_vector, k=k)
+        rows = rows[0].astype(np.int64)
+        return rows[rows < len(vectors)]
+
+
+SEARCH_BACKENDS = {
+    backend.name: backend for backend in (ExactSearch, IVFSearch, HNSWSearch)
+}
+
+
+def create_search_backend(name: str, vectors: np.ndarray, **parameters):
+    """Create a nearest neighbour backend over the normalized vectors of a
+    mood index.
+
+    :param name: name of the backend (exact, ivf or hnsw)
+    :type name: str
+    :param vectors: normalized vectors of all songs of the mood
+    :type vectors: np.ndarray
+    :raises ValueError: unknown backend
+    :return: search backend
+    :rtype: ExactSearch | IVFSearch | HNSWSearch
+    """
+    if name not in SEARCH_BACKENDS:
+        raise ValueError(
+            f"Unknown similarity backend {name}, "
+            f"choose one of {', '.join(SEARCH_BACKENDS)}"
+        )
+    return SEARCH_BACKENDS[name](vectors, **parameters)
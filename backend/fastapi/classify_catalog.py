@@ -0,0 +1,121 @@
+"""Command line tool to classify whole playlists or catalogs with the
+/classify/batch endpoint of the running backend.
+
+The input is a .csv file with the columns song_name, artist_name and
+optionally lyrics, or a .jsonl file with one object with these keys per line.
+Results are written as JSON lines, progress is printed while the backend
+streams the results.
+
+Example:
+    python classify_catalog.py playlist.csv --output moods.jsonl
+"""
+import argparse
+import csv
+import json
+import sys
+
+import requests
+
+
+def read_songs(path: str) -> list[dict]:
+    """Function reads the songs to classify from a .csv or .jsonl file.
+
+    :param path: path to the input file
+    :type path: str
+    :return: songs with song_name, artist_name and optional lyrics
+    :rtype: list[dict]
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in file if line.strip()]
+        else:
+            rows = list(csv.DictReader(file))
+
+    songs = []
+    for row in rows:
+        song = {"song_name": row["song_name"], "artist_name": row["artist_name"]}
+        if row.get("lyrics"):
+            song["lyrics"] = row["lyrics"]
+        songs.append(song)
+    return songs
+
+
+def classify_songs(
+    songs: list[dict], url: str, request_size: int, store: bool, output
+) -> int:
+    """Function sends the songs to the backend in requests of request_size
+    songs and writes the streamed results to output.
+
+    :param songs: songs to classify
+    :type songs: list[dict]
+    :param url: url of the /classify/batch endpoint
+    :type url: str
+    :param request_size: number of songs per request
+    :type request_size: int
+    :param store: write classified songs back to Elasticsearch
+    :type store: bool
+    :param output: file to write the results to
+    :return: number of songs which could not be classified
+    :rtype: int
+    """
+    errors = 0
+    for start in range(0, len(songs), request_size):
+        response = requests.post(
+            url,
+            json={"songs": songs[start : start + request_size], "store": store},
+            stream=True,
+        )
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            if "progress" in result:
+                done = start + result["progress"]["done"]
+                print(f"classified: {done} songs out of {len(songs)}",
+                      file=sys.stderr)
+                continue
+            errors += "error" in result
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Classify the moods of many songs with the backend."
+    )
+    parser.add_argument("input", help=".csv or .jsonl file with songs")
+    parser.add_argument(
+        "--output", help="JSON lines file for the results (default: stdout)"
+    )
+    parser.add_argument(
+        "--url", default="http://localhost:8000/classify/batch",
+        help="url of the /classify/batch endpoint"
+    )
+    parser.add_argument(
+        "--request-size", type=int, default=1000,
+        help="number of songs sent per request"
+    )
+    parser.add_argument(
+        "--no-store", action="store_true",
+        help="do not write the classified songs to Elasticsearch"
+    )
+    args = parser.parse_args()
+
+    songs = read_songs(args.input)
+    output = (
+        open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    )
+    try:
+        errors = classify_songs(
+            songs, args.url, args.request_size, not args.no_store, output
+        )
+    finally:
+        if args.output:
+            output.close()
+    print(f"Errors: {errors}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
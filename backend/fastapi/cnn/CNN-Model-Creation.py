@@ -3,8 +3,12 @@
 # Here is only the abreviated code with less comments and prints
 # to comprehend the processing steps
 #############
+import argparse
+import hashlib
+import json
 import os
 import pickle
+import shutil
 import sys
 
 import numpy as np
@@ -17,6 +21,7 @@ from keras.preprocessing.text import Tokenizer
 from keras.utils import to_categorical
 from sklearn import preprocessing
 from sklearn.model_selection import train_test_split
+import tensorflow as tf
 from tensorflow.keras.layers import Dense, Embedding
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.preprocessing.sequence import pad_sequences
@@ -24,6 +29,148 @@ from tensorflow.keras.preprocessing.sequence import pad_sequences
 # Add parent dir to system path
 sys.path.append('../')
 from utils import *
+from model_registry import save_headless
+from vocabulary import VOCABULARY_FILES, export_vocabulary
+
+
+# Ground truth data of the training
+DATA_PATH = os.environ.get(
+    "DATA_PATH",
+    "../../../data_exploration/data/song-data-labels-cleaned-seven-moods.csv")
+# Length of the padded token sequences
+SEQUENCE_LENGTH = 180
+
+# Preprocessed tokens are cached in parquet files keyed by the hash of the
+# lyrics, so retraining skips lyrics which have been preprocessed before
+PREPROCESSING_CACHE_DIRECTORY = os.environ.get(
+    "PREPROCESSING_CACHE_DIRECTORY", "./preprocessing_cache")
+# lyrics per spaCy batch, spaCy worker processes and lyrics per cache file
+PREPROCESSING_BATCH_SIZE = int(
+    os.environ.get("PREPROCESSING_BATCH_SIZE", "256"))
+PREPROCESSING_N_PROCESS = int(
+    os.environ.get("PREPROCESSING_N_PROCESS", str(os.cpu_count() or 1)))
+PREPROCESSING_PART_SIZE = int(
+    os.environ.get("PREPROCESSING_PART_SIZE", "10000"))
+# increase when the preprocessing steps change to invalidate the cache
+PREPROCESSING_VERSION = 1
+
+# Directory of a training run: tokenizer, label encoder, embedding weights,
+# sharded TFRecord files of the padded sequences and the backup used to
+# resume an interrupted training
+TRAINING_DIRECTORY = os.environ.get("TRAINING_DIRECTORY", "./training_run")
+TRAINING_SHARDS = int(os.environ.get("TRAINING_SHARDS", "16"))
+# batch size per worker, epochs and seed of the train/test split
+TRAINING_BATCH_SIZE = int(os.environ.get("TRAINING_BATCH_SIZE", "32"))
+TRAINING_EPOCHS = int(os.environ.get("TRAINING_EPOCHS", "3"))
+TRAINING_SEED = int(os.environ.get("TRAINING_SEED", "42"))
+TRAINING_SHUFFLE_BUFFER = int(
+    os.environ.get("TRAINING_SHUFFLE_BUFFER", "10000"))
+# cache of the parsed training data: memory, a file path or empty for none
+TRAINING_CACHE = os.environ.get("TRAINING_CACHE", "memory")
+# evaluation gate: minimum test accuracy and maximum accuracy loss compared
+# to the latest model version on the test lyrics both models held out
+TRAINING_MIN_ACCURACY = float(
+    os.environ.get("TRAINING_MIN_ACCURACY", "0.4"))
+TRAINING_MAX_REGRESSION = float(
+    os.environ.get("TRAINING_MAX_REGRESSION", "0.01"))
+METADATA_FILE = "metadata.json"
+# content hashes of the test lyrics no training lyric equals, kept with every
+# model version to know which lyrics it has never been trained on
+HELD_OUT_FILE = "held_out_hashes.npy"
+
+
+def content_hash(lyrics: str) -> str:
+    """Function returns the key of lyrics in the preprocessing cache.
+
+    :param lyrics: lyrics of a song
+    :type lyrics: str
+    :return: sha256 hex digest of the lyrics
+    :rtype: str
+    """
+    return hashlib.sha256(lyrics.encode("utf-8")).hexdigest()
+
+
+def preprocessing_cache_directory(
+        cache_directory: str = PREPROCESSING_CACHE_DIRECTORY) -> str:
+    """Function returns the cache directory of the current preprocessing.
+    Its name depends on the spaCy version, the spaCy pipeline and the
+    preprocessing version, so tokens of another setup are never reused.
+
+    :param cache_directory: root directory of the preprocessing cache
+    :type cache_directory: str
+    :return: cache directory of the current preprocessing
+    :rtype: str
+    """
+    nlp = get_nlp()
+    fingerprint = json.dumps([
+        PREPROCESSING_VERSION, spacy.__version__, nlp.meta["name"],
+        nlp.meta["version"], DISABLED_COMPONENTS])
+    return os.path.join(
+        cache_directory, hashlib.sha256(fingerprint.encode()).hexdigest()[:16])
+
+
+def preprocess_lyrics_cached(
+        lyrics: list[str],
+        cache_directory: str = PREPROCESSING_CACHE_DIRECTORY,
+        batch_size: int = PREPROCESSING_BATCH_SIZE,
+        n_process: int = PREPROCESSING_N_PROCESS,
+        part_size: int = PREPROCESSING_PART_SIZE) -> list[list[str]]:
+    """Function preprocesses a column of lyrics. Lyrics found in the cache
+    are not processed again, the others are streamed through the spaCy
+    pipeline in batches with n_process workers and appended to the cache in
+    parquet files of part_size lyrics.
+
+    :param lyrics: lyrics to preprocess
+    :type lyrics: list[str]
+    :param cache_directory: root directory of the preprocessing cache
+    :type cache_directory: str
+    :param batch_size: number of lyrics per spaCy batch
+    :type batch_size: int
+    :param n_process: number of spaCy worker processes
+    :type n_process: int
+    :param part_size: number of lyrics per cache file
+    :type part_size: int
+    :return: lemmatized tokens of each lyric
+    :rtype: list[list[str]]
+    """
+    directory = preprocessing_cache_directory(cache_directory)
+    os.makedirs(directory, exist_ok=True)
+
+    tokens = {}
+    parts = sorted(name for name in os.listdir(directory)
+                   if name.endswith(".parquet"))
+    if parts:
+        cached = pd.read_parquet(directory, columns=["hash", "tokens"])
+        tokens = dict(zip(cached["hash"], cached["tokens"].map(list)))
+
+    hashes = [content_hash(lyric) for lyric in lyrics]
+    # every distinct lyric is processed only once
+    missing = {}
+    for key, lyric in zip(hashes, lyrics):
+        if key not in tokens:
+            missing.setdefault(key, lyric)
+    print(f"preprocessing: {len(set(hashes)) - len(missing)} distinct lyrics "
+          f"cached, {len(missing)} to process")
+
+    part_number = len(parts)
+    processed = 0
+    part = {"hash": [], "tokens": []}
+    for key, lyric_tokens in zip(
+            missing,
+            preprocess_lyrics(missing.values(), batch_size=batch_size,
+                              n_process=n_process)):
+        tokens[key] = lyric_tokens
+        part["hash"].append(key)
+        part["tokens"].append(lyric_tokens)
+        processed += 1
+        if len(part["hash"]) == part_size or processed == len(missing):
+            pd.DataFrame(part).to_parquet(
+                os.path.join(directory, f"part-{part_number:05d}.parquet"))
+            part_number += 1
+            part = {"hash": [], "tokens": []}
+            print(f"processsed: {processed} lyrics out of {len(missing)}")
+
+    return [tokens[key] for key in hashes]
 
 
 def processing_pipeline(song_data: pd.DataFrame) -> pd.DataFrame:
@@ -31,6 +178,10 @@ def processing_pipeline(song_data: pd.DataFrame) -> pd.DataFrame:
     Preprocessing steps and idea for the model is used from
     https://www.kaggle.com/code/jagannathrk/word2vec-cnn-text-classification
     Preprocessing steps:
+    - Tokenization
+    - Stop word removal
+    - Punctuation removal
+    - Lemmatization
 
     :param song_data: song data saved in a json file containing song name,
         artist name and lyrics
@@ -39,86 +190,23 @@ def processing_pipeline(song_data: pd.DataFrame) -> pd.DataFrame:
     :rtype: pd.DataFrame
     """
 
-    nlp = spacy.load("en_core_web_sm", disable=['ner'])
-
-    for row in range(len(song_data)):
-        text_nlp_pipe = list(nlp.pipe([song_data.iloc[row]["Lyric"]]))
-
-        # Tokenization
-        song_data.at[row, "Lyric"] = tokenization(text_nlp_pipe)
-        # Stop word removal
-        song_data.at[row, "Lyric"] = stop_word_removal(
-            song_data.iloc[row]["Lyric"])
-        # Punctuation removal
-        song_data.at[row, "Lyric"] = punctutation_removal(
-            song_data.iloc[row]["Lyric"])
-        # Lemmatization
-        song_data.at[row, "Lyric"] = lemmatization(
-            song_data.iloc[row]["Lyric"])
-        song_data.at[row, "Lyric"] = " ".join(song_data.iloc[row]["Lyric"])
-        song_data.at[row, "Lyric"] = song_data.iloc[row]["Lyric"].lower()
-        if row % 500 == 0 and row >= 500:
-            print(f"processsed: {row} rows out of {len(song_data)}")
+    song_data["Lyric"] = [
+        " ".join(lyric_tokens).lower()
+        for lyric_tokens in preprocess_lyrics_cached(
+            [str(lyric) for lyric in song_data["Lyric"]])
+    ]
     return song_data
 
 
-# read in the data of our dataset which has been extended
-# with the lastfm labels
-df = pd.read_csv('../../../data_exploration/data/song-data-labels-cleaned-seven-moods.csv')
-# process data with pipeline
-df = processing_pipeline(df)
-
-# merge lyrics together
-lyrics = []
-for i in df['Lyric']:
-    lyrics.append(i.split())
-
-# train the word2vec model (vector size according to:
-# https://moj-analytical-services.github.io/NLP-guidance/NNmodels.html#:~:text=The%20standard%20Word2Vec%20pre%2Dtrained,fewer%20dimensions%20to%20represent%20them)
-# mincount = 2 to prevent misspellings
-word2vec_model = Word2Vec(lyrics, vector_size=150,
-                          window=5, min_count=2, workers=16)
-
-# use the keras tokenizer and apply it to the lyrics
-# number in first row is the vocab size from the above print statement
-token = Tokenizer(len(word2vec_model.wv))
-token.fit_on_texts(df['Lyric'])
-text = token.texts_to_sequences(df['Lyric'])
-text = pad_sequences(text, 180)
-
-# set the model path dynamically
-version = 0
-for i in range(1, 100):
-    if not os.path.exists('cnn_model_v'+str(i)):
-        version = i
-        break
-model_path = "./cnn_model_v"+str(version)
-os.mkdir(model_path)
-# save the tokenizer
-with open(model_path+'/tokenizer.pickle', 'wb') as handle:
-    pickle.dump(token, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-# encode the labels
-le = preprocessing.LabelEncoder()
-y = le.fit_transform(df['Mood'])
-y = to_categorical(y)
-# save the label encoder
-np.save(model_path+'/label_encoder.npy', le.classes_)
-
-
-x_train, x_test, y_train, y_test = train_test_split(
-    np.array(text), y, test_size=0.2, stratify=y)
-
-
-def gensim_to_keras_embedding(model, train_embeddings: bool = False):
+def embedding_layer(weights: np.ndarray, train_embeddings: bool = False):
     """Function generates a Keras 'Embedding' layer with weights set
     from Word2Vec model's learned word embeddings.
     helper function to use the word2vec as an layer in keras
     taken from the gensim wikipage:
     https://github.com/RaRe-Technologies/gensim/wiki/Using-Gensim-Embeddings-with-Keras-and-Tensorflow
 
-    :param model: Word2Vec Embedding model
-    :type model: gensim.model
+    :param weights: word vectors of the Word2Vec model (model.wv.vectors)
+    :type weights: np.ndarray
     :param train_embeddings: If False, the returned weights are frozen
         and stopped from being updated. If True, the weights can / will
         be further updated in Keras, defaults to False
@@ -127,48 +215,480 @@ def gensim_to_keras_embedding(model, train_embeddings: bool = False):
     :rtype: `keras.layers.Embedding`
     """
 
-    keyed_vectors = model.wv  # structure holding the result of training
-    weights = keyed_vectors.vectors  # vectors themselves, a 2D numpy array
-    # which row in `weights` corresponds to which word?
-    index_to_key = keyed_vectors.index_to_key
-
     layer = Embedding(
         input_dim=weights.shape[0],
         output_dim=weights.shape[1],
-        weights=[weights],
+        embeddings_initializer=tf.keras.initializers.Constant(weights),
         trainable=train_embeddings,
     )
     return layer
 
 
-# Defining the model
-# use the hyperparameters from the hyperparameter tuning notebook (CNN-Model-Crreation under the directory data-exploration)
-keras_model = Sequential()
-keras_model.add(gensim_to_keras_embedding(word2vec_model, False))
-keras_model.add(Dropout(0.2))
-keras_model.add(Conv1D(50, 5, activation='relu', padding='same', strides=1))
-keras_model.add(Conv1D(50, 5, activation='relu', padding='same', strides=1))
-keras_model.add(MaxPool1D())
-keras_model.add(Dropout(0.2))
-keras_model.add(Conv1D(100, 5, activation='relu', padding='same', strides=1))
-keras_model.add(Conv1D(100, 5, activation='relu', padding='same', strides=1))
-keras_model.add(MaxPool1D())
-keras_model.add(Dropout(0.2))
-keras_model.add(Conv1D(200, 5, activation='relu', padding='same', strides=1))
-keras_model.add(Conv1D(200, 5, activation='relu', padding='same', strides=1))
-keras_model.add(GlobalMaxPool1D())
-keras_model.add(Dropout(0.2))
-keras_model.add(Dense(200))
-keras_model.add(Activation('relu'))
-keras_model.add(Dropout(0.2))
-# Number of moods to be classified to
-keras_model.add(Dense(7))
-keras_model.add(Activation('softmax'))
-keras_model.compile(loss='binary_crossentropy',
-                    metrics=['acc'], optimizer='adam')
-
-keras_model.fit(x_train, y_train, batch_size=32, epochs=3,
-                validation_data=(x_test, y_test))
-
-# save keras model
-keras_model.save(model_path)
+def write_shards(sequences: np.ndarray, labels: np.ndarray, directory: str,
+                 prefix: str, shards: int) -> list[str]:
+    """Function writes padded sequences and label indexes to TFRecord
+    shards.
+
+    :param sequences: padded token sequences (songs x 180)
+    :type sequences: np.ndarray
+    :param labels: label index of each song
+    :type labels: np.ndarray
+    :param directory: directory of the training run
+    :type directory: str
+    :param prefix: train or test
+    :type prefix: str
+    :param shards: number of shards
+    :type shards: int
+    :return: file names of the shards
+    :rtype: list[str]
+    """
+    files = []
+    for shard, rows in enumerate(
+            np.array_split(np.arange(len(labels)), shards)):
+        file_name = f"{prefix}-{shard:05d}-of-{shards:05d}.tfrecord"
+        with tf.io.TFRecordWriter(os.path.join(directory, file_name)) as writer:
+            for row in rows:
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    "sequence": tf.train.Feature(int64_list=tf.train.Int64List(
+                        value=sequences[row])),
+                    "label": tf.train.Feature(int64_list=tf.train.Int64List(
+                        value=[labels[row]])),
+                }))
+                writer.write(example.SerializeToString())
+        files.append(file_name)
+    return files
+
+
+def prepare_training_data(path_to_csv: str = DATA_PATH,
+                          directory: str = TRAINING_DIRECTORY,
+                          shards: int = TRAINING_SHARDS) -> dict:
+    """Function preprocesses the ground truth data, trains the word2vec
+    model, fits tokenizer and label encoder and writes the padded sequences
+    to sharded TFRecord files. The metadata file is written last, so a
+    prepared training run can be detected and reused.
+
+    :param path_to_csv: csv file with the columns Lyric and Mood
+    :type path_to_csv: str
+    :param directory: directory of the training run
+    :type directory: str
+    :param shards: number of shards per split
+    :type shards: int
+    :return: metadata of the training data
+    :rtype: dict
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    # read in the data of our dataset which has been extended
+    # with the lastfm labels
+    df = pd.read_csv(path_to_csv, usecols=["Lyric", "Mood"])
+    # process data with pipeline
+    df = processing_pipeline(df)
+
+    # merge lyrics together
+    lyrics = [lyric.split() for lyric in df['Lyric']]
+
+    # train the word2vec model (vector size according to:
+    # https://moj-analytical-services.github.io/NLP-guidance/NNmodels.html#:~:text=The%20standard%20Word2Vec%20pre%2Dtrained,fewer%20dimensions%20to%20represent%20them)
+    # mincount = 2 to prevent misspellings
+    word2vec_model = Word2Vec(lyrics, vector_size=150,
+                              window=5, min_count=2, workers=16)
+    np.save(os.path.join(directory, "embedding.npy"),
+            word2vec_model.wv.vectors)
+
+    # use the keras tokenizer and apply it to the lyrics
+    # number in first row is the vocab size from the above print statement
+    token = Tokenizer(len(word2vec_model.wv))
+    token.fit_on_texts(df['Lyric'])
+    with open(os.path.join(directory, 'tokenizer.pickle'), 'wb') as handle:
+        pickle.dump(token, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # compact vocabulary used by the backend instead of the pickle
+    export_vocabulary(token, directory)
+
+    # encode the labels
+    le = preprocessing.LabelEncoder()
+    y = le.fit_transform(df['Mood'])
+    np.save(os.path.join(directory, 'label_encoder.npy'), le.classes_)
+
+    train_rows, test_rows = train_test_split(
+        np.arange(len(df)), test_size=0.2, stratify=y,
+        random_state=TRAINING_SEED)
+    # the preprocessed test lyrics are kept to compare model versions
+    df.iloc[test_rows][["Lyric", "Mood"]].to_parquet(
+        os.path.join(directory, "test_lyrics.parquet"))
+    # duplicates of training lyrics in the test split are not held out
+    train_hashes = {content_hash(lyric)
+                    for lyric in df['Lyric'].iloc[train_rows]}
+    held_out = sorted({content_hash(lyric)
+                       for lyric in df['Lyric'].iloc[test_rows]}
+                      - train_hashes)
+    np.save(os.path.join(directory, HELD_OUT_FILE), np.asarray(held_out))
+
+    metadata = {
+        "classes": [str(mood) for mood in le.classes_],
+        "embedding_shape": list(word2vec_model.wv.vectors.shape),
+    }
+    for split, rows in (("train", train_rows), ("test", test_rows)):
+        # pad one split at a time
+        text = pad_sequences(token.texts_to_sequences(
+            df['Lyric'].iloc[rows]), SEQUENCE_LENGTH)
+        metadata[f"{split}_files"] = write_shards(
+            text, y[rows], directory, split, shards)
+        metadata[f"{split}_examples"] = len(rows)
+
+    with open(os.path.join(directory, METADATA_FILE), "w") as handle:
+        json.dump(metadata, handle, indent=2)
+    return metadata
+
+
+def load_metadata(directory: str = TRAINING_DIRECTORY) -> dict:
+    """Function loads the metadata of a prepared training run.
+
+    :param directory: directory of the training run
+    :type directory: str
+    :return: metadata or None if the training data is not prepared
+    :rtype: dict
+    """
+    path = os.path.join(directory, METADATA_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as handle:
+        return json.load(handle)
+
+
+def load_dataset(files: list[str], num_classes: int, batch_size: int,
+                 training: bool, cache: str = TRAINING_CACHE
+                 ) -> tf.data.Dataset:
+    """Function streams the TFRecord shards as batches of padded sequences
+    and one-hot labels. Shards are read and parsed in parallel, the parsed
+    examples are cached and batches are prefetched.
+
+    :param files: paths of the shards
+    :type files: list[str]
+    :param num_classes: number of moods
+    :type num_classes: int
+    :param batch_size: global batch size
+    :type batch_size: int
+    :param training: shuffle and repeat the training data
+    :type training: bool
+    :param cache: memory, a file path or empty for no cache
+    :type cache: str
+    :return: dataset of (sequences, labels) batches
+    :rtype: tf.data.Dataset
+    """
+    features = {
+        "sequence": tf.io.FixedLenFeature([SEQUENCE_LENGTH], tf.int64),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        return (tf.cast(example["sequence"], tf.int32),
+                tf.one_hot(example["label"], num_classes))
+
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if training:
+        dataset = dataset.shuffle(len(files), seed=TRAINING_SEED)
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset, cycle_length=tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=not training)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache == "memory":
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.cache(cache)
+    if training:
+        dataset = dataset.shuffle(TRAINING_SHUFFLE_BUFFER,
+                                  seed=TRAINING_SEED).repeat()
+    dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    # every worker reads its own shards
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.FILE)
+    return dataset.with_options(options)
+
+
+def build_model(embedding_weights: np.ndarray, num_classes: int):
+    """Function builds and compiles the CNN.
+
+    :param embedding_weights: word vectors of the Word2Vec model
+    :type embedding_weights: np.ndarray
+    :param num_classes: number of moods to be classified to
+    :type num_classes: int
+    :return: compiled model
+    :rtype: Sequential
+    """
+    # Defining the model
+    # use the hyperparameters from the hyperparameter tuning notebook (CNN-Model-Crreation under the directory data-exploration)
+    keras_model = Sequential()
+    keras_model.add(tf.keras.Input(shape=(SEQUENCE_LENGTH,), dtype="int32"))
+    keras_model.add(embedding_layer(embedding_weights, False))
+    keras_model.add(Dropout(0.2))
+    keras_model.add(Conv1D(50, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(Conv1D(50, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(MaxPool1D())
+    keras_model.add(Dropout(0.2))
+    keras_model.add(Conv1D(100, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(Conv1D(100, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(MaxPool1D())
+    keras_model.add(Dropout(0.2))
+    keras_model.add(Conv1D(200, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(Conv1D(200, 5, activation='relu', padding='same', strides=1))
+    keras_model.add(GlobalMaxPool1D())
+    keras_model.add(Dropout(0.2))
+    keras_model.add(Dense(200))
+    keras_model.add(Activation('relu'))
+    keras_model.add(Dropout(0.2))
+    keras_model.add(Dense(num_classes))
+    keras_model.add(Activation('softmax'))
+    keras_model.compile(
+        loss='binary_crossentropy', optimizer='adam',
+        metrics=['acc', tf.keras.metrics.CategoricalAccuracy(
+            name="categorical_accuracy")])
+    return keras_model
+
+
+def get_strategy() -> tf.distribute.Strategy:
+    """Function returns the distribution strategy of the training. With a
+    TF_CONFIG environment variable (cluster of several workers) the batches
+    are split across the CPU workers, otherwise one process trains.
+
+    :return: distribution strategy
+    :rtype: tf.distribute.Strategy
+    """
+    if "TF_CONFIG" in os.environ:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief() -> bool:
+    """Function returns whether this worker writes the model version.
+
+    :return: True for the chief or a single worker
+    :rtype: bool
+    """
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task", {})
+    task_type = task.get("type", "chief")
+    return task_type == "chief" or (
+        task_type == "worker" and task.get("index", 0) == 0
+        and "chief" not in json.loads(os.environ["TF_CONFIG"])["cluster"])
+
+
+def train(directory: str = TRAINING_DIRECTORY,
+          epochs: int = TRAINING_EPOCHS,
+          batch_size: int = TRAINING_BATCH_SIZE):
+    """Function trains the CNN on the prepared training data. The state is
+    backed up after every epoch, an interrupted training resumes from the
+    last backup when it is started again.
+
+    :param directory: directory of the training run
+    :type directory: str
+    :param epochs: number of epochs
+    :type epochs: int
+    :param batch_size: batch size per worker
+    :type batch_size: int
+    :raises FileNotFoundError: training data is not prepared
+    :return: trained model
+    :rtype: Sequential
+    """
+    metadata = load_metadata(directory)
+    if metadata is None:
+        raise FileNotFoundError(
+            f"No prepared training data in {directory}, run the prepare "
+            "stage first")
+    strategy = get_strategy()
+    global_batch_size = batch_size * strategy.num_replicas_in_sync
+    num_classes = len(metadata["classes"])
+
+    with strategy.scope():
+        keras_model = build_model(
+            np.load(os.path.join(directory, "embedding.npy")), num_classes)
+
+    train_dataset = load_dataset(
+        [os.path.join(directory, name) for name in metadata["train_files"]],
+        num_classes, global_batch_size, training=True)
+    test_dataset = load_dataset(
+        [os.path.join(directory, name) for name in metadata["test_files"]],
+        num_classes, global_batch_size, training=False, cache="")
+
+    keras_model.fit(
+        train_dataset, epochs=epochs,
+        steps_per_epoch=max(metadata["train_examples"] // global_batch_size, 1),
+        validation_data=test_dataset,
+        callbacks=[tf.keras.callbacks.BackupAndRestore(
+            os.path.join(directory, "backup"))])
+    return keras_model
+
+
+def latest_model_version() -> str:
+    """Function returns the directory of the latest model version.
+
+    :return: path of the latest cnn_model_vN directory or None
+    :rtype: str
+    """
+    versions = [int(name.rsplit("v", 1)[1]) for name in os.listdir(".")
+                if name.startswith("cnn_model_v")
+                and name.rsplit("v", 1)[1].isdigit()]
+    return f"./cnn_model_v{max(versions)}" if versions else None
+
+
+def accuracy_on_lyrics(keras_model, token, classes: list[str],
+                       test_lyrics: pd.DataFrame) -> float:
+    """Function returns the accuracy of a model on preprocessed lyrics.
+
+    :param keras_model: model to evaluate
+    :param token: tokenizer of the model
+    :type token: Tokenizer
+    :param classes: moods of the label encoder of the model
+    :type classes: list[str]
+    :param test_lyrics: preprocessed test lyrics with their moods
+    :type test_lyrics: pd.DataFrame
+    :return: share of correctly classified lyrics
+    :rtype: float
+    """
+    text = pad_sequences(token.texts_to_sequences(test_lyrics["Lyric"]),
+                         SEQUENCE_LENGTH)
+    predictions = keras_model.predict(text, batch_size=256, verbose=0)
+    predicted = np.asarray(classes)[np.argmax(predictions, axis=1)]
+    return float(np.mean(predicted == test_lyrics["Mood"].to_numpy()))
+
+
+def evaluation_gate(keras_model, directory: str = TRAINING_DIRECTORY
+                    ) -> tuple[bool, dict]:
+    """Function decides whether a trained model becomes a new model version.
+    Its accuracy on the test lyrics has to reach TRAINING_MIN_ACCURACY. If
+    the latest model version has the same moods and records its held out
+    lyrics, the model may be at most TRAINING_MAX_REGRESSION below it on the
+    test lyrics held out by both. Without these lyrics the comparison would
+    score the latest version on its own training lyrics, so it is skipped.
+
+    :param keras_model: trained model
+    :param directory: directory of the training run
+    :type directory: str
+    :raises FileNotFoundError: training data is not prepared
+    :return: whether the model passed and the evaluation report
+    :rtype: tuple[bool, dict]
+    """
+    metadata = load_metadata(directory)
+    if metadata is None:
+        raise FileNotFoundError(
+            f"No prepared training data in {directory}, run the prepare "
+            "stage first")
+    test_lyrics = pd.read_parquet(
+        os.path.join(directory, "test_lyrics.parquet"))
+    with open(os.path.join(directory, "tokenizer.pickle"), "rb") as handle:
+        token = pickle.load(handle)
+    report = {"accuracy": accuracy_on_lyrics(
+        keras_model, token, metadata["classes"], test_lyrics)}
+    passed = report["accuracy"] >= TRAINING_MIN_ACCURACY
+
+    latest = latest_model_version()
+    if latest is None:
+        return passed, report
+    report["latest_version"] = latest
+    classes = [str(mood) for mood in np.load(
+        os.path.join(latest, "label_encoder.npy"), allow_pickle=True)]
+    held_out_files = [os.path.join(directory, HELD_OUT_FILE),
+                      os.path.join(latest, HELD_OUT_FILE)]
+    if classes != metadata["classes"]:
+        report["regression_check"] = "skipped, different moods"
+        return passed, report
+    if not all(os.path.isfile(path) for path in held_out_files):
+        report["regression_check"] = "skipped, held out lyrics unknown"
+        return passed, report
+
+    # test lyrics neither model has been trained on
+    held_out = set.intersection(
+        *[set(np.load(path).tolist()) for path in held_out_files])
+    compared = test_lyrics[
+        test_lyrics["Lyric"].map(content_hash).isin(held_out)]
+    if compared.empty:
+        report["regression_check"] = "skipped, no common held out lyrics"
+        return passed, report
+
+    with open(os.path.join(latest, "tokenizer.pickle"), "rb") as handle:
+        latest_token = pickle.load(handle)
+    report["regression_check"] = "compared"
+    report["compared_lyrics"] = len(compared)
+    report["compared_accuracy"] = accuracy_on_lyrics(
+        keras_model, token, metadata["classes"], compared)
+    report["latest_accuracy"] = accuracy_on_lyrics(
+        tf.keras.models.load_model(latest), latest_token, classes, compared)
+    passed = passed and (report["compared_accuracy"] >= report[
+        "latest_accuracy"] - TRAINING_MAX_REGRESSION)
+    return passed, report
+
+
+def save_model_version(keras_model,
+                       directory: str = TRAINING_DIRECTORY) -> str:
+    """Function writes the model with tokenizer and label encoder to the
+    next cnn_model_vN directory. The directory is renamed into place only
+    after all files are written.
+
+    :param keras_model: trained model
+    :param directory: directory of the training run
+    :type directory: str
+    :return: path of the model version
+    :rtype: str
+    """
+    # set the model path dynamically
+    version = 0
+    for i in range(1, 100):
+        if not os.path.exists('cnn_model_v'+str(i)):
+            version = i
+            break
+    model_path = "./cnn_model_v"+str(version)
+    temporary_path = model_path + ".tmp"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    # save keras model
+    keras_model.save(temporary_path)
+    # embedding matrix memory mapped by the backend and the layers after it
+    save_headless(keras_model, temporary_path)
+    for file_name in ("tokenizer.pickle", "label_encoder.npy",
+                      *VOCABULARY_FILES):
+        shutil.copy(os.path.join(directory, file_name), temporary_path)
+    # missing in training runs prepared before the file was introduced
+    if os.path.isfile(os.path.join(directory, HELD_OUT_FILE)):
+        shutil.copy(os.path.join(directory, HELD_OUT_FILE), temporary_path)
+    os.rename(temporary_path, model_path)
+    return model_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Train the mood classification CNN.")
+    parser.add_argument(
+        "--stage", choices=["prepare", "train", "all"], default="all",
+        help="prepare the sharded training data, train on it or both "
+             "(workers of a multi-worker training run only train)")
+    args = parser.parse_args()
+
+    if args.stage in ("prepare", "all") and (
+            args.stage == "prepare" or load_metadata() is None):
+        metadata = prepare_training_data()
+        print(f"Prepared {metadata['train_examples']} training and "
+              f"{metadata['test_examples']} test songs")
+    if args.stage == "prepare":
+        return
+
+    keras_model = train()
+    # every worker evaluates, so predictions run the same on all workers
+    passed, report = evaluation_gate(keras_model)
+    print(f"Evaluation: {report}")
+    if not passed:
+        print("The model did not pass the evaluation gate and is not saved")
+        sys.exit(1)
+    if not is_chief():
+        # every worker takes part in saving, only the chief keeps the model
+        temporary_path = f"./cnn_model_worker{os.getpid()}.tmp"
+        keras_model.save(temporary_path)
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        return
+    print(f"Saved model version {save_model_version(keras_model)}")
+    # a new run starts from scratch
+    shutil.rmtree(os.path.join(TRAINING_DIRECTORY, "backup"),
+                  ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
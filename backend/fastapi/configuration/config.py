@@ -1,3 +1,5 @@
+import os
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -19,3 +21,127 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+
+# Directory containing the versioned cnn_model_vN artifact sets
+CNN_MODEL_DIRECTORY = os.environ.get("CNN_MODEL_DIRECTORY", "./cnn")
+# Model version that serves requests after startup
+CNN_MODEL_VERSION = os.environ.get("CNN_MODEL_VERSION", "cnn_model_v3")
+# Comma separated model versions that are loaded at startup
+# (empty loads every cnn_model_vN directory found)
+CNN_PRELOAD_VERSIONS = [
+    version.strip()
+    for version in os.environ.get("CNN_PRELOAD_VERSIONS", "").split(",")
+    if version.strip()
+]
+
+# Directory containing the precomputed per mood similarity indexes
+SIMILARITY_INDEX_DIRECTORY = os.environ.get(
+    "SIMILARITY_INDEX_DIRECTORY", "./similarity_index"
+)
+# Nearest neighbour backend of the similarity indexes (exact, ivf or hnsw)
+SIMILARITY_BACKEND = os.environ.get("SIMILARITY_BACKEND", "exact")
+# Moods with less songs are always searched exactly
+ANN_MIN_SONGS = int(os.environ.get("ANN_MIN_SONGS", "20000"))
+# IVF: number of clusters (0 means sqrt of the number of songs) and number
+# of clusters scored per query (recall/latency trade-off)
+ANN_IVF_NLIST = int(os.environ.get("ANN_IVF_NLIST", "0"))
+ANN_IVF_NPROBE = int(os.environ.get("ANN_IVF_NPROBE", "8"))
+# HNSW: graph degree, build and search beam width (recall/latency trade-off)
+ANN_HNSW_M = int(os.environ.get("ANN_HNSW_M", "16"))
+ANN_HNSW_EF_CONSTRUCTION = int(
+    os.environ.get("ANN_HNSW_EF_CONSTRUCTION", "200")
+)
+ANN_HNSW_EF_SEARCH = int(os.environ.get("ANN_HNSW_EF_SEARCH", "64"))
+# spaCy preprocessing: documents per batch and number of worker processes
+SPACY_BATCH_SIZE = int(os.environ.get("SPACY_BATCH_SIZE", "64"))
+SPACY_N_PROCESS = int(os.environ.get("SPACY_N_PROCESS", "1"))
+# Elasticsearch connection of the shared clients
+ES_HOST = os.environ.get("ES_HOST", "http://elasticsearch:9200")
+# Maximum number of pooled connections to the node
+ES_POOL_SIZE = int(os.environ.get("ES_POOL_SIZE", "20"))
+ES_REQUEST_TIMEOUT = float(os.environ.get("ES_REQUEST_TIMEOUT", "10"))
+ES_MAX_RETRIES = int(os.environ.get("ES_MAX_RETRIES", "3"))
+# Thread pool for I/O bound steps and process pool for CPU bound steps of
+# /search: number of workers and calls that may wait in the queue
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "32"))
+IO_MAX_QUEUE = int(os.environ.get("IO_MAX_QUEUE", "256"))
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 1)))
+CPU_MAX_QUEUE = int(os.environ.get("CPU_MAX_QUEUE", "64"))
+# Micro-batching of mood predictions: maximum sequences per forward pass,
+# maximum time a request waits for others and forward passes run at once
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", "32"))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "5"))
+INFERENCE_MAX_CONCURRENT_BATCHES = int(
+    os.environ.get("INFERENCE_MAX_CONCURRENT_BATCHES", "2")
+)
+# Number of songs preprocessed and classified together by /classify/batch
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", "64"))
+# Add vectors, mood probabilities, preprocessed lyrics and model version to
+# stored songs which lack them (initial load) in the background at startup.
+# Off by default, since it competes with /search for the thread pool; run
+# python index_enrichment.py after loading the index instead
+ENRICH_ON_STARTUP = os.environ.get("ENRICH_ON_STARTUP", "false") == "true"
+ENRICH_CHUNK_SIZE = int(os.environ.get("ENRICH_CHUNK_SIZE", "256"))
+# Engine ranking similar songs: local (similarity index in this process) or
+# elasticsearch (cosine similarity of the stored lyric vectors computed
+# inside Elasticsearch)
+SIMILARITY_ENGINE = os.environ.get("SIMILARITY_ENGINE", "local")
+# Query used by the elasticsearch engine: script_score (exact, Elasticsearch
+# 7.x and 8.x) or knn (approximate, Elasticsearch 8.x with indexed vectors)
+ES_SIMILARITY_QUERY = os.environ.get("ES_SIMILARITY_QUERY", "script_score")
+ES_KNN_NUM_CANDIDATES = int(os.environ.get("ES_KNN_NUM_CANDIDATES", "100"))
+# Documents per page and point in time keep alive of streamed retrieval
+ES_PAGE_SIZE = int(os.environ.get("ES_PAGE_SIZE", "1000"))
+ES_PIT_KEEP_ALIVE = os.environ.get("ES_PIT_KEEP_ALIVE", "2m")
+# Readiness: the backend polls the Elasticsearch index with exponential
+# backoff (initial and maximum delay in seconds) until it is loaded. After
+# the deadline /readyz reports the index as overdue, polling goes on
+READY_DEADLINE = float(os.environ.get("READY_DEADLINE", "600"))
+READY_BACKOFF_INITIAL = float(os.environ.get("READY_BACKOFF_INITIAL", "0.5"))
+READY_BACKOFF_MAX = float(os.environ.get("READY_BACKOFF_MAX", "10"))
+# Cache of /search results: entries and time to live (seconds) of the
+# in-process tier and sqlite file of the tier shared between processes
+# (empty to disable it)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_SHARED_PATH = os.environ.get("RESULT_CACHE_SHARED_PATH", "")
+# Genius lyrics fetching: file with the api token, base url of a Genius
+# compatible server (empty for genius.com, e.g. a local fake server in
+# tests), timeout and retries per HTTP request, timeout of a whole fetch,
+# upstream fetches at once and how long (seconds) and how many songs which
+# were not found are remembered
+GENIUS_TOKEN_PATH = os.environ.get(
+    "GENIUS_TOKEN_PATH", "secrets/genius_api_secret"
+)
+GENIUS_BASE_URL = os.environ.get("GENIUS_BASE_URL", "")
+GENIUS_TIMEOUT = float(os.environ.get("GENIUS_TIMEOUT", "5"))
+GENIUS_RETRIES = int(os.environ.get("GENIUS_RETRIES", "0"))
+GENIUS_FETCH_TIMEOUT = float(os.environ.get("GENIUS_FETCH_TIMEOUT", "30"))
+GENIUS_MAX_CONCURRENT = int(os.environ.get("GENIUS_MAX_CONCURRENT", "8"))
+GENIUS_NEGATIVE_TTL = float(os.environ.get("GENIUS_NEGATIVE_TTL", "3600"))
+GENIUS_NEGATIVE_CACHE_SIZE = int(
+    os.environ.get("GENIUS_NEGATIVE_CACHE_SIZE", "10000")
+)
+# Runtime of the mood CNN: keras (SavedModel with the full TensorFlow
+# runtime) or a TFLite export of the model versions (see export_model.py):
+# tflite, tflite_float16 or tflite_int8
+CNN_RUNTIME = os.environ.get("CNN_RUNTIME", "keras")
+# Routing of classifications between model versions: traffic split as
+# comma separated version=weight pairs (empty serves CNN_MODEL_VERSION),
+# version classifying a share of the songs in the background for comparison
+# (empty disables it) and shadow classifications running at most at once
+MODEL_SPLIT = os.environ.get("MODEL_SPLIT", "")
+MODEL_SHADOW_VERSION = os.environ.get("MODEL_SHADOW_VERSION", "")
+MODEL_SHADOW_RATE = float(os.environ.get("MODEL_SHADOW_RATE", "1"))
+MODEL_SHADOW_MAX_IN_FLIGHT = int(
+    os.environ.get("MODEL_SHADOW_MAX_IN_FLIGHT", "16")
+)
+# Threads running the shadow classifications, separate from IO_WORKERS so
+# shadows never hold a worker or a batch slot of served requests
+MODEL_SHADOW_WORKERS = int(os.environ.get("MODEL_SHADOW_WORKERS", "1"))
+# Latest classification calls of the latency percentiles and seconds of the
+# throughput per model version
+MODEL_LATENCY_WINDOW = int(os.environ.get("MODEL_LATENCY_WINDOW", "1000"))
+MODEL_THROUGHPUT_WINDOW = float(
+    os.environ.get("MODEL_THROUGHPUT_WINDOW", "60")
+)
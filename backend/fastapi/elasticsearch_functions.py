@@ -1,72 +1,371 @@
-from elasticsearch import Elasticsearch
+import time
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
+
+from configuration.config import (ES_HOST, ES_KNN_NUM_CANDIDATES,
+                                  ES_MAX_RETRIES, ES_PAGE_SIZE,
+                                  ES_PIT_KEEP_ALIVE, ES_POOL_SIZE,
+                                  ES_REQUEST_TIMEOUT, ES_SIMILARITY_QUERY)
 
 # Set Elasticsearch index name
 index_name = "lyrics_mood_classification"
 
+# Fields computed at write time, so a stored song never has to be
+# preprocessed, classified or vectorized again
+enrichment_mappings = {
+    # normalized SVD vector of the lyrics in the similarity index of the mood
+    "lyric_vector": {"type": "dense_vector", "dims": 300},
+    # build id of the similarity index the lyric vector belongs to
+    "vector_index": {"type": "keyword"},
+    # softmax output of the model, ordered like the label encoder classes
+    "mood_probabilities": {"type": "float"},
+    "preprocessed_lyrics": {"type": "text"},
+    "model_version": {"type": "keyword"},
+    # mood classified by model_version, mood itself keeps the label of the
+    # dataset for songs loaded from the csv file
+    "model_mood": {"type": "keyword"},
+    # time the backend last wrote the document, incremental snapshots of the
+    # index contain the documents written since the previous snapshot
+    "indexed_at": {"type": "date", "format": "epoch_millis"},
+}
+if ES_SIMILARITY_QUERY == "knn":
+    # approximate kNN search needs an indexed vector (Elasticsearch 8.x)
+    enrichment_mappings["lyric_vector"].update(
+        {"index": True, "similarity": "cosine"}
+    )
+
+# Fields of a stored song document returned by get_stored_document
+stored_song_fields = [
+    "song_name",
+    "artist_name",
+    "lyrics",
+    "mood",
+    "lyric_vector",
+    "vector_index",
+    "mood_probabilities",
+    "model_version",
+    "model_mood",
+]
+
+# Shared clients, created once per process and reused by all functions
+es_client = None
+es_async_client = None
+
+
+def client_options():
+    """Connection pool, timeout and retry options of the shared clients.
+
+    :return: keyword arguments for Elasticsearch and AsyncElasticsearch.
+    :rtype: dict
+    """
+    return {
+        "hosts": ES_HOST,
+        "connections_per_node": ES_POOL_SIZE,
+        "request_timeout": ES_REQUEST_TIMEOUT,
+        "max_retries": ES_MAX_RETRIES,
+        "retry_on_timeout": True,
+    }
+
+
+def get_client():
+    """Return the shared Elasticsearch client and create it on first use.
+
+    :return: shared synchronous client.
+    :rtype: Elasticsearch
+    """
+
+    global es_client
+
+    if es_client is None:
+        es_client = Elasticsearch(**client_options())
+    return es_client
+
+
+def get_async_client():
+    """Return the shared AsyncElasticsearch client and create it on first use.
+
+    :return: shared asynchronous client.
+    :rtype: AsyncElasticsearch
+    """
+
+    global es_async_client
+
+    if es_async_client is None:
+        es_async_client = AsyncElasticsearch(**client_options())
+    return es_async_client
 
-def add_es_document(song_name, artist_name, lyrics, mood):
+
+async def close_clients():
+    """Close the shared clients and their connection pools (application shutdown)."""
+
+    global es_client, es_async_client
+
+    if es_client is not None:
+        es_client.close()
+        es_client = None
+    if es_async_client is not None:
+        await es_async_client.close()
+        es_async_client = None
+
+
+def ensure_mappings():
+    """Add the enrichment fields to the mapping of an index created without them (the strict mapping rejects unknown fields)."""
+
+    global index_name
+
+    get_client().indices.put_mapping(
+        index=index_name, properties=enrichment_mappings
+    )
+
+
+def indexed_at():
+    """Return the current time as stored in the indexed_at field.
+
+    :return: milliseconds since the epoch.
+    :rtype: int
+    """
+    return int(time.time() * 1000)
+
+
+def song_document(song_name, artist_name, lyrics, mood, enrichment=None):
+    """Return the document stored for a song.
+
+    :param song_name: song name of the document entry.
+    :param artist_name: artist name of the document entry.
+    :param lyrics: lyrics of the document entry.
+    :param mood: mood of the document entry.
+    :param enrichment: values of the enrichment fields (see enrichment_mappings), None values are left out.
+
+    :return: document of the song.
+    :rtype: dict
+    """
+    document = {
+        "song_name": song_name,
+        "artist_name": artist_name,
+        "lyrics": lyrics,
+        "mood": mood,
+        "indexed_at": indexed_at(),
+    }
+    for field, value in (enrichment or {}).items():
+        if value is not None:
+            document[field] = value
+    return document
+
+
+def song_query(song_name, artist_name):
+    """Return the query searching a song (use match instead of term query to handle typos).
+
+    :param song_name: song name of the document entry.
+    :param artist_name: artist name of the document entry.
+
+    :return: bool query matching song and artist name.
+    :rtype: dict
+    """
+    return {
+        "bool": {
+            "must": [
+                {"match": {"song_name": song_name}},
+                {"match": {"artist_name": artist_name}},
+            ]
+        }
+    }
+
+
+def first_source(result):
+    """Return the _source of the most relevant hit of a search result.
+
+    :param result: search result.
+
+    :return: _source of the first hit if a document has been found. Else None.
+    :rtype: dict or None
+    """
+    if result["hits"]["total"]["value"] > 0:
+        return result["hits"]["hits"][0]["_source"]
+    return None
+
+
+def add_es_document(song_name, artist_name, lyrics, mood, enrichment=None):
     """Add document to Elasticsearch index.
 
     :param song_name: song name of the document entry.
     :param artist_name: artist name of the document entry.
     :param lyrics: artist name of the document entry.
     :param mood: mood of the document entry.
+    :param enrichment: values of the enrichment fields of the document entry.
     """
 
     global index_name
 
-    es_host = "http://elasticsearch:9200"
+    # Add document to index
+    get_client().index(
+        index=index_name,
+        document=song_document(song_name, artist_name, lyrics, mood, enrichment),
+    )
+
+
+async def async_add_es_document(
+    song_name, artist_name, lyrics, mood, enrichment=None, refresh=None
+):
+    """Add document to Elasticsearch index without blocking the event loop.
+
+    :param song_name: song name of the document entry.
+    :param artist_name: artist name of the document entry.
+    :param lyrics: artist name of the document entry.
+    :param mood: mood of the document entry.
+    :param enrichment: values of the enrichment fields of the document entry.
+    :param refresh: "wait_for" returns once the document is searchable, defaults to None.
+    """
+
+    global index_name
 
-    es = Elasticsearch(hosts=es_host)
     # Add document to index
-    es.index(
+    await get_async_client().index(
         index=index_name,
-        document={
-            "song_name": song_name,
-            "artist_name": artist_name,
-            "lyrics": lyrics,
-            "mood": mood,
-        },
+        document=song_document(song_name, artist_name, lyrics, mood, enrichment),
+        refresh=refresh,
     )
-    es.close()
 
 
-def get_stored_mood_of_song(song_name, artist_name):
-    """Search in Elasticsearch index for the song and return the mood if already stored.
+def add_es_documents(documents):
+    """Add many documents to Elasticsearch index with one bulk request.
+
+    :param documents: dicts with song_name, artist_name, lyrics and mood of the document entries.
+
+    :return: error of every document in the order of documents, None if the document has been added.
+    :rtype: list
+    """
+
+    global index_name
+
+    # streaming_bulk yields the result of every action in order, indexed_at
+    # is stamped again when the action is sent
+    return [
+        None if ok else result
+        for ok, result in helpers.streaming_bulk(
+            get_client(),
+            (
+                {
+                    "_index": index_name,
+                    "_source": {**document, "indexed_at": indexed_at()},
+                }
+                for document in documents
+            ),
+            raise_on_error=False,
+        )
+    ]
+
+
+def update_es_documents(updates):
+    """Update fields of many stored documents with one bulk request.
+
+    :param updates: pairs of document id and dict of the fields to update.
+
+    :return: number of successful operations and list of errors.
+    :rtype: tuple
+    """
+
+    global index_name
+
+    successful_operations, errors = helpers.bulk(
+        get_client(),
+        (
+            {
+                "_op_type": "update",
+                "_index": index_name,
+                "_id": document_id,
+                "doc": {**fields, "indexed_at": indexed_at()},
+            }
+            for document_id, fields in updates
+        ),
+        raise_on_error=False,
+    )
+    return successful_operations, errors
+
+
+def get_stored_document(song_name, artist_name, fields=None):
+    """Search in Elasticsearch index for the song and return the whole stored document with one query.
 
     :param song_name: song name of the document entry.
     :param artist_name: artist name of the document entry.
+    :param fields: fields of the document to return (_source filtering), defaults to stored_song_fields.
 
-    :return: Mood of given song and artist name if stored in Elasticsearch index. Else None.
-    :rtype: String or None
+    :return: Stored fields of the most relevant document for given song and artist name if stored in Elasticsearch index. Else None.
+    :rtype: dict or None
     """
 
     global index_name
 
-    es_host = "http://elasticsearch:9200"
+    # Search for song in es index and take most relevant result
+    result = get_client().search(
+        index=index_name,
+        query=song_query(song_name, artist_name),
+        size=1,
+        source_includes=fields or stored_song_fields,
+    )
+    return first_source(result)
+
+
+async def async_get_stored_document(song_name, artist_name, fields=None):
+    """Search in Elasticsearch index for the song and return the whole stored document with one query without blocking the event loop.
+
+    :param song_name: song name of the document entry.
+    :param artist_name: artist name of the document entry.
+    :param fields: fields of the document to return (_source filtering), defaults to stored_song_fields.
+
+    :return: Stored fields of the most relevant document for given song and artist name if stored in Elasticsearch index. Else None.
+    :rtype: dict or None
+    """
 
-    es = Elasticsearch(hosts=es_host)
+    global index_name
 
-    # Search for song in es index (use match instead of term query to handle typos)
-    result = es.search(
+    # Search for song in es index and take most relevant result
+    result = await get_async_client().search(
         index=index_name,
-        query={
-            "bool": {
-                "must": [
-                    {"match": {"song_name": song_name}},
-                    {"match": {"artist_name": artist_name}},
-                ]
-            }
-        },
+        query=song_query(song_name, artist_name),
+        size=1,
+        source_includes=fields or stored_song_fields,
     )
+    return first_source(result)
 
-    # Check if a song has been found
-    es.close()
-    if result["hits"]["total"]["value"] > 0:
-        # Take most relevant result
-        return result["hits"]["hits"][0]["_source"]["mood"]
-    else:
-        return None
+
+async def async_get_index_status():
+    """Return whether the index exists, whether documents are still being bulk loaded into it (refreshes are disabled while loading) and its number of documents.
+
+    :return: exists, loading and documents of the index.
+    :rtype: dict
+    """
+
+    global index_name
+
+    client = get_async_client()
+    if not await client.indices.exists(index=index_name):
+        return {"exists": False, "loading": False, "documents": 0}
+    settings = await client.indices.get_settings(
+        index=index_name, name="index.refresh_interval"
+    )
+    refresh_interval = (
+        settings[index_name]["settings"].get("index", {}).get("refresh_interval")
+    )
+    count = await client.count(index=index_name)
+    return {
+        "exists": True,
+        "loading": refresh_interval == "-1",
+        "documents": count["count"],
+    }
+
+
+def get_stored_mood_of_song(song_name, artist_name):
+    """Search in Elasticsearch index for the song and return the mood if already stored.
+
+    :param song_name: song name of the document entry.
+    :param artist_name: artist name of the document entry.
+
+    :return: Mood of given song and artist name if stored in Elasticsearch index. Else None.
+    :rtype: String or None
+    """
+
+    document = get_stored_document(song_name, artist_name, ["mood"])
+    return None if document is None else document["mood"]
 
 
 def get_stored_lyrics_of_song(song_name, artist_name):
@@ -78,72 +377,93 @@ def get_stored_lyrics_of_song(song_name, artist_name):
     :return: Lyrics of given song and artist name if stored in Elasticsearch index. Else None.
     :rtype: String or None
     """
-    global index_name
 
-    es_host = "http://elasticsearch:9200"
+    document = get_stored_document(song_name, artist_name, ["lyrics"])
+    return None if document is None else document["lyrics"]
 
-    es = Elasticsearch(hosts=es_host)
 
-    # Search for song in es index (use match instead of term query to handle typos)
-    result = es.search(
-        index=index_name,
-        query={
-            "bool": {
-                "must": [
-                    {"match": {"song_name": song_name}},
-                    {"match": {"artist_name": artist_name}},
-                ]
-            }
-        },
-    )
-    # Check if a song has been found
-    es.close()
-    if result["hits"]["total"]["value"] > 0:
-        # Take most relevant result
-        return result["hits"]["hits"][0]["_source"]["lyrics"]
-    else:
-        return None
+def iter_documents(query, fields=None, page_size=ES_PAGE_SIZE):
+    """Generator that streams all documents matching a query in pages, using a point in time and search_after instead of one search limited to 10000 hits. Only one page is held in memory at a time.
 
+    :param query: query of the documents.
+    :param fields: fields of the documents to return (_source filtering), defaults to all fields.
+    :param page_size: number of documents per page.
 
-def get_all_documents_of_mood(mood):
+    :return: pages of documents, each document is its _source with the document id as "_id".
+    :rtype: Iterator[list[dict]]
     """
-    Function that returns all the documents of a certain mood.
+
+    global index_name
+
+    es = get_client()
+    pit_id = es.open_point_in_time(
+        index=index_name, keep_alive=ES_PIT_KEEP_ALIVE
+    )["id"]
+    try:
+        search_after = None
+        while True:
+            arguments = {"source_includes": fields} if fields else {}
+            if search_after is not None:
+                arguments["search_after"] = search_after
+            result = es.search(
+                query=query,
+                size=page_size,
+                pit={"id": pit_id, "keep_alive": ES_PIT_KEEP_ALIVE},
+                # cheapest sort order with a tiebreaker for search_after
+                sort=["_shard_doc"],
+                track_total_hits=False,
+                **arguments,
+            )
+            pit_id = result.get("pit_id", pit_id)
+            hits = result["hits"]["hits"]
+            if not hits:
+                break
+            yield [dict(hit["_source"], _id=hit["_id"]) for hit in hits]
+            search_after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit_id)
+
+
+def iter_documents_of_mood(mood, fields=None, page_size=ES_PAGE_SIZE):
+    """Generator that streams all documents of a certain mood in pages.
 
     :param mood: mood of the document entry.
+    :param fields: fields of the documents to return (_source filtering), defaults to all fields.
+    :param page_size: number of documents per page.
 
-    :return: dict of documents of the given mood.
-    :rtype: dict
+    :return: pages of documents of the given mood.
+    :rtype: Iterator[list[dict]]
     """
+    return iter_documents({"match": {"mood": mood}}, fields, page_size)
 
-    global index_name
 
-    es_host = "http://elasticsearch:9200"
-    es = Elasticsearch(hosts=es_host)
+def get_all_documents_of_mood(mood):
+    """
+    Function that returns all the documents of a certain mood.
 
-    # search for all document of given mood (set size to 10000 to get all documents, as it is max number of documents that can be found at once and there are less than 10000 documents in the index for each mood)
-    results = es.search(index=index_name, size=10000,
-                        query={"match": {"mood": mood}})
-    es.close()
+    :param mood: mood of the document entry.
 
-    # check if given mood has songs in the index
-    if results["hits"]["total"]["value"] == 0:
-        raise Exception(f"No songs found for mood: {mood}.")
+    :return: dict of documents of the given mood, empty if the mood has no songs.
+    :rtype: dict
+    """
 
-    # save all lyrics of the songs with the given mood
+    # stream all documents of given mood page by page (no 10000 hits limit)
     song_same_mood_dict = {}
-    for result in results["hits"]["hits"]:
-        song = result["_source"]["song_name"]
-        artist = result["_source"]["artist_name"]
-        lyrics = result["_source"]["lyrics"]
-        document_dict = {"Song": song, "Artist": artist, "Lyrics": lyrics}
-
-        # add document to song_same_mood_dict
-        song_same_mood_dict[f"{song}_{artist}"] = document_dict
+    for page in iter_documents_of_mood(
+        mood, ["song_name", "artist_name", "lyrics"]
+    ):
+        for document in page:
+            song = document["song_name"]
+            artist = document["artist_name"]
+            lyrics = document["lyrics"]
+            document_dict = {"Song": song, "Artist": artist, "Lyrics": lyrics}
+
+            # add document to song_same_mood_dict
+            song_same_mood_dict[f"{song}_{artist}"] = document_dict
 
     return song_same_mood_dict
 
 
-
 def get_stored_song(song_name, artist_name):
     """Search in Elasticsearch index for the song and return the song and artist name if already stored.
 
@@ -154,30 +474,107 @@ def get_stored_song(song_name, artist_name):
     :rtype: String or None
     """
 
-    global index_name
+    document = get_stored_document(
+        song_name, artist_name, ["song_name", "artist_name"]
+    )
+    if document is None:
+        return None
+    return document["song_name"], document["artist_name"]
 
-    es_host = "http://elasticsearch:9200"
 
-    es = Elasticsearch(hosts=es_host)
+def similar_songs_search(lyric_vector, vector_index, mood, size):
+    """Return the search arguments ranking the stored songs of a mood by cosine similarity to a lyric vector inside Elasticsearch.
 
-    # Search for song in es index (use match instead of term query to handle typos)
-    result = es.search(
-        index=index_name,
-        query={
-            "bool": {
-                "must": [
-                    {"match": {"song_name": song_name}},
-                    {"match": {"artist_name": artist_name}},
-                ]
-            }
-        },
-    )
+    :param lyric_vector: normalized lyric vector of the song to compare with.
+    :param vector_index: build id of the similarity index the vector belongs to, only vectors of the same build are comparable.
+    :param mood: mood of the songs to compare with.
+    :param size: number of songs to return.
 
-    # Check if a song has been found
-    es.close()
-    if result["hits"]["total"]["value"] > 0:
-        # Take most relevant result
-        return result["hits"]["hits"][0]["_source"]["song_name"], result["hits"]["hits"][0]["_source"]["artist_name"]
+    :return: keyword arguments of the search.
+    :rtype: dict
+    """
+    song_filter = {
+        "bool": {
+            "must": [{"match": {"mood": mood}}],
+            "filter": [{"term": {"vector_index": vector_index}}],
+        }
+    }
+    arguments = {"size": size, "source_includes": ["song_name", "artist_name"]}
+    if ES_SIMILARITY_QUERY == "knn":
+        arguments["knn"] = {
+            "field": "lyric_vector",
+            "query_vector": list(lyric_vector),
+            "k": size,
+            "num_candidates": max(ES_KNN_NUM_CANDIDATES, size),
+            "filter": song_filter,
+        }
     else:
-        return None
+        # scores must not be negative, hence + 1.0
+        arguments["query"] = {
+            "script_score": {
+                "query": {
+                    "bool": {
+                        "must": song_filter["bool"]["must"],
+                        "filter": song_filter["bool"]["filter"]
+                        + [{"exists": {"field": "lyric_vector"}}],
+                    }
+                },
+                "script": {
+                    "source": "cosineSimilarity(params.query_vector, 'lyric_vector') + 1.0",
+                    "params": {"query_vector": list(lyric_vector)},
+                },
+            }
+        }
+    return arguments
+
+
+def hit_similarity(hit):
+    """Return the cosine similarity of a hit of similar_songs_search.
+
+    :param hit: search hit.
+
+    :return: cosine similarity.
+    :rtype: float
+    """
+    if ES_SIMILARITY_QUERY == "knn":
+        # knn scores cosine similarity as (1 + cosine) / 2
+        return 2 * hit["_score"] - 1
+    return hit["_score"] - 1
+
+
+async def async_get_similar_songs(lyric_vector, vector_index, mood, top_n=3):
+    """Search the top n most similar songs of a mood inside Elasticsearch, so only their names and scores are transferred.
+
+    :param lyric_vector: normalized lyric vector of the song to compare with.
+    :param vector_index: build id of the similarity index the vector belongs to.
+    :param mood: mood of the songs to compare with.
+    :param top_n: number of most similar songs to return.
+
+    :return: dict of the top n most similar songs with song name, artist name and similarity.
+    :rtype: dict
+    """
+
+    global index_name
+
+    # query a few more songs, duplicates of the song itself are filtered
+    result = await get_async_client().search(
+        index=index_name,
+        **similar_songs_search(lyric_vector, vector_index, mood, top_n + 3),
+    )
 
+    similar_songs = {}
+    for hit in result["hits"]["hits"]:
+        similarity = hit_similarity(hit)
+        # similarity >= 0.999 means, that the same song has been found
+        if similarity >= 0.999:
+            continue
+        song = hit["_source"]["song_name"]
+        artist = hit["_source"]["artist_name"]
+        similar_songs[f"{song}_{artist}"] = {
+            "Song": song,
+            "Artist": artist,
+            "Similarity": round(similarity * 100, 2),
+        }
+        if len(similar_songs) == top_n:
+            break
+    return similar_songs
@@ -0,0 +1,183 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+
+import utils
+from configuration.config import (CPU_MAX_QUEUE, CPU_WORKERS, IO_MAX_QUEUE,
+                                  IO_WORKERS, MODEL_SHADOW_MAX_IN_FLIGHT,
+                                  MODEL_SHADOW_WORKERS)
+
+
+def timed_call(function, *args, **kwargs) -> tuple[float, float, object]:
+    """Call a function and return when it started and finished running.
+    Defined on module level so it can be sent to worker processes.
+
+    :param function: function to call
+    :return: start time, end time and return value of the function
+    :rtype: tuple[float, float, object]
+    """
+    started = time.time()
+    result = function(*args, **kwargs)
+    return started, time.time(), result
+
+
+class BoundedExecutor:
+    """Executor wrapper for the event loop. It limits the number of calls in
+    flight (callers wait when workers and queue are full) and keeps track of
+    queue depth, saturation and timing.
+    """
+
+    def __init__(
+        self, name: str, executor: Executor, workers: int, max_queue: int
+    ):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.max_queue = max_queue
+        # calls submitted to the executor and not finished yet
+        self.in_flight = 0
+        # calls waiting for a free slot before being submitted
+        self.waiting = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self._slots = None
+
+    async def run(self, function, *args, **kwargs):
+        """Run a function in the executor and await its result.
+
+        :param function: function to run, must be picklable for processes
+        :return: return value of the function
+        """
+        # created lazily to bind the semaphore to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.max_queue)
+
+        submitted = time.time()
+        self.waiting += 1
+        async with self._slots:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                started, finished, result = await asyncio.wrap_future(
+                    self.executor.submit(timed_call, function, *args, **kwargs)
+                )
+            except BaseException:
+                self.failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+        self.completed += 1
+        self.total_wait += started - submitted
+        self.total_run += finished - started
+        return result
+
+    def busy(self) -> bool:
+        """Return whether calls are waiting for a free worker.
+
+        :return: True if all workers are taken and calls are queued
+        :rtype: bool
+        """
+        return self.in_flight + self.waiting > self.workers
+
+    def stats(self) -> dict:
+        """Return queue depth, saturation and timing of the executor.
+
+        :return: executor statistics
+        :rtype: dict
+        """
+        running = min(self.in_flight, self.workers)
+        completed = max(self.completed, 1)
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": running,
+            "queued": self.in_flight - running + self.waiting,
+            "max_in_flight": self.max_in_flight,
+            "saturation": round(running / self.workers, 3),
+            "completed": self.completed,
+            "failed": self.failed,
+            "mean_wait_ms": round(1000 * self.total_wait / completed, 3),
+            "mean_run_ms": round(1000 * self.total_run / completed, 3),
+        }
+
+    def shutdown(self) -> None:
+        """Shut the executor down after running calls finished."""
+        self.executor.shutdown(wait=True)
+
+
+# I/O bound steps (Genius scraping, file reads, Elasticsearch) as well as
+# TensorFlow inference and numpy lookups, which release the GIL and need the
+# models and indexes loaded in this process
+io_executor = BoundedExecutor(
+    "io",
+    ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io"),
+    IO_WORKERS,
+    IO_MAX_QUEUE,
+)
+
+# Low priority lane of the shadow model version, so background comparisons
+# do not queue in front of served classifications
+shadow_executor = BoundedExecutor(
+    "shadow",
+    ThreadPoolExecutor(
+        max_workers=MODEL_SHADOW_WORKERS, thread_name_prefix="shadow"
+    ),
+    MODEL_SHADOW_WORKERS,
+    MODEL_SHADOW_MAX_IN_FLIGHT,
+)
+
+# CPU bound steps holding the GIL (spaCy preprocessing, TF-IDF/SVD fitting).
+# Workers are spawned, since forking a process with loaded TensorFlow is
+# unsafe, and preload the spaCy pipeline.
+cpu_executor = BoundedExecutor(
+    "cpu",
+    ProcessPoolExecutor(
+        max_workers=CPU_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=utils.get_nlp,
+    ),
+    CPU_WORKERS,
+    CPU_MAX_QUEUE,
+)
+
+
+async def run_io(function, *args, **kwargs):
+    """Run an I/O bound function in the thread pool.
+
+    :param function: function to run
+    :return: return value of the function
+    """
+    return await io_executor.run(function, *args, **kwargs)
+
+
+async def run_cpu(function, *args, **kwargs):
+    """Run a CPU bound function in the process pool.
+
+    :param function: module level function to run
+    :return: return value of the function
+    """
+    return await cpu_executor.run(function, *args, **kwargs)
+
+
+def stats() -> dict:
+    """Return the statistics of all executors.
+
+    :return: statistics per executor
+    :rtype: dict
+    """
+    return {
+        executor.name: executor.stats()
+        for executor in (io_executor, cpu_executor, shadow_executor)
+    }
+
+
+def shutdown() -> None:
+    """Shut all executors down."""
+    for executor in (io_executor, cpu_executor, shadow_executor):
+        executor.shutdown()
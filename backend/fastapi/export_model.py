@@ -0,0 +1,300 @@
+"""Command line tool to export a model version to TFLite and compare the
+exported variants with the Keras SavedModel.
+
+Three variants are written into the model version directory:
+    model.tflite          float32, same numerics as the SavedModel
+    model_float16.tflite  weights stored as float16
+    model_int8.tflite     dynamic range quantization (int8 weights)
+
+The report compares the mood probabilities and predicted moods of every
+variant with the Keras predictions and measures load time, peak memory and
+prediction latency of each runtime in a fresh process. The backend uses a
+variant with CNN_RUNTIME=tflite, tflite_float16 or tflite_int8.
+
+With --headless the embedding matrix of the SavedModel is written to
+embedding.npy and the layers after it to a headless SavedModel. The keras
+runtime then loads only the headless model and looks the embedding up in
+the memory mapped file, which is shared by all worker processes, instead of
+reading the full matrix into every worker.
+
+Examples:
+    python export_model.py cnn_model_v3 --samples 500
+    python export_model.py cnn_model_v3 --headless
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import resource
+import time
+
+import numpy as np
+
+from configuration.config import CNN_MODEL_DIRECTORY
+from lite_model import TFLITE_FILES
+from model_registry import (SEQUENCE_LENGTH, TOKENIZER_FILE, ModelHandle,
+                            save_headless)
+from vocabulary import Vocabulary, vocabulary_exists
+
+REPORT_FILE = "export_report.json"
+
+
+def memory_usage() -> tuple[int, int]:
+    """Function returns the current and the peak resident memory of the
+    process. /proc/self/status starts over in a spawned process, whereas
+    ru_maxrss keeps the peak of the parent across fork and exec.
+
+    :return: current and peak resident memory in bytes
+    :rtype: tuple[int, int]
+    """
+    try:
+        with open("/proc/self/status") as status:
+            fields = dict(line.split(":", 1) for line in status)
+        # kilobytes
+        return (1024 * int(fields["VmRSS"].split()[0]),
+                1024 * int(fields["VmHWM"].split()[0]))
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux
+        return 1024 * peak, 1024 * peak
+
+
+def convert(path: str, runtime: str) -> str:
+    """Function converts the SavedModel of a model version to a TFLite file.
+
+    :param path: directory of the model version
+    :type path: str
+    :param runtime: tflite, tflite_float16 or tflite_int8
+    :type runtime: str
+    :return: path of the written TFLite file
+    :rtype: str
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(path)
+    if runtime != "tflite":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if runtime == "tflite_float16":
+        converter.target_spec.supported_types = [tf.float16]
+    tflite_path = os.path.join(path, TFLITE_FILES[runtime])
+    with open(tflite_path, "wb") as file:
+        file.write(converter.convert())
+    return tflite_path
+
+
+def sample_sequences(path: str, samples: int, seed: int = 42) -> np.ndarray:
+    """Function returns padded sequences of random tokens of the vocabulary
+    of a model version with random lengths, as input of the parity check.
+
+    :param path: directory of the model version
+    :type path: str
+    :param samples: number of sequences
+    :type samples: int
+    :param seed: seed of the random generator, defaults to 42
+    :type seed: int, optional
+    :return: padded token sequences (samples x 180)
+    :rtype: np.ndarray
+    """
+    if vocabulary_exists(path):
+        # unpickling the tokenizer needs the Keras 2 preprocessing module
+        vocabulary_size = int(Vocabulary(path).ids.max()) + 1
+    else:
+        with open(os.path.join(path, TOKENIZER_FILE), "rb") as handle:
+            tokenizer = pickle.load(handle)
+        vocabulary_size = tokenizer.num_words or len(tokenizer.word_index) + 1
+
+    random = np.random.default_rng(seed)
+    sequences = np.zeros((samples, SEQUENCE_LENGTH), dtype=np.int32)
+    for row in range(samples):
+        length = random.integers(1, SEQUENCE_LENGTH + 1)
+        sequences[row, -length:] = random.integers(1, vocabulary_size, length)
+    return sequences
+
+
+def parity(reference: np.ndarray, prediction: np.ndarray) -> dict:
+    """Function compares the predictions of a variant with the reference.
+
+    :param reference: Keras probabilities (samples x moods)
+    :type reference: np.ndarray
+    :param prediction: probabilities of the variant (samples x moods)
+    :type prediction: np.ndarray
+    :return: maximum and mean absolute difference of the probabilities and
+        share of equal predicted moods
+    :rtype: dict
+    """
+    difference = np.abs(reference - prediction)
+    return {
+        "max_abs_difference": float(difference.max()),
+        "mean_abs_difference": float(difference.mean()),
+        "mood_agreement": float(
+            np.mean(reference.argmax(axis=1) == prediction.argmax(axis=1))
+        ),
+    }
+
+
+def benchmark(
+    version: str, path: str, runtime: str, sequences: np.ndarray,
+    repetitions: int, results
+) -> None:
+    """Function loads a model version with one runtime and measures it. It
+    runs in a fresh process, so the peak memory belongs to this runtime.
+
+    :param version: name of the model version
+    :type version: str
+    :param path: directory of the model version
+    :type path: str
+    :param runtime: keras, tflite, tflite_float16 or tflite_int8
+    :type runtime: str
+    :param sequences: padded token sequences to predict
+    :type sequences: np.ndarray
+    :param repetitions: number of timed predictions per batch size
+    :type repetitions: int
+    :param results: queue receiving the predictions and measurements
+    """
+    memory_before, _ = memory_usage()
+    handle = ModelHandle(version, path, runtime)
+    measurements = {
+        "load_time_seconds": round(handle.load_time, 3),
+        "weights_bytes": handle.weights_bytes,
+    }
+    predictions = handle.predict(sequences)
+    for batch_size in (1, 32):
+        batch = sequences[:batch_size]
+        handle.predict(batch)
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            handle.predict(batch)
+        measurements[f"latency_ms_batch_{batch_size}"] = round(
+            1000 * (time.perf_counter() - start) / repetitions, 3
+        )
+    _, measurements["peak_memory_bytes"] = memory_usage()
+    measurements["load_memory_bytes"] = (
+        measurements["peak_memory_bytes"] - memory_before
+    )
+    results.put((predictions, measurements))
+
+
+def measure(
+    version: str, path: str, runtime: str, sequences: np.ndarray,
+    repetitions: int
+) -> tuple[np.ndarray, dict]:
+    """Function runs benchmark in a spawned process.
+
+    :raises RuntimeError: the process exited without measurements
+    :return: predictions and measurements of the runtime
+    :rtype: tuple[np.ndarray, dict]
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=benchmark,
+        args=(version, path, runtime, sequences, repetitions, results),
+    )
+    process.start()
+    while True:
+        try:
+            predictions, measurements = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # e.g. the runtime failed to load the model
+            if not process.is_alive():
+                raise RuntimeError(
+                    f"Measuring the {runtime} runtime failed with exit code "
+                    f"{process.exitcode}"
+                )
+    process.join()
+    return predictions, measurements
+
+
+def export(version: str, samples: int, repetitions: int) -> dict:
+    """Function exports all TFLite variants of a model version and writes
+    the comparison report into the model version directory.
+
+    :param version: name of the model version, e.g. cnn_model_v3
+    :type version: str
+    :param samples: number of sequences of the parity check
+    :type samples: int
+    :param repetitions: number of timed predictions per batch size
+    :type repetitions: int
+    :return: report with parity and measurements per runtime
+    :rtype: dict
+    """
+    path = os.path.join(CNN_MODEL_DIRECTORY, version)
+    sequences = sample_sequences(path, samples)
+    reference, measurements = measure(
+        version, path, "keras", sequences, repetitions
+    )
+    report = {"version": version, "samples": samples, "keras": measurements}
+    for runtime in TFLITE_FILES:
+        tflite_path = convert(path, runtime)
+        print(f"Exported {tflite_path}")
+        predictions, measurements = measure(
+            version, path, runtime, sequences, repetitions
+        )
+        report[runtime] = {**measurements, **parity(reference, predictions)}
+
+    with open(os.path.join(path, REPORT_FILE), "w") as file:
+        json.dump(report, file, indent=2)
+    return report
+
+
+def export_headless(version: str, samples: int) -> dict:
+    """Function writes the embedding matrix and the headless SavedModel of
+    a model version and compares the predictions of the full model with
+    the predictions of the handle loading the headless one.
+
+    :param version: name of the model version, e.g. cnn_model_v3
+    :type version: str
+    :param samples: number of sequences of the parity check
+    :type samples: int
+    :return: shape of the embedding, load time and weights of the handle
+        and parity of the predictions
+    :rtype: dict
+    """
+    import tensorflow as tf
+
+    path = os.path.join(CNN_MODEL_DIRECTORY, version)
+    keras_model = tf.keras.models.load_model(path)
+    embedding = save_headless(keras_model, path)
+
+    sequences = sample_sequences(path, samples)
+    reference = keras_model(sequences, training=False).numpy()
+    handle = ModelHandle(version, path, "keras")
+    return {
+        "version": version,
+        "embedding_shape": list(embedding.shape),
+        "load_time_seconds": round(handle.load_time, 3),
+        "weights_bytes": handle.weights_bytes,
+        **parity(reference, handle.predict(sequences)),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Export a model version to TFLite and compare it."
+    )
+    parser.add_argument("version", help="model version, e.g. cnn_model_v3")
+    parser.add_argument(
+        "--samples", type=int, default=500,
+        help="number of sequences of the parity check"
+    )
+    parser.add_argument(
+        "--repetitions", type=int, default=50,
+        help="number of timed predictions per batch size"
+    )
+    parser.add_argument(
+        "--headless", action="store_true",
+        help="only export embedding.npy and the headless SavedModel"
+    )
+    args = parser.parse_args()
+    if args.headless:
+        report = export_headless(args.version, args.samples)
+    else:
+        report = export(args.version, args.samples, args.repetitions)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
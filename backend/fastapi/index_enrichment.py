@@ -0,0 +1,144 @@
+import time
+
+import numpy as np
+
+import elasticsearch_functions as ef
+import utils
+from configuration.config import ENRICH_CHUNK_SIZE
+from model_registry import registry
+from similarity_index import similarity_indexes
+
+
+def enrichment_of(
+    classification: dict, lyric_vector: np.ndarray, vector_index: str
+) -> dict:
+    """Function returns the enrichment fields stored with a song.
+
+    :param classification: classification of the song, see
+        model_registry.ModelHandle.classification
+    :type classification: dict
+    :param lyric_vector: normalized vector of the lyrics or None
+    :type lyric_vector: np.ndarray
+    :param vector_index: build id of the similarity index of the vector
+    :type vector_index: str
+    :return: values of elasticsearch_functions.enrichment_mappings
+    :rtype: dict
+    """
+    # vectors without magnitude (no known word) can not be compared
+    if lyric_vector is not None and not np.any(lyric_vector):
+        lyric_vector = None
+    return {
+        "lyric_vector": None if lyric_vector is None else lyric_vector.tolist(),
+        "vector_index": vector_index,
+        "mood_probabilities": classification["mood_probabilities"],
+        "preprocessed_lyrics": classification["preprocessed_lyrics"],
+        "model_version": classification["model_version"],
+        "model_mood": classification["mood"],
+    }
+
+
+def documents_to_enrich(mood: str, vector_index: str) -> dict:
+    """Function returns the query for stored songs of a mood which have not
+    been classified yet (or were enriched before model_mood was stored) or
+    whose vector belongs to another index build.
+
+    :param mood: mood of the songs
+    :type mood: str
+    :param vector_index: build id of the similarity index of the mood or
+        None if the mood has no index
+    :type vector_index: str
+    :return: Elasticsearch query
+    :rtype: dict
+    """
+    missing = [
+        {"bool": {"must_not": {"exists": {"field": "model_version"}}}},
+        {"bool": {"must_not": {"exists": {"field": "model_mood"}}}},
+    ]
+    if vector_index is not None:
+        missing.append(
+            {"bool": {"must_not": {"term": {"vector_index": vector_index}}}}
+        )
+    return {
+        "bool": {
+            "must": [{"match": {"mood": mood}}],
+            "should": missing,
+            "minimum_should_match": 1,
+        }
+    }
+
+
+def enrich_chunk(model, mood_index, documents: list[dict]) -> int:
+    """Function classifies and vectorizes one chunk of stored songs and
+    updates them with one bulk request.
+
+    :param model: handle of the model version to use
+    :type model: model_registry.ModelHandle
+    :param mood_index: similarity index of the mood or None
+    :type mood_index: similarity_index.MoodIndex
+    :param documents: stored songs with document id and lyrics
+    :type documents: list[dict]
+    :return: number of updated songs
+    :rtype: int
+    """
+    lyrics = [document["lyrics"].lower() for document in documents]
+    classifications = model.classify(utils.preprocess_lyrics_batch(lyrics))
+
+    updates = []
+    for document, lyric, classification in zip(
+        documents, lyrics, classifications
+    ):
+        vector, vector_index = None, None
+        if mood_index is not None:
+            vector, vector_index = mood_index.vectorize(lyric), mood_index.build_id
+        updates.append(
+            (
+                document["_id"],
+                enrichment_of(classification, vector, vector_index),
+            )
+        )
+    successful_operations, errors = ef.update_es_documents(updates)
+    if errors:
+        print(f"Errors: {errors}")
+    return successful_operations
+
+
+def enrich_stored_documents(chunk_size: int = ENRICH_CHUNK_SIZE) -> int:
+    """Function adds lyric vector, mood probabilities, preprocessed lyrics
+    and model version to all stored songs which lack them, e.g. after the
+    initial load of the index from the csv file or a dump.
+
+    :param chunk_size: number of songs processed together
+    :type chunk_size: int
+    :return: number of updated songs
+    :rtype: int
+    """
+    ef.ensure_mappings()
+    model = registry.get()
+    enriched = 0
+    for mood in model.encoder.classes_:
+        mood = str(mood)
+        mood_index = similarity_indexes.get(mood)
+        pages = ef.iter_documents(
+            documents_to_enrich(
+                mood, None if mood_index is None else mood_index.build_id
+            ),
+            ["lyrics"],
+            chunk_size,
+        )
+        start = time.perf_counter()
+        for chunk in pages:
+            enriched += enrich_chunk(model, mood_index, chunk)
+            print(
+                f"Enriched {len(chunk)} songs of mood {mood} in "
+                f"{time.perf_counter() - start:.2f}s ({enriched} in total)"
+            )
+            start = time.perf_counter()
+    return enriched
+
+
+if __name__ == "__main__":
+    from model_registry import load_models
+
+    load_models()
+    similarity_indexes.load()
+    print(f"Enriched songs: {enrich_stored_documents()}")
@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import Counter
+
+import numpy as np
+
+import executors
+from configuration.config import (INFERENCE_MAX_BATCH_SIZE,
+                                  INFERENCE_MAX_CONCURRENT_BATCHES,
+                                  INFERENCE_MAX_WAIT_MS,
+                                  MODEL_SHADOW_WORKERS)
+
+
+class InferenceBatcher:
+    """Request coalescing queue in front of the mood models. Concurrent
+    predictions are collected for at most max_wait_ms (or until
+    max_batch_size sequences are waiting) and run as one batched forward
+    pass per model version. Every caller gets its own row of the result.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+        max_wait_ms: float = INFERENCE_MAX_WAIT_MS,
+        max_concurrent_batches: int = INFERENCE_MAX_CONCURRENT_BATCHES,
+        executor: executors.BoundedExecutor = executors.io_executor,
+    ):
+        self.max_batch_size = max_batch_size
+        # executor running the forward passes
+        self.executor = executor
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.batch_sizes = Counter()
+        self.batches = 0
+        self.requests = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.total_inference = 0.0
+        self._queue = None
+        self._worker = None
+        self._batch_slots = None
+        # running batches, referenced until done so they are not collected
+        self._batch_tasks = set()
+
+    def start(self) -> None:
+        """Start collecting requests on the running event loop."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.create_task(self._collect())
+
+    async def stop(self) -> None:
+        """Stop collecting requests. Running batches are cancelled and every
+        request that has not been answered fails, so no caller waits
+        forever."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._batch_tasks):
+            task.cancel()
+        await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        if self._queue is not None:
+            queued = []
+            while not self._queue.empty():
+                queued.append(self._queue.get_nowait())
+            self._fail(queued, RuntimeError("Inference batcher stopped"))
+
+    async def predict(self, model, sequence: np.ndarray) -> np.ndarray:
+        """Queue one padded sequence and await its mood probabilities.
+
+        :param model: handle of the model version to use
+        :type model: model_registry.ModelHandle
+        :param sequence: padded token sequence (180,)
+        :type sequence: np.ndarray
+        :return: softmax probabilities of the sequence
+        :rtype: np.ndarray
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((model, sequence, time.perf_counter(), future))
+        return await future
+
+    def busy(self) -> bool:
+        """Return whether requests are waiting or all batch slots are taken.
+
+        :return: True if a new request would wait for earlier ones
+        :rtype: bool
+        """
+        return self._queue is not None and (
+            not self._queue.empty()
+            or len(self._batch_tasks) >= self.max_concurrent_batches
+        )
+
+    @staticmethod
+    def _fail(requests: list, error: BaseException) -> None:
+        # answer every request that is still waiting with an error
+        for _, _, _, future in requests:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _collect(self) -> None:
+        # collect requests until the batch is full or the wait time is over
+        while True:
+            batch = []
+            handed = set()
+            try:
+                batch.append(await self._queue.get())
+                deadline = time.perf_counter() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(self._queue.get(), timeout)
+                        )
+                    except asyncio.TimeoutError:
+                        break
+
+                # one forward pass per model version in the batch
+                by_model = {}
+                for request in batch:
+                    by_model.setdefault(id(request[0]), []).append(request)
+                for requests in by_model.values():
+                    await self._batch_slots.acquire()
+                    task = asyncio.create_task(self._run(requests))
+                    self._batch_tasks.add(task)
+                    task.add_done_callback(self._batch_tasks.discard)
+                    handed.update(map(id, requests))
+            except BaseException:
+                # fail the requests not handed to a batch yet, the batches
+                # answer their own requests
+                waiting = [
+                    request for request in batch if id(request) not in handed
+                ]
+                self._fail(waiting, RuntimeError("Inference batcher stopped"))
+                raise
+
+    async def _run(self, requests: list) -> None:
+        try:
+            model = requests[0][0]
+            started = time.perf_counter()
+            for _, _, queued, _ in requests:
+                wait = started - queued
+                self.total_queue_wait += wait
+                self.max_queue_wait = max(self.max_queue_wait, wait)
+            try:
+                predictions = await self.executor.run(
+                    model.predict,
+                    np.stack([sequence for _, sequence, _, _ in requests]),
+                )
+            except Exception as error:
+                self._fail(requests, error)
+                return
+            except BaseException:
+                self._fail(
+                    requests, RuntimeError("Inference batch cancelled")
+                )
+                raise
+
+            self.total_inference += time.perf_counter() - started
+            self.batches += 1
+            self.requests += len(requests)
+            self.batch_sizes[len(requests)] += 1
+            for prediction, (_, _, _, future) in zip(predictions, requests):
+                if not future.done():
+                    future.set_result(prediction)
+        finally:
+            self._batch_slots.release()
+
+    def stats(self) -> dict:
+        """Return batch size distribution, queue wait and inference time.
+
+        :return: batcher statistics
+        :rtype: dict
+        """
+        requests = max(self.requests, 1)
+        batches = max(self.batches, 1)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": round(self.requests / batches, 3),
+            "batch_size_distribution": dict(sorted(self.batch_sizes.items())),
+            "mean_queue_wait_ms": round(
+                1000 * self.total_queue_wait / requests, 3
+            ),
+            "max_queue_wait_ms": round(1000 * self.max_queue_wait, 3),
+            "mean_batch_inference_ms": round(
+                1000 * self.total_inference / batches, 3
+            ),
+        }
+
+
+inference_batcher = InferenceBatcher()
+# batches of the shadow model version, run in their own executor so they
+# never take a batch slot or a worker of served requests
+shadow_batcher = InferenceBatcher(
+    max_concurrent_batches=MODEL_SHADOW_WORKERS,
+    executor=executors.shadow_executor,
+)
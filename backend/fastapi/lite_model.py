@@ -0,0 +1,91 @@
+import os
+import threading
+
+import numpy as np
+
+try:
+    # standalone interpreter without the TensorFlow runtime
+    # (requirements-tflite.txt)
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    try:
+        # predecessor of ai_edge_litert, its last release can not load
+        # int8 exports of current converters
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        Interpreter = None
+
+# TFLite files written by export_model.py into a model version directory
+TFLITE_FILES = {
+    "tflite": "model.tflite",
+    "tflite_float16": "model_float16.tflite",
+    "tflite_int8": "model_int8.tflite",
+}
+
+
+def get_interpreter_class():
+    """Return the TFLite interpreter class, preferring the lean
+    ai_edge_litert or tflite_runtime package over the full TensorFlow
+    installation.
+
+    :raises ImportError: no TFLite interpreter package is installed
+    :return: interpreter class
+    """
+    if Interpreter is not None:
+        return Interpreter
+    try:
+        import tensorflow as tf
+    except ImportError:
+        raise ImportError(
+            "The TFLite runtimes need the ai-edge-litert package "
+            "(requirements-tflite.txt) or TensorFlow"
+        )
+
+    return tf.lite.Interpreter
+
+
+class LiteModel:
+    """Mood CNN exported to TFLite. The interpreter is not thread safe, so
+    invocations are serialized; the tensors are only reallocated when the
+    batch size changes.
+    """
+
+    def __init__(self, path: str, num_threads: int = None):
+        """Load the TFLite file.
+
+        :param path: path of the .tflite file
+        :type path: str
+        :param num_threads: threads used by the interpreter, defaults to the
+            number of cpus
+        :type num_threads: int, optional
+        """
+        self.path = path
+        self.file_bytes = os.path.getsize(path)
+        self.interpreter = get_interpreter_class()(
+            model_path=path, num_threads=num_threads or os.cpu_count()
+        )
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, sequences: np.ndarray) -> np.ndarray:
+        """Predict the mood probabilities for padded token sequences.
+
+        :param sequences: padded token sequences (batch x 180)
+        :type sequences: np.ndarray
+        :return: softmax probabilities (batch x number of moods)
+        :rtype: np.ndarray
+        """
+        sequences = np.asarray(sequences, dtype=self.input["dtype"])
+        with self._lock:
+            if self._batch_size != len(sequences):
+                self.interpreter.resize_tensor_input(
+                    self.input["index"], sequences.shape
+                )
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(sequences)
+            self.interpreter.set_tensor(self.input["index"], sequences)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output["index"]).copy()
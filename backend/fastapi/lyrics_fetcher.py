@@ -0,0 +1,213 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import lyricsgenius as genius  # https://github.com/johnwmillr/LyricsGenius
+
+import executors
+from configuration.config import (GENIUS_BASE_URL, GENIUS_FETCH_TIMEOUT,
+                                  GENIUS_MAX_CONCURRENT,
+                                  GENIUS_NEGATIVE_CACHE_SIZE,
+                                  GENIUS_NEGATIVE_TTL, GENIUS_RETRIES,
+                                  GENIUS_TIMEOUT, GENIUS_TOKEN_PATH)
+from result_cache import normalize
+
+
+def read_api_token(path: str = GENIUS_TOKEN_PATH) -> str:
+    """Function reads the Genius api token.
+
+    :param path: file containing the token, defaults to GENIUS_TOKEN_PATH
+    :type path: str, optional
+    :return: Genius api token
+    :rtype: str
+    """
+    with open(path, "r") as file:
+        return file.read().strip()
+
+
+class Coalescer:
+    """Runs a coroutine function only once for concurrent calls with the same
+    key. Callers arriving while the call is in flight await the same
+    result (or exception). Cancelling one caller does not cancel the call.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def run(self, key, function, *args):
+        """Run function(*args) or join the call in flight for key.
+
+        :param key: hashable key of the call
+        :param function: coroutine function
+        :return: result of the call
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function(*args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        """Return the number of calls in flight.
+
+        :return: number of calls in flight
+        :rtype: int
+        """
+        return len(self._in_flight)
+
+
+class LyricsFetcher:
+    """Fetch layer in front of the Genius API. The token is read and the
+    client created once, concurrent fetches of the same song are coalesced
+    into one upstream call, songs which were not found are remembered for a
+    while, and upstream calls are limited in number and time.
+    """
+
+    def __init__(
+        self,
+        token_path: str = GENIUS_TOKEN_PATH,
+        base_url: str = GENIUS_BASE_URL,
+        max_concurrent: int = GENIUS_MAX_CONCURRENT,
+        timeout: float = GENIUS_FETCH_TIMEOUT,
+        negative_ttl: float = GENIUS_NEGATIVE_TTL,
+        negative_cache_size: int = GENIUS_NEGATIVE_CACHE_SIZE,
+    ):
+        self.token_path = token_path
+        self.base_url = base_url
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.negative_cache_size = negative_cache_size
+        self.requests = 0
+        self.upstream_calls = 0
+        self.found = 0
+        self.not_found = 0
+        self.negative_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_upstream = 0.0
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._coalescer = Coalescer()
+        # normalized key -> time.monotonic() when the entry expires
+        self._negative = OrderedDict()
+        self._slots = None
+
+    def client(self) -> genius.Genius:
+        """Return the shared Genius client, created on first use.
+
+        :return: Genius client
+        :rtype: genius.Genius
+        """
+        with self._client_lock:
+            if self._client is None:
+                client = genius.Genius(
+                    read_api_token(self.token_path),
+                    timeout=GENIUS_TIMEOUT,
+                    retries=GENIUS_RETRIES,
+                )
+                if self.base_url:
+                    # e.g. a local fake Genius server
+                    root = self.base_url.rstrip("/") + "/"
+                    client.API_ROOT = root
+                    client.PUBLIC_API_ROOT = root + "api/"
+                    client.WEB_ROOT = root
+                self._client = client
+            return self._client
+
+    async def fetch(self, song: str, artist: str):
+        """Search a song on Genius and scrape its lyrics.
+
+        :param song: song name
+        :type song: str
+        :param artist: artist name
+        :type artist: str
+        :raises asyncio.TimeoutError: Genius did not answer in time
+        :return: found song with title, artist and lyrics or None
+        :rtype: lyricsgenius.types.Song
+        """
+        self.requests += 1
+        key = (normalize(song), normalize(artist))
+        expires = self._negative.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.negative_hits += 1
+                return None
+            del self._negative[key]
+        return await self._coalescer.run(key, self._fetch, key, song, artist)
+
+    async def _fetch(self, key: tuple, song: str, artist: str):
+        # created lazily to bind the semaphore to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+
+        await self._slots.acquire()
+        self.upstream_calls += 1
+        started = time.perf_counter()
+        try:
+            scrape = asyncio.ensure_future(
+                executors.run_io(self.client().search_song, song, artist)
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        # a timed out scrape keeps running in its thread, so the slot is only
+        # released when it has finished
+        scrape.add_done_callback(lambda _: self._slots.release())
+        try:
+            lyrics = await asyncio.wait_for(
+                asyncio.shield(scrape), self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            # the result of the abandoned scrape is not retrieved
+            scrape.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.total_upstream += time.perf_counter() - started
+
+        if lyrics is None:
+            self.not_found += 1
+            self._negative[key] = time.monotonic() + self.negative_ttl
+            while len(self._negative) > self.negative_cache_size:
+                self._negative.popitem(last=False)
+        else:
+            self.found += 1
+        return lyrics
+
+    def stats(self) -> dict:
+        """Return counters of requests, upstream calls and their outcome.
+
+        :return: fetcher statistics
+        :rtype: dict
+        """
+        upstream_calls = max(self.upstream_calls, 1)
+        return {
+            "requests": self.requests,
+            "upstream_calls": self.upstream_calls,
+            "in_flight": self._coalescer.in_flight(),
+            "coalesced": self._coalescer.coalesced,
+            "negative_hits": self.negative_hits,
+            "negative_cache_size": len(self._negative),
+            "found": self.found,
+            "not_found": self.not_found,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "max_concurrent": self.max_concurrent,
+            "mean_upstream_ms": round(
+                1000 * self.total_upstream / upstream_calls, 3
+            ),
+        }
+
+
+lyrics_fetcher = LyricsFetcher()
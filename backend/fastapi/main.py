@@ -1,29 +1,263 @@
-import pickle
+import asyncio
+import json
+import time
+from typing import Optional
 
-import lyricsgenius as genius  # https://github.com/johnwmillr/LyricsGenius
 import numpy as np
-import tensorflow as tf
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from sklearn import preprocessing
-from sklearn.decomposition import TruncatedSVD
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from fastapi import HTTPException
+from fastapi import HTTPException, Request, Response
 
 import elasticsearch_functions as ef
+import executors
+from index_enrichment import enrich_stored_documents, enrichment_of
+from inference_batcher import inference_batcher
+from lyrics_fetcher import Coalescer, lyrics_fetcher
 import utils as utils
+from configuration.config import (BATCH_CHUNK_SIZE, ENRICH_ON_STARTUP,
+                                  SIMILARITY_ENGINE)
 from configuration.config import app as app
-from utils import processing_pipeline
-
-CNN_MODEL = "./cnn/cnn_model_v3"
-TOKENIZER = "./cnn/cnn_model_v3/tokenizer.pickle"
-LABELENCODER = "./cnn/cnn_model_v3/label_encoder.npy"
+from model_registry import MissingExportError, registry
+from model_router import model_router
+from readiness import index_status, prepare, readiness
+from result_cache import cache_key, normalize, result_cache
+from similarity_index import (get_similar_of_documents, similarity_indexes,
+                              song_key)
 
 
 class Body(BaseModel):
     song_name: str
     artist_name: str
+    # model version classifying a new song, routed if not given
+    model_version: Optional[str] = None
+
+
+class BatchSong(BaseModel):
+    song_name: str
+    artist_name: str
+    # lyrics are scraped from Genius if not given
+    lyrics: Optional[str] = None
+
+
+class BatchBody(BaseModel):
+    songs: list[BatchSong]
+    # write classified songs back to Elasticsearch
+    store: bool = True
+    # model version classifying the songs, routed if not given
+    model_version: Optional[str] = None
+
+
+class RoutingBody(BaseModel):
+    # weight per model version, empty to serve the active version
+    split: dict[str, float] = {}
+    # model version classifying songs in the background for comparison
+    shadow_version: Optional[str] = None
+    # share of the songs classified by the shadow version
+    shadow_rate: float = 1.0
+
+
+# references to running background tasks
+background_tasks = set()
+# songs which are being scraped, classified and stored
+new_songs = Coalescer()
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    """Create the shared Elasticsearch clients once for the process lifetime
+    and prepare the backend in the background: wait for the Elasticsearch
+    index while the mood classification models, the spaCy pipeline and the
+    similarity indexes are loaded and warmed up (see /readyz). Afterwards
+    stored songs without vectors and mood probabilities are enriched if
+    ENRICH_ON_STARTUP is set, otherwise run python index_enrichment.py."""
+    ef.get_client()
+    ef.get_async_client()
+    task = asyncio.create_task(prepare_in_background())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def prepare_in_background() -> None:
+    """Prepare the backend and enrich the stored songs once it is ready."""
+    if await prepare() and ENRICH_ON_STARTUP:
+        await enrich_in_background()
+
+
+async def enrich_in_background() -> None:
+    """Enrich stored songs in the thread pool, errors are only logged."""
+    try:
+        enriched = await executors.run_io(enrich_stored_documents)
+        print(f"Enriched songs: {enriched}")
+    except Exception as error:
+        print(f"Enrichment of stored songs failed: {error}")
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    """Persist songs which have been added to the similarity indexes and
+    close the shared Elasticsearch clients."""
+    similarity_indexes.save()
+    await model_router.stop()
+    await inference_batcher.stop()
+    await ef.close_clients()
+    executors.shutdown()
+
+
+@app.exception_handler(MissingExportError)
+async def missing_export(request: Request, error: MissingExportError):
+    """Function answers with 503 if a model version can not be served
+    because it has not been exported to the configured TFLite runtime.
+
+    :param request: request which needed the model version
+    :type request: Request
+    :param error: error naming the missing export
+    :type error: MissingExportError
+    :return: error response
+    :rtype: JSONResponse
+    """
+    return JSONResponse(status_code=503, content={"detail": str(error)})
+
+
+@app.get("/healthz")
+def get_health() -> dict:
+    """Function answers as long as the process is serving requests, also
+    while the index and the models are still being loaded.
+
+    :return: status and uptime
+    :rtype: dict
+    """
+    return {
+        "status": "ok",
+        "uptime_seconds": readiness.report()["uptime_seconds"],
+    }
+
+
+@app.get("/readyz")
+async def get_readiness(response: Response) -> dict:
+    """Function returns whether the backend should receive traffic: the
+    Elasticsearch index is loaded and the models are loaded and warmed up.
+    The status code is 503 until everything is ready.
+
+    :param response: response whose status code is set
+    :type response: Response
+    :return: state of the components and document count of the index
+    :rtype: dict
+    """
+    index = await index_status()
+    report = readiness.report()
+    report["index"] = index
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
+
+@app.get("/inference")
+def get_inference() -> dict:
+    """Function returns batch size distribution and queue wait of the
+    micro-batching mood inference.
+
+    :return: inference batcher statistics
+    :rtype: dict
+    """
+    return inference_batcher.stats()
+
+
+@app.get("/executors")
+def get_executors() -> dict:
+    """Function returns queue depth, saturation and timing of the thread
+    and process pools running the blocking steps of /search.
+
+    :return: executor statistics
+    :rtype: dict
+    """
+    return executors.stats()
+
+
+@app.get("/cache")
+def get_cache() -> dict:
+    """Function returns size and hit, miss, eviction and invalidation
+    counters of the /search result cache.
+
+    :return: statistics of the in-process and the shared cache tier
+    :rtype: dict
+    """
+    return result_cache.stats()
+
+
+@app.get("/genius")
+def get_genius() -> dict:
+    """Function returns request, upstream call, coalescing and negative
+    cache counters of the Genius lyrics fetching.
+
+    :return: lyrics fetcher statistics
+    :rtype: dict
+    """
+    return lyrics_fetcher.stats()
+
+
+@app.get("/models")
+def get_models() -> dict:
+    """Function returns the active model version as well as load time and
+    memory footprint of every loaded model version.
+
+    :return: model registry statistics
+    :rtype: dict
+    """
+    return registry.stats()
+
+
+@app.post("/models/{version}/activate")
+def activate_model(version: str, reload: bool = False) -> dict:
+    """Function hot-swaps the model version used for classification.
+
+    :param version: model version to activate, e.g. cnn_model_v2
+    :type version: str
+    :param reload: load the artifacts from disk again, defaults to False
+    :type reload: bool, optional
+    :raises HTTPException: Error model version not found
+    :return: model registry statistics
+    :rtype: dict
+    """
+    try:
+        registry.activate(version, reload=reload)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    return registry.stats()
+
+
+@app.get("/routing")
+def get_routing() -> dict:
+    """Function returns the traffic split, the shadow version and latency,
+    throughput and agreement statistics per model version.
+
+    :return: model router statistics
+    :rtype: dict
+    """
+    return model_router.stats()
+
+
+@app.post("/routing")
+def configure_routing(body: RoutingBody) -> dict:
+    """Function splits the traffic between model versions by weight and
+    sets the model version classifying songs in the background. The
+    versions are loaded before traffic is routed to them.
+
+    :param body: split, shadow version and shadow rate
+    :type body: RoutingBody
+    :raises HTTPException: Error model version not found
+    :raises HTTPException: Error invalid weight or shadow rate
+    :return: model router statistics
+    :rtype: dict
+    """
+    try:
+        model_router.configure(
+            body.split, body.shadow_version, body.shadow_rate
+        )
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return model_router.stats()
 
 
 @app.post("/search")
@@ -39,237 +273,473 @@ async def search(body: Body) -> dict:
     :type body: Body
     :raises HTTPException: Error when scraping the lyrics
     :raises HTTPException: Error lyrics for song not found
+    :raises HTTPException: Error model version not found
+    :raises HTTPException: Error model version classifies into other moods
     :return: dictionary of top three most similar songs
     :rtype: dict
     """
 
-    # read in the api key after it has been encrypted by you
-    with open("secrets/genius_api_secret", "r") as file:
-        api_token = file.read()
+    # model version classifying the song if it is new, the same song is
+    # always routed to the same version of a split
+    try:
+        version = model_router.route(
+            body.model_version, routing_key(body.song_name, body.artist_name)
+        )
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    # return the cached result of the song for this model version
+    started = time.monotonic()
+    key = cache_key(body.song_name, body.artist_name, version)
+    cached = await result_cache.get(key)
+    if cached is not None:
+        return cached
 
     song = body.song_name.lower()
     artist = body.artist_name.lower()
 
-    song_lyrics = ef.get_stored_lyrics_of_song(song, artist)
-
-    if song_lyrics is None:
-        api = genius.Genius(api_token)
-        try:
-            lyrics = api.search_song(song, artist)
-        except BaseException:
-            raise HTTPException(
-                status_code=500, detail="Error during scraping of the lyrics"
-            )
+    # get the whole stored document with one query
+    stored_song = await ef.async_get_stored_document(song, artist)
 
+    if stored_song is None:
+        # concurrent searches for the same new song scrape, classify and
+        # store it only once
+        song_dictionary = await new_songs.run(
+            (normalize(song), normalize(artist)), add_new_song, song, artist,
+            version
+        )
         # return 404 if song not found
-        if lyrics is None:
-            print(f"Couldn't find a corresponding song to {song} from {artist}")
+        if song_dictionary is None:
             return {"error": 404}
-
-        # Classify the mood
-        # set the artist and song name to the found one,
-        # since genius package can search on only a substring and this would
-        # lead to errors in the end
-        song = lyrics.title.lower()
-        artist = lyrics.artist.lower()
-        lyrics.lyrics = utils.chorus_normalization(lyrics.lyrics.lower())
-        song_dictionary = {
-            "Song": song,
-            "Artist": artist,
-            "Lyrics": lyrics.lyrics,
-            "Mood": "none",
-        }
-        # Mood is set in classify function (call by reference is used)
-        mood = classify(song_dictionary)
-
-        # When preprocessed the else block does not need a preprocessing
-        ef.add_es_document(song, artist, lyrics.lyrics, mood)
+        song_dictionary = dict(song_dictionary)
     else:
-        mood = ef.get_stored_mood_of_song(song, artist)
-        song,artist = ef.get_stored_song(song,artist)
         song_dictionary = {
-            "Song": song,
-            "Artist": artist,
-            "Lyrics": song_lyrics.lower(),
-            "Mood": mood,
+            "Song": stored_song["song_name"],
+            "Artist": stored_song["artist_name"],
+            "Lyrics": stored_song["lyrics"].lower(),
+            "Mood": stored_song["mood"],
         }
+        if body.model_version:
+            # the stored mood may be the label of the dataset or the mood
+            # of another version, the result is cached for the requested
+            # one. The stored document is not changed.
+            if (
+                stored_song.get("model_version") == body.model_version
+                and stored_song.get("model_mood") is not None
+            ):
+                song_dictionary["Mood"] = stored_song["model_mood"]
+            else:
+                classification = await classify_song(
+                    song_dictionary["Lyrics"], version
+                )
+                song_dictionary["Mood"] = classification["mood"]
+        # reuse the stored vector if it belongs to the loaded index
+        mood_index = similarity_indexes.get(song_dictionary["Mood"])
+        if (
+            mood_index is not None
+            and stored_song.get("lyric_vector") is not None
+            and stored_song.get("vector_index") == mood_index.build_id
+        ):
+            song_dictionary["Vectorized_lyric"] = np.asarray(
+                stored_song["lyric_vector"], dtype=np.float32
+            )
     # search similar songs
     mood = song_dictionary["Mood"]
     song_dictionary.pop("Mood", None)
 
     # get top n similar songs
-    similar_songs = get_similar(song_to_compare=song_dictionary, mood=mood)
+    similar_songs = await get_similar(
+        song_to_compare=song_dictionary, mood=mood
+    )
     # pop the lyrics to reduce size of return value
     song_dictionary.pop("Lyrics", None)
     song_dictionary.pop("Vectorized_lyric", None)
     # combine all the data for the return
     similar_songs.update(song_dictionary)
+    await result_cache.set(key, mood, similar_songs, started)
     return similar_songs
 
 
-def sklearn_cosine(x: np.array, y: np.array) -> int:
-    """Function that takes in two arguments, x and y,
-    and returns the cosine similarity between them as calculated by
-    the cosine_similarity function from the scikit-learn library.
+async def add_new_song(song: str, artist: str, version: str = None) -> dict:
+    """Function scrapes the lyrics of a song which is not stored yet,
+    classifies its mood, stores it in Elasticsearch and adds it to the
+    similarity index of its mood.
+
+    :param song: song name
+    :type song: str
+    :param artist: artist name
+    :type artist: str
+    :param version: model version classifying the song, defaults to the
+        routed version
+    :type version: str, optional
+    :raises HTTPException: Error or timeout when scraping the lyrics
+    :return: song dictionary with lyrics, mood and vectorized lyrics or None
+        if the song was not found
+    :rtype: dict
+    """
+    try:
+        lyrics = await lyrics_fetcher.fetch(song, artist)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504, detail="Timeout during scraping of the lyrics"
+        )
+    except Exception:
+        raise HTTPException(
+            status_code=500, detail="Error during scraping of the lyrics"
+        )
+
+    # return 404 if song not found
+    if lyrics is None:
+        print(f"Couldn't find a corresponding song to {song} from {artist}")
+        return None
+
+    # Classify the mood
+    # set the artist and song name to the found one,
+    # since genius package can search on only a substring and this would
+    # lead to errors in the end
+    song = lyrics.title.lower()
+    artist = lyrics.artist.lower()
+    # the fetched song is shared by coalesced requests, so it is not modified
+    song_lyrics = utils.chorus_normalization(lyrics.lyrics.lower())
+    song_dictionary = {
+        "Song": song,
+        "Artist": artist,
+        "Lyrics": song_lyrics,
+        "Mood": "none",
+    }
+    classification = await classify_song(song_lyrics, version)
+    song_dictionary["Mood"] = classification["mood"]
+    (stored,) = await stored_classifications([song_lyrics], [classification])
+    mood = stored["mood"]
+    # vectorize once, the vector is stored and reused for similar songs
+    lyric_vector, vector_index = await executors.run_io(
+        similarity_indexes.vectorize, mood, song_lyrics
+    )
+    if song_dictionary["Mood"] == mood:
+        song_dictionary["Vectorized_lyric"] = lyric_vector
+
+    # store vectors and mood probabilities, so a repeated search does
+    # not need to recompute them. The coalesced call only finishes once the
+    # song is searchable, so a later search finds it stored.
+    await ef.async_add_es_document(
+        song, artist, song_lyrics, mood,
+        enrichment_of(stored, lyric_vector, vector_index),
+        refresh="wait_for",
+    )
+    # add the song to the similarity index of its mood without refitting
+    await executors.run_io(
+        similarity_indexes.add_song, mood, song, artist, song_lyrics,
+        lyric_vector
+    )
+    # similar songs of the mood have changed
+    await result_cache.invalidate_mood(mood)
+    return song_dictionary
+
+
+@app.post("/classify/batch")
+async def classify_batch(body: BatchBody) -> StreamingResponse:
+    """Function classifies many songs, e.g. a whole playlist or catalog.
+    Songs which are already stored return their stored mood, songs without
+    lyrics are scraped from Genius. The remaining songs are preprocessed and
+    classified in chunks of BATCH_CHUNK_SIZE and written back to
+    Elasticsearch with one bulk request per chunk.
+    The response is streamed as JSON lines: one line per song
+    (song name, artist name, mood and source or error) and a progress line
+    after every chunk.
+
+    :param body: songs to classify
+    :type body: BatchBody
+    :raises HTTPException: Error model version not found
+    :raises HTTPException: Error model version classifies into other moods
+    :return: streamed JSON lines with results and progress
+    :rtype: StreamingResponse
+    """
+    if body.model_version:
+        try:
+            model_router.check_version(body.model_version)
+        except FileNotFoundError as error:
+            raise HTTPException(status_code=404, detail=str(error))
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+    return StreamingResponse(
+        stream_batch_classification(body), media_type="application/x-ndjson"
+    )
+
 
-    :param x: first vector
-    :type x: np.array
-    :param y: second vector
-    :type y: np.array
-    :return: scalar similarity value
-    :rtype: int
+async def stream_batch_classification(body: BatchBody):
+    """Function classifies the songs of a batch request chunk by chunk and
+    yields the results as JSON lines.
+
+    :param body: songs to classify
+    :type body: BatchBody
+    :return: JSON lines with results and progress
+    :rtype: AsyncIterator[str]
     """
-    return cosine_similarity([x], [y])
-
-
-def get_top_n_similar(
-    song_to_compare: dict, songs_to_compare_to: dict, top_n_simlar: int = 3
-) -> list:
-    """Function which takes in three parameters: song_to_compare,
-    songs_to_compare_to, and top_n_similar, and returns a list of top n
-    most similar songs based on the cosine similarity score between their
-    vectorized lyrics. The function first calculates the cosine similarity
-    score between the vectorized lyric of song_to_compare and each of
-    the songs in songs_to_compare_to using the sklearn_cosine function.
-    It then filters out any scores equal to 1 (which would mean that the
-    same song was found in songs_to_compare_to). The indexes of the top n
-    scores are then found and the corresponding song information
-    (song name and artist name) is returned in the form of a list.
-
-    :param song_to_compare: lyric to find similar songs for
-    :type song_to_compare: dict
-    :param songs_to_compare_to: lyrics of songs to compare to song_to_compare
-    :type songs_to_compare_to: dict
-    :param top_n_simlar: number of most similar songs to return
-    :type top_n_simlar: int
-    :return: list of top n most similar songs containing song name
-        and artist name
-    :rtype: list
+    total = len(body.songs)
+    # keys of the songs stored by this request, written songs may not be
+    # searchable before the next refresh of the index
+    stored_keys = set()
+    for start in range(0, total, BATCH_CHUNK_SIZE):
+        chunk = body.songs[start : start + BATCH_CHUNK_SIZE]
+        for result in await classify_chunk(
+            chunk, body.store, body.model_version, stored_keys
+        ):
+            yield json.dumps(result) + "\n"
+        done = start + len(chunk)
+        yield json.dumps({"progress": {"done": done, "total": total}}) + "\n"
+
+
+async def resolve_batch_song(item: BatchSong) -> dict:
+    """Function looks up a song of a batch request in Elasticsearch and
+    scrapes its lyrics if neither stored nor given.
+
+    :param item: song of the batch request
+    :type item: BatchSong
+    :return: song dict with lyrics to classify, stored mood or error
+    :rtype: dict
     """
-    cosine_similarity_scores = []
-
-    # calculate similarity score for each passed vectorized lyrics with
-    # gold_song
-    for key, value in songs_to_compare_to.items():
-        # calculate similarity score
-        similarity_score = sklearn_cosine(
-            song_to_compare["Vectorized_lyric"], value["Vectorized_lyric"]
-        )[0][0]
-        # filter similarity score = 1
-        # this would mean, that somehow, the same song was found in the songs
-        # to compare
-        if similarity_score >= 0.999:
-            similarity_score = 0
-        # Add score to list of all scores
-        cosine_similarity_scores.append(similarity_score)
-        # round similarity to decent percentage
-        value["Similarity"] = round(similarity_score * 100, 2)
-    cosine_similarity_scores = np.array(cosine_similarity_scores)
-
-    # get indexes of top n values
-    indexes_top_n = np.argsort(cosine_similarity_scores)[::-1][:top_n_simlar]
-    # get top n dictionary keys
-    top_n_keys = np.array(list(songs_to_compare_to))[indexes_top_n]
-    # get top n dict entries
-    top_n_dict = {key: songs_to_compare_to[key] for key in top_n_keys}
-
-    # remove lyrics from dict
-    top_n_songs_no_lyrics = {
-        key: {
-            "Song": value["Song"],
-            "Artist": value["Artist"],
-            "Similarity": value["Similarity"],
+    song = item.song_name.lower()
+    artist = item.artist_name.lower()
+    if item.lyrics is not None:
+        return {
+            "Song": song,
+            "Artist": artist,
+            "Lyrics": utils.chorus_normalization(item.lyrics.lower()),
+            "Source": "request",
         }
-        for key, value in top_n_dict.items()
-    }
 
-    return top_n_songs_no_lyrics
+    stored_song = await ef.async_get_stored_document(
+        song, artist, ["song_name", "artist_name", "mood"]
+    )
+    if stored_song is not None:
+        return {
+            "Song": stored_song["song_name"],
+            "Artist": stored_song["artist_name"],
+            "Mood": stored_song["mood"],
+            "Source": "elasticsearch",
+        }
 
+    try:
+        lyrics = await lyrics_fetcher.fetch(song, artist)
+    except asyncio.TimeoutError:
+        return {"Song": song, "Artist": artist, "error": 504}
+    except Exception:
+        return {"Song": song, "Artist": artist, "error": 500}
+    if lyrics is None:
+        return {"Song": song, "Artist": artist, "error": 404}
+    return {
+        "Song": lyrics.title.lower(),
+        "Artist": lyrics.artist.lower(),
+        "Lyrics": utils.chorus_normalization(lyrics.lyrics.lower()),
+        "Source": "genius",
+    }
 
-def get_tf_idf_vectorized_lyrics(
-    song_to_compare: dict, mood: str
-) -> tuple[dict, dict]:
-    """Function that returns the tf-idf vectors for given lyrics.
 
-    :param song_to_compare: dict with song name, artist name and lyrics
-        for song to compare with.
-    :type song_to_compare: dict
-    :param mood: mood of the song to compare with.
-    :type mood: str
+async def stored_song_keys(songs: list[dict]) -> set:
+    """Function looks up songs in Elasticsearch and returns the keys of the
+    songs which are stored with exactly the same song and artist name.
 
-    :return: dict for the song we want to compare each lyrics of certain
-        mood with. It contains information on the song name, artist name,
-        lyrics and vectorized lyric.
-    :rtype: dict
-    :return: dict with dicts that contain song name, artist name, lyrics
-        and vectorized lyrics for each song of given mood
-        (except of the song to compare with).
-    :rtype: dict
+    :param songs: song dicts with song name and artist name
+    :type songs: list[dict]
+    :return: keys of the stored songs
+    :rtype: set
     """
-
-    # get documents with songs that have the same mood
-    song_same_mood_dict = ef.get_all_documents_of_mood(mood)
-    # check if song to compare with is within the song_same_mood_dict. If not
-    # add it for tf-idf vectorization
-    song_to_compare_key = (
-        f'{song_to_compare["Song"]}_{song_to_compare["Artist"]}'
-    )
-    if song_to_compare_key not in song_same_mood_dict.keys():
-        song_same_mood_dict[song_to_compare_key] = song_to_compare
-    # get list of all lyrics of songs with same mood
-    lyrics_list = [
-        document["Lyrics"] for document in song_same_mood_dict.values()
-    ]
-    # current ones
-    tfidf_vectorizer = TfidfVectorizer(
-        analyzer="word", lowercase=True, stop_words="english", min_df=5
+    stored_songs = await asyncio.gather(
+        *[
+            ef.async_get_stored_document(
+                song["Song"], song["Artist"], ["song_name", "artist_name"]
+            )
+            for song in songs
+        ]
     )
-    print(f"tfidf_vectorizer: {tfidf_vectorizer}")
-    # generate tdf-idf scores
-    lyrics_tf_idf = tfidf_vectorizer.fit_transform(lyrics_list)
+    return {
+        song_key(stored_song["song_name"], stored_song["artist_name"])
+        for stored_song in stored_songs
+        if stored_song is not None
+    }
 
-    # reduce the dimensionality of the tf-idf vectors
-    SVD = TruncatedSVD(
-        n_components=300, random_state=42  # number of output dimensionalities
-    )
-    vectorized_lyrics = SVD.fit_transform(
-        lyrics_tf_idf
-    )
 
-    for key, vectorized_lyric in zip(
-        list(song_same_mood_dict.keys()), vectorized_lyrics
-    ):
-        song_same_mood_dict[key]["Vectorized_lyric"] = vectorized_lyric
+async def classify_chunk(
+    chunk: list[BatchSong], store: bool, version: str = None,
+    stored_keys: set = None
+) -> list[dict]:
+    """Function classifies one chunk of a batch request. Classified songs
+    are only stored if no song with the same song and artist name is stored
+    yet, songs whose write failed return the status of the write as error.
+
+    :param chunk: songs to classify
+    :type chunk: list[BatchSong]
+    :param store: write classified songs back to Elasticsearch
+    :type store: bool
+    :param version: model version classifying the songs, defaults to the
+        routed version
+    :type version: str, optional
+    :param stored_keys: keys of the songs stored by previous chunks, the
+        keys of the songs stored by this chunk are added
+    :type stored_keys: set, optional
+    :return: song name, artist name, mood and source (or error) per song
+    :rtype: list[dict]
+    """
+    if stored_keys is None:
+        stored_keys = set()
+    # look up stored songs and scrape missing lyrics concurrently
+    songs = await asyncio.gather(
+        *[resolve_batch_song(item) for item in chunk]
+    )
 
-    song_to_compare = song_same_mood_dict.pop(song_to_compare_key)
+    to_classify = [song for song in songs if "Lyrics" in song]
+    if to_classify:
+        classifications = await classify_many(
+            [song["Lyrics"] for song in to_classify],
+            version,
+            [
+                routing_key(song["Song"], song["Artist"])
+                for song in to_classify
+            ],
+        )
+        for song, classification in zip(to_classify, classifications):
+            song["Mood"] = classification["mood"]
+
+        if store:
+            # songs with given lyrics are not looked up before, and a song
+            # may occur more than once in a request
+            to_store = {}
+            for song, classification in zip(to_classify, classifications):
+                key = song_key(song["Song"], song["Artist"])
+                if key not in stored_keys and key not in to_store:
+                    to_store[key] = (song, classification)
+            stored_keys.update(
+                await stored_song_keys(
+                    [song for song, _ in to_store.values()]
+                )
+            )
+            to_store = {
+                key: value
+                for key, value in to_store.items()
+                if key not in stored_keys
+            }
+            stored = await stored_classifications(
+                [song["Lyrics"] for song, _ in to_store.values()],
+                [classification for _, classification in to_store.values()],
+            )
+            to_store = {
+                key: (song, classification)
+                for (key, (song, _)), classification in zip(
+                    to_store.items(), stored
+                )
+            }
+
+            documents = []
+            vectors = []
+            for song, classification in to_store.values():
+                lyric_vector, vector_index = await executors.run_io(
+                    similarity_indexes.vectorize, classification["mood"],
+                    song["Lyrics"]
+                )
+                vectors.append(lyric_vector)
+                documents.append(
+                    ef.song_document(
+                        song["Song"], song["Artist"], song["Lyrics"],
+                        classification["mood"],
+                        enrichment_of(classification, lyric_vector,
+                                      vector_index)
+                    )
+                )
+            try:
+                errors = await executors.run_io(
+                    ef.add_es_documents, documents
+                )
+            except Exception:
+                errors = [{"index": {"status": 500}}] * len(documents)
+
+            for (key, (song, classification)), lyric_vector, error in zip(
+                to_store.items(), vectors, errors
+            ):
+                if error is not None:
+                    song["error"] = next(iter(error.values())).get(
+                        "status", 500
+                    )
+                    continue
+                stored_keys.add(key)
+                await executors.run_io(
+                    similarity_indexes.add_song, classification["mood"],
+                    song["Song"], song["Artist"], song["Lyrics"], lyric_vector
+                )
+            stored_moods = {
+                classification["mood"]
+                for song, classification in to_store.values()
+                if "error" not in song
+            }
+            for mood in stored_moods:
+                await result_cache.invalidate_mood(mood)
 
-    return song_to_compare, song_same_mood_dict
+    # pop the lyrics to reduce size of return value
+    for song in songs:
+        song.pop("Lyrics", None)
+    return songs
 
 
-def get_similar(song_to_compare: dict, mood: str) -> dict:
+async def get_similar(
+    song_to_compare: dict, mood: str, engine: str = SIMILARITY_ENGINE
+) -> dict:
     """Function gets top n similar song names and artist names
-    based on passed song_to_compare and mood. First it searches
-    all songs with the same mood and vectorizes their lyrics with TD-IDF.
+    based on passed song_to_compare and mood. If a precomputed similarity
+    index exists for the mood, only the lyrics of song_to_compare are
+    vectorized and looked up in it, either locally or with the stored lyric
+    vectors inside Elasticsearch. Otherwise it searches
+    all songs with the same mood and vectorizes their lyrics with TD-IDF
+    in a worker process.
     After that, the top n similar songs are filtered using TD-IDF.
 
     :param song_to_compare: Song to find similar songs for
     :type song_to_compare: dict
     :param mood: mood of song to find dimilar songs for
     :type mood: str
+    :param engine: local or elasticsearch, defaults to SIMILARITY_ENGINE
+    :type engine: str, optional
     :return: Dictionary containing top n similar songs
     :rtype: tuple[dict, dict]
     """
 
-    # Get all songs with same mood and vectorize all song lyrics with TD-IDF
-    song_to_compare, songs_to_compare_to = get_tf_idf_vectorized_lyrics(
-        song_to_compare=song_to_compare, mood=mood
-    )
+    mood_index = similarity_indexes.get(mood)
+    if mood_index is not None and engine == "elasticsearch":
+        # Rank the stored vectors of the mood inside Elasticsearch
+        lyric_vector = song_to_compare.get("Vectorized_lyric")
+        if lyric_vector is None:
+            lyric_vector = await executors.run_io(
+                mood_index.vectorize, song_to_compare["Lyrics"]
+            )
+        # vectors without magnitude can not be compared by Elasticsearch
+        if np.any(lyric_vector):
+            return {
+                "similar_songs": await ef.async_get_similar_songs(
+                    lyric_vector.tolist(), mood_index.build_id, mood
+                ),
+                "mood": mood,
+            }
+    if mood_index is not None:
+        # Look up the song in the precomputed index of the mood
+        return {
+            "similar_songs": await executors.run_io(
+                mood_index.get_similar, song_to_compare
+            ),
+            "mood": mood,
+        }
 
-    # Get top n most similar song names and artist names based on cosine
-    # similarity
-    top_n_songs_no_lyrics = get_top_n_similar(
-        song_to_compare=song_to_compare,
-        songs_to_compare_to=songs_to_compare_to)
+    # Get all songs with same mood
+    song_same_mood_dict = await executors.run_io(
+        ef.get_all_documents_of_mood, mood
+    )
+    if not song_same_mood_dict:
+        # no song of the mood is stored yet
+        return {"similar_songs": {}, "mood": mood}
+    # Vectorize all song lyrics with TD-IDF and get top n most similar song
+    # names and artist names based on cosine similarity
+    top_n_songs_no_lyrics = await executors.run_cpu(
+        get_similar_of_documents, song_to_compare, song_same_mood_dict
+    )
 
     # Add mood to dictionary
     similar_songs = {"similar_songs": top_n_songs_no_lyrics, "mood": mood}
@@ -277,7 +747,28 @@ def get_similar(song_to_compare: dict, mood: str) -> dict:
     return similar_songs
 
 
-def classify(song_dictionary: dict) -> dict:
+async def classify_song(lyrics: str, version: str = None) -> dict:
+    """Function classifies the lyrics of a song. Preprocessing runs in a
+    worker process, the inference is batched with concurrent requests.
+
+    :param lyrics: chorus normalized lyrics to classify
+    :type lyrics: str
+    :param version: model version classifying the song, defaults to the
+        routed version
+    :type version: str, optional
+    :return: mood, mood probabilities, preprocessed lyrics and model version
+    :rtype: dict
+    """
+    # preprocess the song
+    preprocessed_lyrics = (
+        await executors.run_cpu(utils.preprocess_lyrics_batch, [lyrics])
+    )[0]
+
+    # tokenize and predict the mood with the routed model version
+    return await model_router.classify(preprocessed_lyrics, version)
+
+
+async def classify(song_dictionary: dict) -> dict:
     """Function classifies a given song.
 
     :param song_dictionary: Song to classify
@@ -285,27 +776,76 @@ def classify(song_dictionary: dict) -> dict:
     :return: Song to classify with addtional mood classification
     :rtype: dict
     """
-    # create new dict to not modify the old one by reference
-    song_dictionary_transformable = song_dictionary.copy()
-
-    # preprocess the song
-    preprocessed_lyrics = processing_pipeline(song_dictionary_transformable)
-
-    # load the tokenizer
-    with open(TOKENIZER, "rb") as handle:
-        tokenizer = pickle.load(handle)
-    # tokenize
-    text = tokenizer.texts_to_sequences([preprocessed_lyrics["Lyrics"]])
-    text = pad_sequences(text, 180)
-    # predict the mood
-    model = tf.keras.models.load_model(CNN_MODEL)
-    prediction = model.predict(text)
-    predicted_mood = np.argmax(prediction, axis=1)
-
-    # load the label encoder
-    encoder = preprocessing.LabelEncoder()
-    encoder.classes_ = np.load(LABELENCODER, allow_pickle=True)
-    # transform the prediciton to an actual mood
-    mood = encoder.inverse_transform(predicted_mood)[0]
+    mood = (await classify_song(song_dictionary["Lyrics"]))["mood"]
     song_dictionary["Mood"] = mood
     return mood
+
+
+async def classify_many(
+    lyrics: list[str], version: str = None, keys: list[str] = None
+) -> list[dict]:
+    """Function classifies many lyrics in one batch. Preprocessing runs in
+    a worker process, tokenization and inference in the thread pool.
+
+    :param lyrics: chorus normalized lyrics to classify
+    :type lyrics: list[str]
+    :param version: model version classifying the lyrics, defaults to the
+        routed version of each song
+    :type version: str, optional
+    :param keys: routing key of each song, see routing_key, defaults to a
+        random choice per lyric
+    :type keys: list[str], optional
+    :return: classification of each lyric
+    :rtype: list[dict]
+    """
+    preprocessed_lyrics = await executors.run_cpu(
+        utils.preprocess_lyrics_batch, lyrics
+    )
+    return await model_router.classify_many(preprocessed_lyrics, version, keys)
+
+
+async def stored_classifications(
+    lyrics: list[str], classifications: list[dict]
+) -> list[dict]:
+    """Function returns the classifications to store with songs. Only moods
+    of the active version are stored, so the stored songs and the similarity
+    indexes keep its moods; lyrics routed to another version are classified
+    again with the active version.
+
+    :param lyrics: chorus normalized lyrics of the songs
+    :type lyrics: list[str]
+    :param classifications: classification of each lyric by its routed
+        version
+    :type classifications: list[dict]
+    :return: classification of each lyric by the active version
+    :rtype: list[dict]
+    """
+    active_version = registry.active_version
+    positions = [
+        position
+        for position, classification in enumerate(classifications)
+        if classification["model_version"] != active_version
+    ]
+    if not positions:
+        return classifications
+    stored = list(classifications)
+    reclassified = await classify_many(
+        [lyrics[position] for position in positions], active_version
+    )
+    for position, classification in zip(positions, reclassified):
+        stored[position] = classification
+    return stored
+
+
+def routing_key(song: str, artist: str) -> str:
+    """Function returns the key routing a song to a version of the traffic
+    split, so /search and /classify/batch route a song the same way.
+
+    :param song: song name
+    :type song: str
+    :param artist: artist name
+    :type artist: str
+    :return: routing key
+    :rtype: str
+    """
+    return song_key(normalize(song), normalize(artist))
@@ -0,0 +1,445 @@
+import os
+import pickle
+import re
+import threading
+import time
+
+import numpy as np
+from sklearn import preprocessing
+
+from configuration.config import (CNN_MODEL_DIRECTORY, CNN_MODEL_VERSION,
+                                  CNN_PRELOAD_VERSIONS, CNN_RUNTIME)
+from lite_model import TFLITE_FILES, LiteModel
+from vocabulary import Vocabulary, vocabulary_exists
+
+# Artifact file names inside every cnn_model_vN directory
+TOKENIZER_FILE = "tokenizer.pickle"
+LABELENCODER_FILE = "label_encoder.npy"
+# embedding matrix and headless SavedModel (the layers after the embedding,
+# input batch x 180 x embedding dimension) written by the training script
+# and export_model.py
+EMBEDDING_FILE = "embedding.npy"
+HEADLESS_DIRECTORY = "headless"
+# Length of the padded token sequences the models were trained with
+SEQUENCE_LENGTH = 180
+
+
+class MissingExportError(RuntimeError):
+    """A model version exists but has not been exported to the TFLite
+    variant of the configured runtime."""
+
+
+def pad_sequences(
+    sequences: list[list[int]], length: int = SEQUENCE_LENGTH
+) -> np.ndarray:
+    """Pad token sequences like keras pad_sequences with its defaults: zeros
+    are added and tokens removed at the beginning of a sequence.
+
+    :param sequences: token ids of each lyric
+    :type sequences: list[list[int]]
+    :param length: length of the padded sequences, defaults to 180
+    :type length: int, optional
+    :return: padded token sequences (batch x length)
+    :rtype: np.ndarray
+    """
+    padded = np.zeros((len(sequences), length), dtype=np.int32)
+    for row, sequence in enumerate(sequences):
+        sequence = sequence[-length:]
+        if len(sequence):
+            padded[row, -len(sequence):] = sequence
+    return padded
+
+
+def save_headless(keras_model, directory: str) -> np.ndarray:
+    """Write the embedding matrix of a model whose first layer is an
+    Embedding and a headless SavedModel of the remaining layers, which takes
+    the embedded sequences as input.
+
+    :param keras_model: Keras model starting with an Embedding layer
+    :param directory: directory of the model version
+    :type directory: str
+    :raises ValueError: first layer is not an Embedding
+    :return: embedding matrix
+    :rtype: np.ndarray
+    """
+    import tensorflow as tf
+
+    if not isinstance(keras_model.layers[0], tf.keras.layers.Embedding):
+        raise ValueError("The first layer of the model is not an Embedding")
+    embedding = keras_model.layers[0].get_weights()[0]
+    headless = tf.keras.Sequential(
+        [
+            tf.keras.Input((SEQUENCE_LENGTH, embedding.shape[1])),
+            *keras_model.layers[1:],
+        ]
+    )
+    np.save(os.path.join(directory, EMBEDDING_FILE), embedding)
+    headless.save(os.path.join(directory, HEADLESS_DIRECTORY))
+    return embedding
+
+
+class ModelHandle:
+    """Loaded artifact set (CNN, vocabulary and label encoder) of one model
+    version. The exported vocabulary is used if the model version has one,
+    the pickled Keras tokenizer otherwise. Handles are never modified after
+    loading, so they can be shared between requests and threads. A hot-swap
+    replaces the handle in the registry, requests that already hold the old
+    handle finish with it.
+    """
+
+    def __init__(self, version: str, path: str, runtime: str = CNN_RUNTIME):
+        """Load all artifacts of the model version stored in path.
+
+        :param version: name of the model version, e.g. cnn_model_v3
+        :type version: str
+        :param path: directory of the model version
+        :type path: str
+        :param runtime: keras (SavedModel) or one of the exported TFLite
+            variants tflite, tflite_float16 and tflite_int8, defaults to
+            CNN_RUNTIME
+        :type runtime: str, optional
+        :raises MissingExportError: TFLite variant of runtime not exported
+        """
+        start = time.perf_counter()
+
+        self.version = version
+        self.path = path
+        self.runtime = runtime
+        self.embedding = None
+        if runtime == "keras":
+            import tensorflow as tf
+
+            headless_path = os.path.join(path, HEADLESS_DIRECTORY)
+            embedding_path = os.path.join(path, EMBEDDING_FILE)
+            if os.path.isdir(headless_path) and os.path.isfile(
+                embedding_path
+            ):
+                # the full model is not loaded: the embedding is looked up
+                # in the memory mapped matrix, which worker processes share,
+                # and only the layers after it are read
+                self.embedding = np.load(embedding_path, mmap_mode="r")
+                self.model = tf.keras.models.load_model(headless_path)
+            else:
+                self.model = tf.keras.models.load_model(path)
+        else:
+            # TFLite does not need the TensorFlow runtime
+            tflite_path = os.path.join(path, TFLITE_FILES[runtime])
+            if not os.path.isfile(tflite_path):
+                raise MissingExportError(
+                    f"Model version {version} has no {runtime} export "
+                    f"{TFLITE_FILES[runtime]}, run python export_model.py "
+                    f"{version}"
+                )
+            self.model = LiteModel(tflite_path)
+        if vocabulary_exists(path):
+            self.vocabulary = Vocabulary(path)
+            self.tokenizer = None
+        else:
+            self.vocabulary = None
+            with open(os.path.join(path, TOKENIZER_FILE), "rb") as handle:
+                self.tokenizer = pickle.load(handle)
+        self.encoder = preprocessing.LabelEncoder()
+        self.encoder.classes_ = np.load(
+            os.path.join(path, LABELENCODER_FILE), allow_pickle=True
+        )
+
+        self.load_time = time.perf_counter() - start
+        self.loaded_at = time.time()
+        # memory held by the model weights and the vocabulary, the memory
+        # mapped embedding is shared and reported separately
+        if runtime == "keras":
+            self.weights_bytes = int(
+                sum(weight.nbytes for weight in self.model.get_weights())
+            )
+        else:
+            self.weights_bytes = self.model.file_bytes
+        if self.vocabulary is not None:
+            self.tokenizer_bytes = self.vocabulary.file_bytes
+        else:
+            self.tokenizer_bytes = os.path.getsize(
+                os.path.join(path, TOKENIZER_FILE)
+            )
+
+    def encode(
+        self, preprocessed_lyrics: list[list[str]], out: np.ndarray = None
+    ) -> np.ndarray:
+        """Tokenize preprocessed lyrics and pad them to the model input.
+
+        :param preprocessed_lyrics: lemmatized tokens of each lyric
+        :type preprocessed_lyrics: list[list[str]]
+        :param out: int32 array (batch x 180) receiving the sequences,
+            defaults to a new array
+        :type out: np.ndarray, optional
+        :return: padded token sequences (batch x 180)
+        :rtype: np.ndarray
+        """
+        if self.vocabulary is not None:
+            return self.vocabulary.encode(
+                preprocessed_lyrics, SEQUENCE_LENGTH, out
+            )
+        padded = pad_sequences(
+            self.tokenizer.texts_to_sequences(preprocessed_lyrics),
+            SEQUENCE_LENGTH,
+        )
+        if out is None:
+            return padded
+        out[...] = padded
+        return out
+
+    def predict(self, sequences: np.ndarray) -> np.ndarray:
+        """Predict the mood probabilities for padded token sequences.
+        Calling the Keras model directly avoids the per call setup of
+        model.predict and is safe to use from several threads.
+
+        :param sequences: padded token sequences (batch x 180)
+        :type sequences: np.ndarray
+        :return: softmax probabilities (batch x number of moods)
+        :rtype: np.ndarray
+        """
+        if self.runtime == "keras":
+            if self.embedding is not None:
+                sequences = self.embedding[sequences]
+            return self.model(sequences, training=False).numpy()
+        return self.model.predict(sequences)
+
+    def decode(self, prediction: np.ndarray) -> np.ndarray:
+        """Transform predicted probabilities to mood names.
+
+        :param prediction: softmax probabilities (batch x number of moods)
+        :type prediction: np.ndarray
+        :return: mood name for each row of the prediction
+        :rtype: np.ndarray
+        """
+        return self.encoder.inverse_transform(np.argmax(prediction, axis=1))
+
+    def classification(
+        self, preprocessed_lyrics: list[str], prediction: np.ndarray
+    ) -> dict:
+        """Return the classification of one lyric as stored in Elasticsearch.
+
+        :param preprocessed_lyrics: lemmatized tokens of the lyric
+        :type preprocessed_lyrics: list[str]
+        :param prediction: softmax probabilities of the lyric
+        :type prediction: np.ndarray
+        :return: mood, mood probabilities, preprocessed lyrics and version
+        :rtype: dict
+        """
+        return {
+            "mood": str(self.decode(prediction[np.newaxis])[0]),
+            "mood_probabilities": [float(value) for value in prediction],
+            "preprocessed_lyrics": " ".join(preprocessed_lyrics),
+            "model_version": self.version,
+        }
+
+    def classify(self, preprocessed_lyrics: list[list[str]]) -> list[dict]:
+        """Classify many preprocessed lyrics with one forward pass.
+
+        :param preprocessed_lyrics: lemmatized tokens of each lyric
+        :type preprocessed_lyrics: list[list[str]]
+        :return: classification of each lyric
+        :rtype: list[dict]
+        """
+        if not preprocessed_lyrics:
+            return []
+        predictions = self.predict(self.encode(preprocessed_lyrics))
+        return [
+            self.classification(tokens, prediction)
+            for tokens, prediction in zip(preprocessed_lyrics, predictions)
+        ]
+
+    def stats(self) -> dict:
+        """Return load time and memory footprint of the handle.
+
+        :return: statistics of the loaded model version
+        :rtype: dict
+        """
+        return {
+            "version": self.version,
+            "path": self.path,
+            "runtime": self.runtime,
+            "tokenizer": "pickle" if self.vocabulary is None else "vocabulary",
+            "load_time_seconds": round(self.load_time, 3),
+            "loaded_at": self.loaded_at,
+            "weights_bytes": self.weights_bytes,
+            "tokenizer_bytes": self.tokenizer_bytes,
+            "memory_bytes": self.weights_bytes + self.tokenizer_bytes,
+            "embedding_bytes": (
+                0 if self.embedding is None else int(self.embedding.nbytes)
+            ),
+            "moods": [str(mood) for mood in self.encoder.classes_],
+        }
+
+
+class ModelRegistry:
+    """Process wide registry of loaded model versions. Every artifact set is
+    loaded only once and handed out as shared handle. The active version can
+    be swapped atomically while the application keeps serving requests.
+    """
+
+    def __init__(
+        self,
+        model_directory: str = CNN_MODEL_DIRECTORY,
+        active_version: str = CNN_MODEL_VERSION,
+    ):
+        self.model_directory = model_directory
+        self.active_version = active_version
+        self._handles = {}
+        # guards _handles and active_version
+        self._lock = threading.Lock()
+        # serializes loading, so a version is never loaded twice
+        self._load_lock = threading.Lock()
+
+    def available_versions(self) -> list[str]:
+        """Return all model versions stored in the model directory.
+
+        :return: sorted list of cnn_model_vN directory names
+        :rtype: list[str]
+        """
+        versions = [
+            name
+            for name in os.listdir(self.model_directory)
+            if re.fullmatch(r"cnn_model_v\d+", name)
+            and os.path.isdir(os.path.join(self.model_directory, name))
+        ]
+        return sorted(versions, key=lambda name: int(name.rsplit("v", 1)[1]))
+
+    def load(self, version: str, reload: bool = False) -> ModelHandle:
+        """Load a model version if it is not loaded yet.
+
+        :param version: model version to load
+        :type version: str
+        :param reload: load the artifacts from disk again even if the version
+            is already loaded, defaults to False
+        :type reload: bool, optional
+        :raises FileNotFoundError: model version does not exist
+        :raises MissingExportError: TFLite variant of the runtime not
+            exported
+        :return: handle of the loaded model version
+        :rtype: ModelHandle
+        """
+        with self._load_lock:
+            with self._lock:
+                handle = self._handles.get(version)
+            if handle is not None and not reload:
+                return handle
+
+            path = os.path.join(self.model_directory, version)
+            if not os.path.isdir(path):
+                raise FileNotFoundError(f"Model version {version} not found")
+            # load outside of _lock so requests can still get handles
+            handle = ModelHandle(version, path)
+            print(
+                f"Loaded {version} in {handle.load_time:.2f}s "
+                f"({handle.stats()['memory_bytes']} bytes)"
+            )
+            with self._lock:
+                self._handles[version] = handle
+            return handle
+
+    def load_all(self, versions: list[str] = None) -> None:
+        """Load the given model versions and the active version.
+
+        :param versions: versions to load, defaults to every available version
+        :type versions: list[str], optional
+        """
+        versions = list(versions or self.available_versions())
+        if self.active_version not in versions:
+            versions.append(self.active_version)
+        for version in versions:
+            self.load(version)
+
+    def get(self, version: str = None) -> ModelHandle:
+        """Return the shared handle of a model version. Versions which have
+        not been loaded at startup are loaded on first use.
+
+        :param version: model version, defaults to the active version
+        :type version: str, optional
+        :return: handle of the model version
+        :rtype: ModelHandle
+        """
+        with self._lock:
+            version = version or self.active_version
+            handle = self._handles.get(version)
+        if handle is None:
+            handle = self.load(version)
+        return handle
+
+    def moods(self, version: str = None) -> list[str]:
+        """Return the moods a model version classifies into, read from its
+        label encoder without loading the model.
+
+        :param version: model version, defaults to the active version
+        :type version: str, optional
+        :raises FileNotFoundError: model version does not exist
+        :return: moods in the order of the model output
+        :rtype: list[str]
+        """
+        with self._lock:
+            version = version or self.active_version
+            handle = self._handles.get(version)
+        if handle is not None:
+            classes = handle.encoder.classes_
+        else:
+            path = os.path.join(self.model_directory, version)
+            if not os.path.isdir(path):
+                raise FileNotFoundError(f"Model version {version} not found")
+            classes = np.load(
+                os.path.join(path, LABELENCODER_FILE), allow_pickle=True
+            )
+        return [str(mood) for mood in classes]
+
+    def is_loaded(self, version: str) -> bool:
+        """Return whether a model version is loaded.
+
+        :param version: model version
+        :type version: str
+        :return: True if get returns the version without loading it
+        :rtype: bool
+        """
+        with self._lock:
+            return version in self._handles
+
+    def activate(self, version: str, reload: bool = False) -> ModelHandle:
+        """Hot-swap the active model version. The new version is loaded
+        completely before it replaces the active one, so requests never see
+        a partially loaded model.
+
+        :param version: model version to activate
+        :type version: str
+        :param reload: load the artifacts from disk again, e.g. after the
+            model directory has been overwritten, defaults to False
+        :type reload: bool, optional
+        :return: handle of the activated model version
+        :rtype: ModelHandle
+        """
+        handle = self.load(version, reload=reload)
+        with self._lock:
+            self.active_version = version
+        return handle
+
+    def stats(self) -> dict:
+        """Return the active version and statistics of all loaded versions.
+
+        :return: registry statistics
+        :rtype: dict
+        """
+        with self._lock:
+            handles = list(self._handles.values())
+            active_version = self.active_version
+        return {
+            "active_version": active_version,
+            "loaded_versions": {
+                handle.version: handle.stats() for handle in handles
+            },
+            "memory_bytes": sum(
+                handle.stats()["memory_bytes"] for handle in handles
+            ),
+        }
+
+
+registry = ModelRegistry()
+
+
+def load_models() -> None:
+    """Load the configured model versions into the process wide registry."""
+    registry.load_all(CNN_PRELOAD_VERSIONS)
@@ -0,0 +1,543 @@
+import asyncio
+import hashlib
+import random
+import time
+from collections import deque
+
+import numpy as np
+
+import executors
+from configuration.config import (MODEL_LATENCY_WINDOW, MODEL_SHADOW_RATE,
+                                  MODEL_SHADOW_MAX_IN_FLIGHT,
+                                  MODEL_SHADOW_VERSION, MODEL_SPLIT,
+                                  MODEL_THROUGHPUT_WINDOW)
+from inference_batcher import inference_batcher, shadow_batcher
+from model_registry import registry
+
+
+class IncompatibleVersionError(ValueError):
+    """A model version classifies into other moods than the active version,
+    which the stored songs and the similarity indexes use."""
+
+
+def parse_split(text: str) -> dict:
+    """Function parses a traffic split like "cnn_model_v3=90,cnn_model_v2=10".
+
+    :param text: comma separated version=weight pairs
+    :type text: str
+    :raises ValueError: weight is not a positive number
+    :return: weight per model version
+    :rtype: dict
+    """
+    split = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        version, _, weight = part.partition("=")
+        split[version.strip()] = float(weight or 1)
+    if any(weight <= 0 for weight in split.values()):
+        raise ValueError(f"Weights of the split {text} must be positive")
+    return split
+
+
+class LatencyStats:
+    """Latency and throughput of the classifications of one model version in
+    one role (served or shadow). Percentiles are computed over the latest
+    calls, the throughput over the latest seconds.
+    """
+
+    def __init__(
+        self,
+        window: int = MODEL_LATENCY_WINDOW,
+        throughput_window: float = MODEL_THROUGHPUT_WINDOW,
+    ):
+        self.throughput_window = throughput_window
+        self.calls = 0
+        self.songs = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self._latencies = deque(maxlen=window)
+        # (time.monotonic() when finished, songs) of the latest calls
+        self._finished = deque()
+
+    def record(self, latency: float, songs: int = 1) -> None:
+        """Record a successful classification call.
+
+        :param latency: seconds the call took
+        :type latency: float
+        :param songs: number of classified songs, defaults to 1
+        :type songs: int, optional
+        """
+        self.calls += 1
+        self.songs += songs
+        self.total_latency += latency
+        self._latencies.append(latency)
+        now = time.monotonic()
+        self._finished.append((now, songs))
+        while self._finished[0][0] < now - self.throughput_window:
+            self._finished.popleft()
+
+    def stats(self) -> dict:
+        """Return call counts, latency percentiles and throughput.
+
+        :return: latency statistics
+        :rtype: dict
+        """
+        now = time.monotonic()
+        recent = sum(
+            songs
+            for finished, songs in self._finished
+            if finished >= now - self.throughput_window
+        )
+        latencies = 1000 * np.asarray(self._latencies)
+        percentiles = (
+            np.percentile(latencies, [50, 95, 99])
+            if len(latencies)
+            else [0.0, 0.0, 0.0]
+        )
+        return {
+            "calls": self.calls,
+            "songs": self.songs,
+            "errors": self.errors,
+            "mean_latency_ms": round(
+                1000 * self.total_latency / max(self.calls, 1), 3
+            ),
+            "p50_latency_ms": round(float(percentiles[0]), 3),
+            "p95_latency_ms": round(float(percentiles[1]), 3),
+            "p99_latency_ms": round(float(percentiles[2]), 3),
+            "songs_per_second": round(recent / self.throughput_window, 3),
+        }
+
+
+class Agreement:
+    """Agreement of the shadow version with the served version. The
+    difference of the mood probabilities is only comparable if both versions
+    classify into the same moods.
+    """
+
+    def __init__(self):
+        self.compared = 0
+        self.agreed = 0
+        self.probabilities_compared = 0
+        self.total_abs_difference = 0.0
+
+    def record(self, served: dict, shadow: dict) -> None:
+        """Compare the classification of one song by both versions.
+
+        :param served: classification of the served version
+        :type served: dict
+        :param shadow: classification of the shadow version
+        :type shadow: dict
+        """
+        self.compared += 1
+        self.agreed += served["mood"] == shadow["mood"]
+        served_probabilities = served["mood_probabilities"]
+        shadow_probabilities = shadow["mood_probabilities"]
+        if len(served_probabilities) == len(shadow_probabilities):
+            self.probabilities_compared += 1
+            self.total_abs_difference += float(
+                np.mean(
+                    np.abs(
+                        np.asarray(served_probabilities)
+                        - np.asarray(shadow_probabilities)
+                    )
+                )
+            )
+
+    def stats(self) -> dict:
+        """Return the share of equal moods and the mean probability
+        difference.
+
+        :return: agreement statistics
+        :rtype: dict
+        """
+        return {
+            "compared": self.compared,
+            "mood_agreement": round(self.agreed / max(self.compared, 1), 4),
+            "mean_abs_difference": (
+                round(
+                    self.total_abs_difference / self.probabilities_compared, 6
+                )
+                if self.probabilities_compared
+                else None
+            ),
+        }
+
+
+class ModelRouter:
+    """Chooses the model version of every classification. A request may ask
+    for a version, otherwise traffic is split between versions by weight
+    (sticky per song) or served by the active version of the registry. A
+    shadow version classifies a share of the songs in the background; its
+    result is only compared with the served one, so it adds no latency to
+    the response. Shadows run in their own batcher and executor and are
+    skipped while served requests queue. Latency, throughput and agreement
+    are recorded per version, so versions can be rolled forward on measured
+    performance.
+    """
+
+    def __init__(
+        self,
+        split: dict = None,
+        shadow_version: str = MODEL_SHADOW_VERSION,
+        shadow_rate: float = MODEL_SHADOW_RATE,
+        shadow_max_in_flight: int = MODEL_SHADOW_MAX_IN_FLIGHT,
+    ):
+        self.split = dict(split or {})
+        self.shadow_version = shadow_version or None
+        self.shadow_rate = shadow_rate
+        self.shadow_max_in_flight = shadow_max_in_flight
+        self.shadow_dropped = 0
+        # shadows skipped because served requests were queued
+        self.shadow_skipped_busy = 0
+        # (version, role) -> LatencyStats
+        self._latency = {}
+        # (served version, shadow version) -> Agreement
+        self._agreement = {}
+        self._shadow_tasks = set()
+
+    def versions(self) -> list[str]:
+        """Return the versions traffic is split or shadowed to.
+
+        :return: model versions
+        :rtype: list[str]
+        """
+        versions = list(self.split)
+        if self.shadow_version and self.shadow_version not in versions:
+            versions.append(self.shadow_version)
+        return versions
+
+    def load(self) -> None:
+        """Check and load the versions traffic is split or shadowed to, so
+        they do not load on a request.
+
+        :raises FileNotFoundError: model version does not exist
+        :raises IncompatibleVersionError: model version classifies into
+            other moods than the active version
+        """
+        for version in self.versions():
+            self.check_version(version)
+        for version in self.versions():
+            registry.load(version)
+
+    def check_version(self, version: str) -> None:
+        """Check that a model version exists and classifies into the moods
+        of the active version.
+
+        :param version: model version
+        :type version: str
+        :raises FileNotFoundError: model version does not exist
+        :raises IncompatibleVersionError: model version classifies into
+            other moods than the active version
+        """
+        if version not in registry.available_versions():
+            raise FileNotFoundError(f"Model version {version} not found")
+        moods = registry.moods(version)
+        active_moods = registry.moods()
+        if moods != active_moods:
+            raise IncompatibleVersionError(
+                f"Model version {version} classifies into {moods}, the "
+                f"active version {registry.active_version} into "
+                f"{active_moods}"
+            )
+
+    def configure(
+        self, split: dict, shadow_version: str = None, shadow_rate: float = 1.0
+    ) -> None:
+        """Replace the traffic split and the shadow version. The versions are
+        loaded before traffic is routed to them.
+
+        :param split: weight per model version, empty to serve the active
+            version
+        :type split: dict
+        :param shadow_version: version classifying in the background,
+            defaults to None
+        :type shadow_version: str, optional
+        :param shadow_rate: share of songs classified by the shadow version,
+            defaults to 1.0
+        :type shadow_rate: float, optional
+        :raises FileNotFoundError: model version does not exist
+        :raises IncompatibleVersionError: model version classifies into
+            other moods than the active version
+        :raises ValueError: weight is not positive or rate not in [0, 1]
+        """
+        for version in [*split, *([shadow_version] if shadow_version else [])]:
+            self.check_version(version)
+        if any(weight <= 0 for weight in split.values()):
+            raise ValueError("Weights of the split must be positive")
+        if not 0 <= shadow_rate <= 1:
+            raise ValueError("The shadow rate must be between 0 and 1")
+        for version in [*split, *([shadow_version] if shadow_version else [])]:
+            registry.load(version)
+        self.split = dict(split)
+        self.shadow_version = shadow_version or None
+        self.shadow_rate = shadow_rate
+
+    def route(self, version: str = None, key: str = None) -> str:
+        """Return the model version which classifies a song.
+
+        :param version: version requested by the client, defaults to None
+        :type version: str, optional
+        :param key: key of the song, the same song is always routed to the
+            same version of the split, defaults to a random choice
+        :type key: str, optional
+        :raises FileNotFoundError: requested version does not exist
+        :raises IncompatibleVersionError: requested version classifies into
+            other moods than the active version
+        :return: model version
+        :rtype: str
+        """
+        if version:
+            self.check_version(version)
+            return version
+        split = self.split
+        if not split:
+            return registry.active_version
+        if key is None:
+            position = random.random()
+        else:
+            digest = hashlib.sha256(key.encode("utf-8")).digest()
+            position = int.from_bytes(digest[:8], "big") / 2**64
+        position *= sum(split.values())
+        for version, weight in split.items():
+            position -= weight
+            if position < 0:
+                return version
+        return version
+
+    def _stats_of(self, version: str, role: str) -> LatencyStats:
+        stats = self._latency.get((version, role))
+        if stats is None:
+            stats = self._latency[(version, role)] = LatencyStats()
+        return stats
+
+    async def _timed(self, version: str, role: str, function, *args):
+        stats = self._stats_of(version, role)
+        started = time.perf_counter()
+        try:
+            result = await function(*args)
+        except Exception:
+            stats.errors += 1
+            raise
+        stats.record(
+            time.perf_counter() - started,
+            len(result) if isinstance(result, list) else 1,
+        )
+        return result
+
+    @staticmethod
+    async def _handle(version: str, shadow: bool = False):
+        # versions requested by a client may not be loaded yet
+        if registry.is_loaded(version):
+            return registry.get(version)
+        executor = (
+            executors.shadow_executor if shadow else executors.io_executor
+        )
+        return await executor.run(registry.get, version)
+
+    async def _classify_one(
+        self, version: str, preprocessed_lyrics: list[str],
+        shadow: bool = False
+    ):
+        model = await self._handle(version, shadow)
+        batcher = shadow_batcher if shadow else inference_batcher
+        # every version encodes with its own vocabulary
+        prediction = await batcher.predict(
+            model, model.encode([preprocessed_lyrics])[0]
+        )
+        return model.classification(preprocessed_lyrics, prediction)
+
+    async def _classify_many(
+        self, version: str, preprocessed_lyrics: list[list[str]],
+        shadow: bool = False
+    ):
+        model = await self._handle(version, shadow)
+        executor = (
+            executors.shadow_executor if shadow else executors.io_executor
+        )
+        return await executor.run(model.classify, preprocessed_lyrics)
+
+    async def classify(
+        self, preprocessed_lyrics: list[str], version: str = None,
+        key: str = None
+    ) -> dict:
+        """Classify one preprocessed lyric with the routed model version.
+        The inference is batched with concurrent requests.
+
+        :param preprocessed_lyrics: lemmatized tokens of the lyric
+        :type preprocessed_lyrics: list[str]
+        :param version: version requested by the client, defaults to None
+        :type version: str, optional
+        :param key: key of the song for the sticky split, defaults to None
+        :type key: str, optional
+        :return: mood, mood probabilities, preprocessed lyrics and version
+        :rtype: dict
+        """
+        version = self.route(version, key)
+        classification = await self._timed(
+            version, "served", self._classify_one, version,
+            preprocessed_lyrics
+        )
+        self._shadow(
+            version, [classification], self._classify_one,
+            preprocessed_lyrics
+        )
+        return classification
+
+    async def classify_many(
+        self, preprocessed_lyrics: list[list[str]], version: str = None,
+        keys: list[str] = None
+    ) -> list[dict]:
+        """Classify many preprocessed lyrics. Every lyric is routed like
+        classify routes it, so a song gets the same version of the split in
+        a batch as in a single request. The lyrics of each version are
+        classified with one forward pass.
+
+        :param preprocessed_lyrics: lemmatized tokens of each lyric
+        :type preprocessed_lyrics: list[list[str]]
+        :param version: version requested by the client, defaults to None
+        :type version: str, optional
+        :param keys: key of the song of each lyric for the sticky split,
+            defaults to a random choice per lyric
+        :type keys: list[str], optional
+        :raises FileNotFoundError: requested version does not exist
+        :raises IncompatibleVersionError: requested version classifies into
+            other moods than the active version
+        :return: classification of each lyric
+        :rtype: list[dict]
+        """
+        if keys is None:
+            keys = [None] * len(preprocessed_lyrics)
+        positions = {}
+        for position, key in enumerate(keys):
+            positions.setdefault(self.route(version, key), []).append(
+                position
+            )
+
+        classifications = [None] * len(preprocessed_lyrics)
+        results = await asyncio.gather(
+            *[
+                self._classify_version(
+                    routed, [preprocessed_lyrics[p] for p in routed_positions]
+                )
+                for routed, routed_positions in positions.items()
+            ]
+        )
+        for routed_positions, routed_classifications in zip(
+            positions.values(), results
+        ):
+            for position, classification in zip(
+                routed_positions, routed_classifications
+            ):
+                classifications[position] = classification
+        return classifications
+
+    async def _classify_version(
+        self, version: str, preprocessed_lyrics: list[list[str]]
+    ) -> list[dict]:
+        # lyrics routed to the same version share one forward pass
+        classifications = await self._timed(
+            version, "served", self._classify_many, version,
+            preprocessed_lyrics
+        )
+        self._shadow(
+            version, classifications, self._classify_many,
+            preprocessed_lyrics
+        )
+        return classifications
+
+    def _shadow(
+        self, served_version: str, served: list[dict], function,
+        preprocessed_lyrics
+    ) -> None:
+        # classify with the shadow version in the background
+        shadow_version = self.shadow_version
+        if (
+            not shadow_version
+            or shadow_version == served_version
+            or random.random() >= self.shadow_rate
+        ):
+            return
+        if len(self._shadow_tasks) >= self.shadow_max_in_flight:
+            # the shadow version does not keep up, skip instead of queueing
+            self.shadow_dropped += 1
+            return
+        if inference_batcher.busy() or executors.io_executor.busy():
+            # served requests are waiting, the comparison can wait for a
+            # quieter moment
+            self.shadow_skipped_busy += 1
+            return
+        task = asyncio.create_task(
+            self._compare(
+                served_version, served, shadow_version, function,
+                preprocessed_lyrics
+            )
+        )
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+
+    async def _compare(
+        self, served_version: str, served: list[dict], shadow_version: str,
+        function, preprocessed_lyrics
+    ) -> None:
+        try:
+            shadow = await self._timed(
+                shadow_version, "shadow", function, shadow_version,
+                preprocessed_lyrics, True
+            )
+        except Exception as error:
+            print(
+                f"Shadow classification with {shadow_version} failed: {error}"
+            )
+            return
+        if isinstance(shadow, dict):
+            shadow = [shadow]
+        agreement = self._agreement.get((served_version, shadow_version))
+        if agreement is None:
+            agreement = self._agreement[(served_version, shadow_version)] = (
+                Agreement()
+            )
+        for served_classification, shadow_classification in zip(
+            served, shadow
+        ):
+            agreement.record(served_classification, shadow_classification)
+
+    async def stop(self) -> None:
+        """Wait for the shadow classifications in flight and stop the
+        batcher of the shadow version."""
+        if self._shadow_tasks:
+            await asyncio.gather(*self._shadow_tasks, return_exceptions=True)
+        await shadow_batcher.stop()
+
+    def stats(self) -> dict:
+        """Return the routing configuration, latency and throughput per
+        version and role and the agreement of the shadow version.
+
+        :return: router statistics
+        :rtype: dict
+        """
+        versions = {}
+        for (version, role), stats in sorted(self._latency.items()):
+            versions.setdefault(version, {})[role] = stats.stats()
+        return {
+            "active_version": registry.active_version,
+            "split": dict(self.split),
+            "shadow": {
+                "version": self.shadow_version,
+                "rate": self.shadow_rate,
+                "in_flight": len(self._shadow_tasks),
+                "dropped": self.shadow_dropped,
+                "skipped_busy": self.shadow_skipped_busy,
+                "inference": shadow_batcher.stats(),
+            },
+            "versions": versions,
+            "agreement": {
+                f"{served}/{shadow}": agreement.stats()
+                for (served, shadow), agreement in sorted(
+                    self._agreement.items()
+                )
+            },
+        }
+
+
+model_router = ModelRouter(parse_split(MODEL_SPLIT))
@@ -0,0 +1,203 @@
+import asyncio
+import time
+
+import elasticsearch_functions as ef
+import executors
+import utils
+from configuration.config import (READY_BACKOFF_INITIAL, READY_BACKOFF_MAX,
+                                  READY_DEADLINE)
+from model_registry import load_models, registry
+from model_router import model_router
+from similarity_index import similarity_indexes
+
+# Maximum time a status request to Elasticsearch may take in /readyz
+STATUS_TIMEOUT = 2
+
+
+class Readiness:
+    """Startup state of the components the backend needs to answer requests
+    without cold starts. Every component is pending, running, ready or
+    failed; the backend is ready once all of them are ready.
+    """
+
+    def __init__(self, components: list[str]):
+        self.started_at = time.time()
+        self.components = {
+            component: {"state": "pending"} for component in components
+        }
+        # last known status of the Elasticsearch index
+        self.index = {"exists": False, "loading": False, "documents": 0}
+
+    def set(self, component: str, state: str, **details) -> None:
+        """Set the state of a component.
+
+        :param component: name of the component
+        :type component: str
+        :param state: pending, running, ready or failed
+        :type state: str
+        """
+        self.components[component] = {
+            "state": state,
+            "since": time.time(),
+            **details,
+        }
+
+    def ready(self) -> bool:
+        """Return whether every component is ready.
+
+        :return: True if the backend can receive traffic
+        :rtype: bool
+        """
+        return all(
+            component["state"] == "ready"
+            for component in self.components.values()
+        )
+
+    def report(self) -> dict:
+        """Return the state of all components and the index.
+
+        :return: readiness report
+        :rtype: dict
+        """
+        return {
+            "ready": self.ready(),
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "components": dict(self.components),
+            "index": dict(self.index),
+        }
+
+
+readiness = Readiness(["index", "models", "nlp", "similarity_indexes", "warm_up"])
+
+
+async def index_status() -> dict:
+    """Request the status of the Elasticsearch index and remember it.
+
+    :return: exists, loading and documents of the index or the error
+    :rtype: dict
+    """
+    try:
+        status = await asyncio.wait_for(
+            ef.async_get_index_status(), STATUS_TIMEOUT
+        )
+    except Exception as error:
+        # Elasticsearch is not reachable (yet)
+        return {**readiness.index, "error": repr(error)}
+    readiness.index = status
+    return status
+
+
+async def wait_for_index(
+    deadline: float = READY_DEADLINE,
+    initial_delay: float = READY_BACKOFF_INITIAL,
+    max_delay: float = READY_BACKOFF_MAX,
+) -> dict:
+    """Poll the Elasticsearch index with exponential backoff until it exists,
+    is not being loaded anymore and contains documents. Polling goes on
+    after the deadline, which only marks the index as overdue in /readyz,
+    so the backend becomes ready whenever the index is loaded.
+
+    :param deadline: seconds after which the index is reported as overdue
+    :type deadline: float
+    :param initial_delay: seconds between the first two polls
+    :type initial_delay: float
+    :param max_delay: maximum seconds between two polls
+    :type max_delay: float
+    :return: status of the loaded index
+    :rtype: dict
+    """
+    end = time.monotonic() + deadline
+    delay = initial_delay
+    overdue = False
+    while True:
+        status = await index_status()
+        if (
+            status["exists"]
+            and not status["loading"]
+            and status["documents"] > 0
+            and "error" not in status
+        ):
+            return status
+        if not overdue and time.monotonic() >= end:
+            overdue = True
+            readiness.set("index", "running", overdue=True, status=status)
+            print(
+                f"Index {ef.index_name} not loaded after {deadline}s, "
+                f"still waiting: {status}"
+            )
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, max_delay)
+
+
+def warm_up() -> None:
+    """Run one classification with every loaded model version, so the first
+    requests do not pay for tracing the model graphs."""
+    preprocessed_lyrics = utils.preprocess_lyrics_batch(
+        ["warm up the mood classification"]
+    )
+    for version in registry.stats()["loaded_versions"]:
+        registry.get(version).classify(preprocessed_lyrics)
+
+
+def load_all_models() -> None:
+    """Load the configured model versions and the versions traffic is split
+    or shadowed to."""
+    load_models()
+    model_router.load()
+
+
+async def prepare_component(component: str, function) -> bool:
+    """Prepare one component and track its state. Blocking functions run in
+    the thread pool, so the health endpoints answer while loading.
+
+    :param component: name of the component
+    :type component: str
+    :param function: coroutine function or blocking function preparing it
+    :return: True if the component is ready
+    :rtype: bool
+    """
+    readiness.set(component, "running")
+    started = time.perf_counter()
+    try:
+        if asyncio.iscoroutinefunction(function):
+            await function()
+        else:
+            await executors.run_io(function)
+    except Exception as error:
+        readiness.set(component, "failed", error=repr(error))
+        print(f"Preparing {component} failed: {error}")
+        return False
+    readiness.set(
+        component, "ready", seconds=round(time.perf_counter() - started, 3)
+    )
+    return True
+
+
+async def prepare_models() -> bool:
+    """Load the models, the spaCy pipeline and the similarity indexes one
+    after another and warm them up.
+
+    :return: True if all of them are ready
+    :rtype: bool
+    """
+    for component, function in (
+        ("models", load_all_models),
+        ("nlp", utils.get_nlp),
+        ("similarity_indexes", similarity_indexes.load),
+        ("warm_up", warm_up),
+    ):
+        if not await prepare_component(component, function):
+            return False
+    return True
+
+
+async def prepare() -> bool:
+    """Wait for the Elasticsearch index while the models are loaded.
+
+    :return: True if the backend is ready
+    :rtype: bool
+    """
+    results = await asyncio.gather(
+        prepare_component("index", wait_for_index), prepare_models()
+    )
+    return all(results)
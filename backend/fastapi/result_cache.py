@@ -0,0 +1,321 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import executors
+from configuration.config import (RESULT_CACHE_SHARED_PATH, RESULT_CACHE_SIZE,
+                                  RESULT_CACHE_TTL)
+
+
+def normalize(text: str) -> str:
+    """Normalize a song or artist name for cache keys: unicode normal form,
+    lower case and single spaces.
+
+    :param text: song or artist name
+    :type text: str
+    :return: normalized name
+    :rtype: str
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def cache_key(song: str, artist: str, model_version: str) -> str:
+    """Return the cache key of a search result.
+
+    :param song: requested song name
+    :type song: str
+    :param artist: requested artist name
+    :type artist: str
+    :param model_version: model version classifying the song
+    :type model_version: str
+    :return: cache key
+    :rtype: str
+    """
+    return json.dumps([model_version, normalize(song), normalize(artist)])
+
+
+class LRUCache:
+    """In-process tier: least recently used results with a time to live.
+    Every entry remembers the mood of the song, so all results of a mood can
+    be invalidated when a song of that mood is added.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # key -> (expires, mood, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Return the cached value of a key.
+
+        :param key: cache key
+        :type key: str
+        :return: cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key: str, mood: str, value) -> None:
+        """Cache a value, the least recently used entry is evicted if the
+        cache is full.
+
+        :param key: cache key
+        :type key: str
+        :param mood: mood of the song the value belongs to
+        :type mood: str
+        :param value: value to cache
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, mood, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_mood(self, mood: str) -> int:
+        """Remove all entries of a mood.
+
+        :param mood: mood of the entries to remove
+        :type mood: str
+        :return: number of removed entries
+        :rtype: int
+        """
+        with self._lock:
+            keys = [
+                key for key, entry in self._entries.items() if entry[1] == mood
+            ]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self) -> dict:
+        """Return size and hit, miss, eviction and invalidation counters.
+
+        :return: cache statistics
+        :rtype: dict
+        """
+        lookups = max(self.hits + self.misses, 1)
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class SqliteCache:
+    """Shared tier: results stored in a sqlite file, so several worker
+    processes on one host share them. It stands in for a shared cache
+    server and has the same interface as LRUCache; values are stored as
+    JSON.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, mood TEXT, expires REAL, value TEXT)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_mood ON results (mood)"
+        )
+
+    def get(self, key: str):
+        """Return the cached value of a key.
+
+        :param key: cache key
+        :type key: str
+        :return: cached value or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT expires, value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] < time.time():
+                self._connection.execute(
+                    "DELETE FROM results WHERE key = ?", (key,)
+                )
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[1])
+
+    def set(self, key: str, mood: str, value) -> None:
+        """Cache a value and remove expired entries.
+
+        :param key: cache key
+        :type key: str
+        :param mood: mood of the song the value belongs to
+        :type mood: str
+        :param value: JSON serializable value to cache
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, mood, now + self.ttl, json.dumps(value, default=float)),
+            )
+            cursor = self._connection.execute(
+                "DELETE FROM results WHERE expires < ?", (now,)
+            )
+            self.expirations += cursor.rowcount
+
+    def invalidate_mood(self, mood: str) -> int:
+        """Remove all entries of a mood.
+
+        :param mood: mood of the entries to remove
+        :type mood: str
+        :return: number of removed entries
+        :rtype: int
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM results WHERE mood = ?", (mood,)
+            )
+            self.invalidations += cursor.rowcount
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        """Return size and hit, miss and invalidation counters.
+
+        :return: cache statistics
+        :rtype: dict
+        """
+        with self._lock:
+            size = self._connection.execute(
+                "SELECT COUNT(*) FROM results"
+            ).fetchone()[0]
+        lookups = max(self.hits + self.misses, 1)
+        return {
+            "path": self.path,
+            "size": size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3),
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class ResultCache:
+    """Two level cache of /search results. Lookups go to the in-process tier
+    first and to the optional shared tier on a miss; shared hits are copied
+    into the in-process tier. Adding a song invalidates the results of its
+    mood in both tiers, other processes drop their in-process entries of
+    that mood when the time to live is over.
+    """
+
+    def __init__(self, local: LRUCache, shared: SqliteCache = None):
+        self.local = local
+        self.shared = shared
+        # time of the last invalidation per mood
+        self._invalidated_at = {}
+
+    async def get(self, key: str):
+        """Return a copy of the cached value of a key.
+
+        :param key: cache key
+        :type key: str
+        :return: cached value or None
+        """
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = await executors.run_io(self.shared.get, key)
+            if value is not None:
+                self.local.set(key, value.get("mood"), value)
+        return copy.deepcopy(value)
+
+    async def set(self, key: str, mood: str, value, started: float) -> None:
+        """Cache a value unless its mood was invalidated after the value was
+        computed, which would store an outdated result.
+
+        :param key: cache key
+        :type key: str
+        :param mood: mood of the song the value belongs to
+        :type mood: str
+        :param value: JSON serializable value to cache
+        :param started: time.monotonic() when computing the value started
+        :type started: float
+        """
+        if self._invalidated_at.get(mood, float("-inf")) >= started:
+            return
+        value = copy.deepcopy(value)
+        self.local.set(key, mood, value)
+        if self.shared is not None:
+            await executors.run_io(self.shared.set, key, mood, value)
+
+    async def invalidate_mood(self, mood: str) -> None:
+        """Remove the cached results of a mood, e.g. after a song of that
+        mood has been added.
+
+        :param mood: mood of the added song
+        :type mood: str
+        """
+        self._invalidated_at[mood] = time.monotonic()
+        self.local.invalidate_mood(mood)
+        if self.shared is not None:
+            await executors.run_io(self.shared.invalidate_mood, mood)
+
+    def stats(self) -> dict:
+        """Return the statistics of both tiers.
+
+        :return: statistics per tier
+        :rtype: dict
+        """
+        return {
+            "local": self.local.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+        }
+
+
+result_cache = ResultCache(
+    LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL),
+    SqliteCache(RESULT_CACHE_SHARED_PATH, RESULT_CACHE_TTL)
+    if RESULT_CACHE_SHARED_PATH
+    else None,
+)
@@ -0,0 +1,845 @@
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from ann_index import ExactSearch, create_search_backend
+from configuration.config import (ANN_MIN_SONGS, CNN_MODEL_DIRECTORY,
+                                  CNN_MODEL_VERSION, SIMILARITY_BACKEND,
+                                  SIMILARITY_INDEX_DIRECTORY)
+
+# File names of the artifacts of one mood index. The arrays are memory
+# mapped, so worker processes share one copy in the page cache.
+TERMS_FILE = "terms.json"
+IDF_FILE = "idf.npy"
+COMPONENTS_FILE = "svd_components.npy"
+VECTORS_FILE = "vectors.npy"
+# pickled vectorizer and SVD of indexes saved by earlier versions
+VECTORIZER_FILE = "vectorizer.pickle"
+SVD_FILE = "svd.pickle"
+SONGS_FILE = "songs.json"
+META_FILE = "meta.json"
+
+
+def song_key(song: str, artist: str) -> str:
+    """Return the key used to identify a song, consistent with the keys of
+    elasticsearch_functions.get_all_documents_of_mood.
+
+    :param song: song name
+    :type song: str
+    :param artist: artist name
+    :type artist: str
+    :return: song key
+    :rtype: str
+    """
+    return f"{song}_{artist}"
+
+
+def tfidf_vectorizer(vocabulary: list[str] = None) -> TfidfVectorizer:
+    """Return the TF-IDF vectorizer of the mood indexes.
+
+    :param vocabulary: terms of a fitted vectorizer in column order,
+        defaults to None to fit the vocabulary
+    :type vocabulary: list[str], optional
+    :return: TF-IDF vectorizer
+    :rtype: TfidfVectorizer
+    """
+    return TfidfVectorizer(
+        analyzer="word", lowercase=True, stop_words="english", min_df=5,
+        vocabulary=vocabulary,
+    )
+
+
+def save_array(path: str, array: np.ndarray) -> None:
+    """Save an array as .npy file. The file is replaced atomically, since
+    running workers may have mapped the previous file into memory.
+
+    :param path: path of the .npy file
+    :type path: str
+    :param array: array to save
+    :type array: np.ndarray
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as handle:
+        np.save(handle, array)
+    os.replace(temporary_path, path)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale every row of a matrix to unit length, so the cosine similarity
+    of normalized rows is their dot product. Rows of zeros stay zero.
+
+    :param matrix: matrix with one vector per row
+    :type matrix: np.ndarray
+    :return: contiguous matrix with normalized rows
+    :rtype: np.ndarray
+    """
+    matrix = np.ascontiguousarray(matrix)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(
+        matrix, norms, out=np.zeros_like(matrix), where=norms != 0
+    )
+
+
+def top_n_cosine(
+    query_vector: np.ndarray, normalized_matrix: np.ndarray, top_n: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rank the rows of a normalized matrix by cosine similarity to a query
+    vector with one matrix vector product. Scores >= 0.999 are set to 0,
+    since this would mean that the song to compare with is part of the
+    matrix.
+
+    :param query_vector: vector to find similar rows for
+    :type query_vector: np.ndarray
+    :param normalized_matrix: candidate vectors normalized with
+        normalize_rows
+    :type normalized_matrix: np.ndarray
+    :param top_n: number of rows to return
+    :type top_n: int
+    :return: indexes of the top n rows (most similar first), empty for
+        top_n <= 0, and the similarity scores of all rows
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    scores = normalized_matrix @ normalize_rows(query_vector)
+    # filter exact duplicates of the song to compare with
+    scores[scores >= 0.999] = 0
+
+    top_n = max(min(top_n, len(scores)), 0)
+    if top_n == 0:
+        # [-0:] would select every row
+        candidates = np.arange(0)
+    elif top_n < len(scores):
+        candidates = np.argpartition(scores, len(scores) - top_n)[-top_n:]
+    else:
+        candidates = np.arange(len(scores))
+    # highest score first, ties ordered like np.argsort(scores)[::-1]
+    order = np.lexsort((-candidates, -scores[candidates]))
+    return candidates[order], scores
+
+
+def get_top_n_similar(
+    song_to_compare: dict, songs_to_compare_to: dict, top_n_simlar: int = 3
+) -> list:
+    """Function which takes in three parameters: song_to_compare,
+    songs_to_compare_to, and top_n_similar, and returns a list of top n
+    most similar songs based on the cosine similarity score between their
+    vectorized lyrics. The vectorized lyrics of songs_to_compare_to are
+    stacked into one normalized matrix, so the cosine similarity scores of
+    all songs are calculated with a single matrix vector product.
+    It then filters out any scores equal to 1 (which would mean that the
+    same song was found in songs_to_compare_to). The indexes of the top n
+    scores are then found and the corresponding song information
+    (song name and artist name) is returned in the form of a list.
+
+    :param song_to_compare: lyric to find similar songs for
+    :type song_to_compare: dict
+    :param songs_to_compare_to: lyrics of songs to compare to song_to_compare
+    :type songs_to_compare_to: dict
+    :param top_n_simlar: number of most similar songs to return
+    :type top_n_simlar: int
+    :return: list of top n most similar songs containing song name
+        and artist name, empty if there are no songs to compare to or
+        top_n_simlar <= 0
+    :rtype: list
+    """
+    keys = list(songs_to_compare_to)
+    if not keys or top_n_simlar <= 0:
+        return {}
+    # stack all vectorized lyrics into one normalized candidate matrix
+    candidate_matrix = normalize_rows(
+        np.vstack(
+            [
+                songs_to_compare_to[key]["Vectorized_lyric"]
+                for key in keys
+            ]
+        )
+    )
+
+    # calculate similarity scores and get indexes of top n values
+    indexes_top_n, cosine_similarity_scores = top_n_cosine(
+        song_to_compare["Vectorized_lyric"], candidate_matrix, top_n_simlar
+    )
+
+    # remove lyrics from dict and round similarity to decent percentage
+    top_n_songs_no_lyrics = {
+        keys[index]: {
+            "Song": songs_to_compare_to[keys[index]]["Song"],
+            "Artist": songs_to_compare_to[keys[index]]["Artist"],
+            "Similarity": round(
+                float(cosine_similarity_scores[index]) * 100, 2
+            ),
+        }
+        for index in indexes_top_n
+    }
+
+    return top_n_songs_no_lyrics
+
+
+def get_tf_idf_vectorized_lyrics(
+    song_to_compare: dict, song_same_mood_dict: dict
+) -> tuple[dict, dict]:
+    """Function that returns the tf-idf vectors for given lyrics.
+
+    :param song_to_compare: dict with song name, artist name and lyrics
+        for song to compare with.
+    :type song_to_compare: dict
+    :param song_same_mood_dict: documents with songs that have the same mood
+        as the song to compare with, as returned by
+        elasticsearch_functions.get_all_documents_of_mood.
+    :type song_same_mood_dict: dict
+
+    :return: dict for the song we want to compare each lyrics of certain
+        mood with. It contains information on the song name, artist name,
+        lyrics and vectorized lyric.
+    :rtype: dict
+    :return: dict with dicts that contain song name, artist name, lyrics
+        and vectorized lyrics for each song of given mood
+        (except of the song to compare with).
+    :rtype: dict
+    """
+
+    # check if song to compare with is within the song_same_mood_dict. If not
+    # add it for tf-idf vectorization
+    song_to_compare_key = (
+        f'{song_to_compare["Song"]}_{song_to_compare["Artist"]}'
+    )
+    if song_to_compare_key not in song_same_mood_dict.keys():
+        song_same_mood_dict[song_to_compare_key] = song_to_compare
+    # get list of all lyrics of songs with same mood
+    lyrics_list = [
+        document["Lyrics"] for document in song_same_mood_dict.values()
+    ]
+    # current ones
+    tfidf_vectorizer = TfidfVectorizer(
+        analyzer="word", lowercase=True, stop_words="english", min_df=5
+    )
+    print(f"tfidf_vectorizer: {tfidf_vectorizer}")
+    # generate tdf-idf scores
+    lyrics_tf_idf = tfidf_vectorizer.fit_transform(lyrics_list)
+
+    # reduce the dimensionality of the tf-idf vectors
+    SVD = TruncatedSVD(
+        n_components=300, random_state=42  # number of output dimensionalities
+    )
+    vectorized_lyrics = SVD.fit_transform(
+        lyrics_tf_idf
+    )
+
+    for key, vectorized_lyric in zip(
+        list(song_same_mood_dict.keys()), vectorized_lyrics
+    ):
+        song_same_mood_dict[key]["Vectorized_lyric"] = vectorized_lyric
+
+    song_to_compare = song_same_mood_dict.pop(song_to_compare_key)
+
+    return song_to_compare, song_same_mood_dict
+
+
+def get_similar_of_documents(
+    song_to_compare: dict, song_same_mood_dict: dict, top_n_simlar: int = 3
+) -> dict:
+    """Function vectorizes the lyrics of the song to compare with and all
+    songs of the same mood with TD-IDF and returns the top n most similar
+    songs. Runs in worker processes, so it only returns the small result.
+
+    :param song_to_compare: dict with song name, artist name and lyrics
+        for song to compare with.
+    :type song_to_compare: dict
+    :param song_same_mood_dict: documents with songs that have the same mood
+    :type song_same_mood_dict: dict
+    :param top_n_simlar: number of most similar songs to return
+    :type top_n_simlar: int
+    :return: top n most similar songs containing song name, artist name
+        and similarity
+    :rtype: dict
+    """
+    song_to_compare, songs_to_compare_to = get_tf_idf_vectorized_lyrics(
+        song_to_compare=song_to_compare,
+        song_same_mood_dict=song_same_mood_dict,
+    )
+    return get_top_n_similar(
+        song_to_compare=song_to_compare,
+        songs_to_compare_to=songs_to_compare_to,
+        top_n_simlar=top_n_simlar,
+    )
+
+
+class MoodIndex:
+    """Precomputed TF-IDF/SVD similarity index of all songs of one mood.
+    It holds the fitted vectorizer, the SVD projection matrix and a dense
+    float32 matrix with one normalized SVD vector per song, so a request only
+    has to transform the lyrics of the song to compare with. The songs to
+    score are selected by a pluggable nearest neighbour backend (see
+    ann_index).
+    """
+
+    def __init__(
+        self,
+        mood: str,
+        vectorizer: TfidfVectorizer,
+        components: np.ndarray,
+        vectors: np.ndarray,
+        songs: list[dict],
+        build_id: str = None,
+        normalized: bool = False,
+    ):
+        """Create the index of a mood.
+
+        :param mood: mood of the songs
+        :type mood: str
+        :param vectorizer: fitted TF-IDF vectorizer
+        :type vectorizer: TfidfVectorizer
+        :param components: SVD projection matrix (300 x number of terms)
+        :type components: np.ndarray
+        :param vectors: SVD vectors of the songs
+        :type vectors: np.ndarray
+        :param songs: song and artist name of every row of the vectors
+        :type songs: list[dict]
+        :param build_id: identifier of the SVD space, defaults to the
+            current time
+        :type build_id: str, optional
+        :param normalized: vectors are normalized float32 rows and are used
+            without a copy, e.g. memory mapped, defaults to False
+        :type normalized: bool, optional
+        """
+        self.mood = mood
+        # identifies the SVD space, vectors stored in Elasticsearch are only
+        # reused while they belong to the same build
+        self.build_id = build_id or time.strftime("%Y%m%d%H%M%S")
+        self.vectorizer = vectorizer
+        self.components = components
+        self.songs = list(songs)
+        self.keys = {
+            song_key(song["Song"], song["Artist"]): row
+            for row, song in enumerate(self.songs)
+        }
+        # rows beyond size are preallocated for incremental additions
+        self.size = len(self.songs)
+        if normalized:
+            # read only if memory mapped, add_song copies on the first growth
+            self._vectors = vectors
+        else:
+            self._vectors = normalize_rows(vectors.astype(np.float32))
+        self._lock = threading.Lock()
+        self.search_backend = ExactSearch(self._vectors)
+
+    def use_search_backend(self, name: str, **parameters) -> None:
+        """Build the nearest neighbour backend used by get_similar.
+
+        :param name: name of the backend (exact, ivf or hnsw)
+        :type name: str
+        """
+        self.search_backend = create_search_backend(
+            name, self.vectors, **parameters
+        )
+
+    @classmethod
+    def build(cls, mood: str, documents: dict) -> "MoodIndex":
+        """Fit the vectorizer and SVD on the lyrics of all songs of a mood.
+
+        :param mood: mood of the documents
+        :type mood: str
+        :param documents: dicts with song name, artist name and lyrics,
+            as returned by elasticsearch_functions.get_all_documents_of_mood
+        :type documents: dict
+        :return: fitted index
+        :rtype: MoodIndex
+        """
+        return cls.build_from_pages(
+            mood,
+            [
+                [
+                    {
+                        "song_name": document["Song"],
+                        "artist_name": document["Artist"],
+                        "lyrics": document["Lyrics"],
+                    }
+                    for document in documents.values()
+                ]
+            ],
+        )
+
+    @classmethod
+    def build_from_pages(cls, mood: str, pages) -> "MoodIndex":
+        """Fit the vectorizer and SVD on streamed pages of documents, as
+        returned by elasticsearch_functions.iter_documents_of_mood. The raw
+        lyrics are consumed page by page, only the sparse tf-idf matrix of
+        the whole mood is held in memory.
+
+        :param mood: mood of the documents
+        :type mood: str
+        :param pages: pages of documents with song_name, artist_name and
+            lyrics
+        :type pages: Iterable[list[dict]]
+        :return: fitted index
+        :rtype: MoodIndex
+        """
+        songs = []
+        seen = set()
+
+        def lyrics_of_pages():
+            for page in pages:
+                for document in page:
+                    key = song_key(document["song_name"], document["artist_name"])
+                    # same key means same song, like in get_all_documents_of_mood
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    songs.append(
+                        {
+                            "Song": document["song_name"],
+                            "Artist": document["artist_name"],
+                        }
+                    )
+                    yield document["lyrics"]
+
+        vectorizer = tfidf_vectorizer()
+        lyrics_tf_idf = vectorizer.fit_transform(lyrics_of_pages())
+        # reduce the dimensionality of the tf-idf vectors
+        svd = TruncatedSVD(
+            n_components=300, random_state=42  # number of output dimensionalities
+        )
+        vectors = svd.fit_transform(lyrics_tf_idf)
+
+        return cls(mood, vectorizer, svd.components_, vectors, songs)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Return the vectors of all songs currently in the index.
+
+        :return: normalized float32 matrix (number of songs x 300)
+        :rtype: np.ndarray
+        """
+        with self._lock:
+            return self._vectors[: self.size]
+
+    def transform(self, lyrics: list[str]) -> np.ndarray:
+        """Project lyrics into the SVD space of the index.
+
+        :param lyrics: lyrics to vectorize
+        :type lyrics: list[str]
+        :return: float32 matrix with one vector per lyric
+        :rtype: np.ndarray
+        """
+        # same projection as TruncatedSVD.transform
+        return (self.vectorizer.transform(lyrics) @ self.components.T).astype(
+            np.float32
+        )
+
+    def vectorize(self, lyrics: str) -> np.ndarray:
+        """Return the normalized vector of lyrics in the index.
+
+        :param lyrics: lyrics to vectorize
+        :type lyrics: str
+        :return: normalized float32 vector
+        :rtype: np.ndarray
+        """
+        return normalize_rows(self.transform([lyrics])[0])
+
+    def add_song(
+        self, song: str, artist: str, lyrics: str, vector: np.ndarray = None
+    ) -> bool:
+        """Add a new song to the index without refitting it. The lyrics are
+        projected with the already fitted vectorizer and SVD.
+
+        :param song: song name
+        :type song: str
+        :param artist: artist name
+        :type artist: str
+        :param lyrics: lyrics of the song
+        :type lyrics: str
+        :param vector: normalized vector of the lyrics if already computed
+            with vectorize, defaults to None
+        :type vector: np.ndarray, optional
+        :return: True if the song has been added, False if already indexed
+        :rtype: bool
+        """
+        key = song_key(song, artist)
+        if key in self.keys:
+            return False
+        if vector is None:
+            vector = self.vectorize(lyrics)
+
+        with self._lock:
+            if key in self.keys:
+                return False
+            # grow the preallocated matrix geometrically
+            if self.size == len(self._vectors):
+                grown = np.zeros(
+                    (max(2 * self.size, 16), self._vectors.shape[1]),
+                    dtype=np.float32,
+                )
+                grown[: self.size] = self._vectors[: self.size]
+                self._vectors = grown
+            self._vectors[self.size] = vector
+            self.songs.append({"Song": song, "Artist": artist})
+            self.keys[key] = self.size
+            self.search_backend.add(self.size, vector)
+            self.size += 1
+        return True
+
+    def search(
+        self, query_vector: np.ndarray, top_n: int, exact: bool = False
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Find the most similar rows of the index. Candidate rows are
+        selected by the search backend and scored exactly.
+
+        :param query_vector: vector to find similar songs for
+        :type query_vector: np.ndarray
+        :param top_n: number of rows to return
+        :type top_n: int
+        :param exact: score all rows regardless of the backend,
+            defaults to False
+        :type exact: bool, optional
+        :return: top n rows (most similar first) and their scores
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        vectors = self.vectors
+        query_vector = normalize_rows(query_vector.astype(np.float32))
+        candidates = None
+        if not exact:
+            candidates = self.search_backend.candidates(
+                vectors, query_vector, top_n
+            )
+        if candidates is None:
+            rows, scores = top_n_cosine(query_vector, vectors, top_n)
+            return rows, scores[rows]
+        indexes, scores = top_n_cosine(
+            query_vector, vectors[candidates], top_n
+        )
+        return candidates[indexes], scores[indexes]
+
+    def get_similar(
+        self, song_to_compare: dict, top_n_similar: int = 3
+    ) -> dict:
+        """Return the top n most similar songs of the index.
+
+        :param song_to_compare: dict with song name, artist name and lyrics
+            and optionally the vectorized lyric of this index
+        :type song_to_compare: dict
+        :param top_n_similar: number of most similar songs to return
+        :type top_n_similar: int
+        :return: dict with song name, artist name and similarity of the
+            top n most similar songs
+        :rtype: dict
+        """
+        query_vector = song_to_compare.get("Vectorized_lyric")
+        if query_vector is None:
+            query_vector = self.transform([song_to_compare["Lyrics"]])[0]
+
+        # skip the song itself if it is part of the index
+        own_row = self.keys.get(
+            song_key(song_to_compare["Song"], song_to_compare["Artist"])
+        )
+        rows, scores = self.search(
+            query_vector, top_n_similar + (own_row is not None)
+        )
+        top_n = [
+            (row, score) for row, score in zip(rows, scores) if row != own_row
+        ][:top_n_similar]
+        return {
+            song_key(self.songs[row]["Song"], self.songs[row]["Artist"]): {
+                "Song": self.songs[row]["Song"],
+                "Artist": self.songs[row]["Artist"],
+                "Similarity": round(float(score) * 100, 2),
+            }
+            for row, score in top_n
+        }
+
+    def recall_report(
+        self, number_of_queries: int = 200, top_n: int = 3
+    ) -> dict:
+        """Compare the search backend with the exact brute force search.
+        Songs of the index are used as queries.
+
+        :param number_of_queries: number of songs used as queries,
+            defaults to 200
+        :type number_of_queries: int, optional
+        :param top_n: number of similar songs per query, defaults to 3
+        :type top_n: int, optional
+        :return: recall@top_n and mean latency of both searches
+        :rtype: dict
+        """
+        vectors = self.vectors
+        rng = np.random.default_rng(42)
+        queries = rng.choice(
+            len(vectors), min(number_of_queries, len(vectors)), replace=False
+        )
+
+        found = 0
+        exact_time = approximate_time = 0.0
+        for query in queries:
+            start = time.perf_counter()
+            exact_rows, _ = self.search(vectors[query], top_n, exact=True)
+            exact_time += time.perf_counter() - start
+            start = time.perf_counter()
+            approximate_rows, _ = self.search(vectors[query], top_n)
+            approximate_time += time.perf_counter() - start
+            found += len(set(exact_rows) & set(approximate_rows))
+
+        return {
+            "mood": self.mood,
+            "backend": self.search_backend.name,
+            "songs": len(vectors),
+            "queries": len(queries),
+            f"recall@{top_n}": round(found / max(len(queries) * top_n, 1), 4),
+            "exact_latency_ms": round(
+                1000 * exact_time / max(len(queries), 1), 3
+            ),
+            "approximate_latency_ms": round(
+                1000 * approximate_time / max(len(queries), 1), 3
+            ),
+        }
+
+    def save(self, directory: str) -> None:
+        """Save the index to the given directory.
+
+        :param directory: directory of the mood index
+        :type directory: str
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            vectors = self._vectors[: self.size].copy()
+            songs = list(self.songs)
+        with open(os.path.join(directory, TERMS_FILE), "w") as handle:
+            json.dump(self.vectorizer.get_feature_names_out().tolist(), handle)
+        save_array(os.path.join(directory, IDF_FILE), self.vectorizer.idf_)
+        save_array(os.path.join(directory, COMPONENTS_FILE), self.components)
+        save_array(os.path.join(directory, VECTORS_FILE), vectors)
+        with open(os.path.join(directory, SONGS_FILE), "w") as handle:
+            json.dump(songs, handle)
+        with open(os.path.join(directory, META_FILE), "w") as handle:
+            json.dump({"build_id": self.build_id}, handle)
+        # superseded by the files above
+        for file_name in (VECTORIZER_FILE, SVD_FILE):
+            if os.path.isfile(os.path.join(directory, file_name)):
+                os.remove(os.path.join(directory, file_name))
+
+    @classmethod
+    def load(cls, mood: str, directory: str) -> "MoodIndex":
+        """Load an index saved with MoodIndex.save. The idf weights, the SVD
+        projection and the vectors are memory mapped read only.
+
+        :param mood: mood of the index
+        :type mood: str
+        :param directory: directory of the mood index
+        :type directory: str
+        :return: loaded index
+        :rtype: MoodIndex
+        """
+        if os.path.isfile(os.path.join(directory, TERMS_FILE)):
+            with open(os.path.join(directory, TERMS_FILE), "r") as handle:
+                vectorizer = tfidf_vectorizer(json.load(handle))
+            vectorizer.idf_ = np.load(
+                os.path.join(directory, IDF_FILE), mmap_mode="r"
+            )
+            components = np.load(
+                os.path.join(directory, COMPONENTS_FILE), mmap_mode="r"
+            )
+        else:
+            # index saved by an earlier version, rewritten on the next save
+            with open(os.path.join(directory, VECTORIZER_FILE), "rb") as handle:
+                vectorizer = pickle.load(handle)
+            with open(os.path.join(directory, SVD_FILE), "rb") as handle:
+                components = pickle.load(handle).components_
+        # saved vectors are normalized float32 rows
+        vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, SONGS_FILE), "r") as handle:
+            songs = json.load(handle)
+        build_id = "unversioned"
+        if os.path.isfile(os.path.join(directory, META_FILE)):
+            with open(os.path.join(directory, META_FILE), "r") as handle:
+                build_id = json.load(handle)["build_id"]
+        return cls(
+            mood, vectorizer, components, vectors, songs, build_id,
+            normalized=True,
+        )
+
+
+class SimilarityIndexes:
+    """Collection of the per mood similarity indexes of the application."""
+
+    def __init__(
+        self,
+        directory: str = SIMILARITY_INDEX_DIRECTORY,
+        backend: str = SIMILARITY_BACKEND,
+    ):
+        self.directory = directory
+        self.backend = backend
+        self._indexes = {}
+        # moods with new songs that have not been saved yet
+        self._changed = set()
+
+    def load(self) -> None:
+        """Load all mood indexes stored in the index directory."""
+        if not os.path.isdir(self.directory):
+            print(f"No similarity index found in {self.directory}")
+            return
+        for mood in sorted(os.listdir(self.directory)):
+            start = time.perf_counter()
+            mood_index = MoodIndex.load(mood, os.path.join(self.directory, mood))
+            # small moods are fast enough to be searched exactly
+            if mood_index.size >= ANN_MIN_SONGS:
+                mood_index.use_search_backend(self.backend)
+            self._indexes[mood] = mood_index
+            print(
+                f"Loaded similarity index of mood {mood} with "
+                f"{mood_index.size} songs ({mood_index.search_backend.name} "
+                f"search) in {time.perf_counter() - start:.2f}s"
+            )
+
+    def get(self, mood: str) -> MoodIndex:
+        """Return the index of a mood.
+
+        :param mood: mood of the index
+        :type mood: str
+        :return: index of the mood or None if no index exists for the mood
+        :rtype: MoodIndex
+        """
+        return self._indexes.get(mood)
+
+    def set(self, mood_index: MoodIndex) -> None:
+        """Add or replace the index of a mood.
+
+        :param mood_index: index to add
+        :type mood_index: MoodIndex
+        """
+        self._indexes[mood_index.mood] = mood_index
+        self._changed.add(mood_index.mood)
+
+    def moods(self) -> list[str]:
+        """Return the moods which have an index.
+
+        :return: moods
+        :rtype: list[str]
+        """
+        return sorted(self._indexes)
+
+    def vectorize(self, mood: str, lyrics: str) -> tuple[np.ndarray, str]:
+        """Vectorize lyrics with the index of a mood.
+
+        :param mood: mood of the song
+        :type mood: str
+        :param lyrics: lyrics of the song
+        :type lyrics: str
+        :return: normalized vector and build id of the index, both None if
+            no index exists for the mood
+        :rtype: tuple[np.ndarray, str]
+        """
+        mood_index = self.get(mood)
+        if mood_index is None:
+            return None, None
+        return mood_index.vectorize(lyrics), mood_index.build_id
+
+    def add_song(
+        self,
+        mood: str,
+        song: str,
+        artist: str,
+        lyrics: str,
+        vector: np.ndarray = None,
+    ) -> None:
+        """Add a newly stored song to the index of its mood.
+
+        :param mood: mood of the song
+        :type mood: str
+        :param song: song name
+        :type song: str
+        :param artist: artist name
+        :type artist: str
+        :param lyrics: lyrics of the song
+        :type lyrics: str
+        :param vector: normalized vector of the lyrics if already computed,
+            defaults to None
+        :type vector: np.ndarray, optional
+        """
+        mood_index = self.get(mood)
+        if mood_index is not None and mood_index.add_song(
+            song, artist, lyrics, vector
+        ):
+            self._changed.add(mood)
+
+    def save(self) -> None:
+        """Save all mood indexes which changed since loading."""
+        for mood in sorted(self._changed):
+            self._indexes[mood].save(os.path.join(self.directory, mood))
+        self._changed.clear()
+
+
+similarity_indexes = SimilarityIndexes()
+
+
+def build_similarity_indexes(moods: list[str] = None) -> None:
+    """Build the indexes of all moods from the songs stored in Elasticsearch
+    and save them to the index directory.
+
+    :param moods: moods to build, defaults to the moods of the active model
+    :type moods: list[str], optional
+    """
+    import elasticsearch_functions as ef
+
+    if not moods:
+        moods = np.load(
+            os.path.join(
+                CNN_MODEL_DIRECTORY, CNN_MODEL_VERSION, "label_encoder.npy"
+            ),
+            allow_pickle=True,
+        )
+    for mood in moods:
+        start = time.perf_counter()
+        similarity_indexes.set(
+            MoodIndex.build_from_pages(
+                str(mood),
+                ef.iter_documents_of_mood(
+                    mood, ["song_name", "artist_name", "lyrics"]
+                ),
+            )
+        )
+        print(
+            f"Built similarity index of mood {mood} in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+    similarity_indexes.save()
+
+
+def recall_report(
+    backend: str, number_of_queries: int = 200, top_n: int = 3, **parameters
+) -> list[dict]:
+    """Compare a nearest neighbour backend with the exact search on the
+    saved index of every mood.
+
+    :param backend: name of the backend (exact, ivf or hnsw)
+    :type backend: str
+    :param number_of_queries: number of queries per mood, defaults to 200
+    :type number_of_queries: int, optional
+    :param top_n: number of similar songs per query, defaults to 3
+    :type top_n: int, optional
+    :return: one report per mood
+    :rtype: list[dict]
+    """
+    reports = []
+    for mood in sorted(os.listdir(SIMILARITY_INDEX_DIRECTORY)):
+        mood_index = MoodIndex.load(
+            mood, os.path.join(SIMILARITY_INDEX_DIRECTORY, mood)
+        )
+        mood_index.use_search_backend(backend, **parameters)
+        reports.append(mood_index.recall_report(number_of_queries, top_n))
+        print(reports[-1])
+    return reports
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == "--recall-report":
+        # e.g. python similarity_index.py --recall-report ivf
+        recall_report(sys.argv[2])
+    else:
+        # build the indexes of the moods passed as arguments
+        # (default: all moods)
+        build_similarity_indexes(sys.argv[1:])
@@ -1,7 +1,32 @@
 import re
+from functools import lru_cache
+from typing import Iterable, Iterator
 
 import spacy
 
+from configuration.config import SPACY_BATCH_SIZE, SPACY_N_PROCESS
+
+# spaCy components the preprocessing does not use
+DISABLED_COMPONENTS = ["parser", "ner"]
+
+
+# Patterns of the chorus normalization, compiled once. Each pass only scans
+# the lyrics if its trigger occurs in them. The passes keep their order,
+# since removing a match can create a match of a later pass.
+BRACKET_PASSES = [
+    # everything in [..]
+    ("[", re.compile(r"\[[^]]*\]")),
+    # everything in (..)
+    ("(", re.compile(r"\([^)]*\)")),
+    # everything in {..}
+    ("{", re.compile(r"\{[^}]*\}")),
+    # everything in <..>
+    ("<", re.compile(r"<[^>]*>")),
+    # everything in ::..::
+    ("::", re.compile(r"::[^(::)]*::")),
+]
+PRE_CHORUS = re.compile(r"pre-?chorus")
+
 
 def chorus_normalization(original_lyrics: str) -> str:
     """Function gets rid of unnecessary tokens in the lyrics which don't
@@ -14,27 +39,112 @@ def chorus_normalization(original_lyrics: str) -> str:
     """
 
     lyrics = original_lyrics
-    # filter everything in [..]
-    lyrics = re.sub("\[[^]]*\]", "", lyrics)
-    # filter everything in (..)
-    lyrics = re.sub("\([^)]*\)", "", lyrics)
-    # filter everything in {..}
-    lyrics = re.sub("\{[^}]*\}", "", lyrics)
-    # filter everything in <..>
-    lyrics = re.sub("\<[^>]*\>", "", lyrics)
-    # filter everything in ::..::
-    lyrics = re.sub("::[^(::)]*::", "", lyrics)
+    for trigger, pattern in BRACKET_PASSES:
+        if trigger in lyrics:
+            lyrics = pattern.sub("", lyrics)
 
     # filter more specific combinations of chorus
-    lyrics = re.sub("\nchorus\n", "", lyrics)
-    lyrics = re.sub("\[chorus", "", lyrics)
-    lyrics = re.sub("\nchorus", "", lyrics)
-    lyrics = re.sub("pre[-]?chorus", "", lyrics)
-    lyrics = re.sub("\nrepeat chorus\n", "", lyrics)
+    if "chorus" in lyrics:
+        lyrics = lyrics.replace("\nchorus\n", "")
+        lyrics = lyrics.replace("[chorus", "")
+        lyrics = lyrics.replace("\nchorus", "")
+        lyrics = PRE_CHORUS.sub("", lyrics)
+        lyrics = lyrics.replace("\nrepeat chorus\n", "")
 
     return lyrics
 
 
+def normalize_choruses(lyrics: Iterable[str]) -> Iterator[str]:
+    """Function applies the chorus normalization to many lyrics.
+
+    :param lyrics: unnormalized lyrics, e.g. a list or a generator
+    :type lyrics: Iterable[str]
+    :return: generator of the normalized lyrics in input order
+    :rtype: Iterator[str]
+    """
+    for original_lyrics in lyrics:
+        yield chorus_normalization(original_lyrics)
+
+
+def chorus_normalization_batch(lyrics: Iterable[str]) -> list[str]:
+    """Function applies the chorus normalization to many lyrics.
+
+    :param lyrics: unnormalized lyrics
+    :type lyrics: Iterable[str]
+    :return: normalized lyrics in input order
+    :rtype: list[str]
+    """
+    return list(normalize_choruses(lyrics))
+
+
+@lru_cache(maxsize=None)
+def get_nlp() -> spacy.language.Language:
+    """Function loads the spaCy pipeline once per process and returns the
+    cached pipeline on every further call.
+
+    :return: english spaCy pipeline without parser and ner
+    :rtype: spacy.language.Language
+    """
+    return spacy.load("en_core_web_sm", disable=DISABLED_COMPONENTS)
+
+
+def filter_tokens(doc: spacy.tokens.Doc) -> list[str]:
+    """Function applies stop word removal, punctuation removal and
+    lemmatization to the tokens of a document in a single pass.
+
+    :param doc: document processed by the spaCy pipeline
+    :type doc: spacy.tokens.Doc
+    :return: lemmatized tokens without stop words and punctuation
+    :rtype: list[str]
+    """
+    return [
+        token.lemma_
+        for token in doc
+        if not token.is_stop
+        and not token.is_punct
+        and "\n" not in token.lemma_
+    ]
+
+
+def preprocess_lyrics(
+    lyrics: Iterable[str],
+    batch_size: int = SPACY_BATCH_SIZE,
+    n_process: int = SPACY_N_PROCESS,
+) -> Iterator[list[str]]:
+    """Function streams many lyrics through the spaCy pipeline in batches
+    and yields the preprocessed tokens of each lyric in input order.
+    Preprocessing steps:
+    - Tokenization
+    - Stop word removal
+    - Punctuation removal
+    - Lemmatization
+
+    :param lyrics: lyrics to preprocess
+    :type lyrics: Iterable[str]
+    :param batch_size: number of lyrics per spaCy batch
+    :type batch_size: int
+    :param n_process: number of worker processes used by spaCy
+    :type n_process: int
+    :return: lemmatized tokens of each lyric
+    :rtype: Iterator[list[str]]
+    """
+    for doc in get_nlp().pipe(
+        lyrics, batch_size=batch_size, n_process=n_process
+    ):
+        yield filter_tokens(doc)
+
+
+def preprocess_lyrics_batch(lyrics: list[str]) -> list[list[str]]:
+    """Function preprocesses a batch of lyrics, e.g. in a worker process.
+
+    :param lyrics: lyrics to preprocess
+    :type lyrics: list[str]
+    :return: lemmatized tokens of each lyric
+    :rtype: list[list[str]]
+    """
+    return list(preprocess_lyrics(lyrics))
+
+
 def processing_pipeline(song_data: dict) -> dict:
     """Function executes the entire processing pipeline on given song data.
     Preprocessing steps:
@@ -50,17 +160,7 @@ def processing_pipeline(song_data: dict) -> dict:
     :rtype: dict
     """
 
-    nlp = spacy.load("en_core_web_sm", disable=['ner'])
-    text_nlp_pipe = list(nlp.pipe([song_data["Lyrics"]]))
-
-    # Tokenization
-    song_data["Lyrics"] = tokenization(text_nlp_pipe)
-    # Stop word removal
-    song_data["Lyrics"] = stop_word_removal(song_data["Lyrics"])
-    # Punctuation removal
-    song_data["Lyrics"] = punctutation_removal(song_data["Lyrics"])
-    # Lemmatization
-    song_data["Lyrics"] = lemmatization(song_data["Lyrics"])
+    song_data["Lyrics"] = next(preprocess_lyrics([song_data["Lyrics"]]))
 
     return song_data
 
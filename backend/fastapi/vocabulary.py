@@ -0,0 +1,405 @@
+"""Compact word to id table replacing the pickled Keras tokenizer at
+inference time.
+
+The table holds only the words the tokenizer actually maps (ids below its
+num_words) in a perfect hash table ("hash and displace"): a word's 64 bit
+hash selects a bucket, the displacement of the bucket selects the slot and
+the slot stores the hash as fingerprint and the id of the word. The arrays
+are stored as .npy files and memory mapped, so loading a model version does
+not unpickle the word counts and document counts the tokenizer keeps from
+fitting, and worker processes share the pages of the table.
+
+Example:
+    python vocabulary.py cnn_model_v3
+"""
+import argparse
+import json
+import os
+import pickle
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+
+from configuration.config import CNN_MODEL_DIRECTORY
+
+# Vocabulary files written into a model version directory
+VOCABULARY_FINGERPRINTS_FILE = "vocabulary_fingerprints.npy"
+VOCABULARY_IDS_FILE = "vocabulary_ids.npy"
+VOCABULARY_DISPLACEMENTS_FILE = "vocabulary_displacements.npy"
+VOCABULARY_METADATA_FILE = "vocabulary.json"
+VOCABULARY_FILES = (
+    VOCABULARY_FINGERPRINTS_FILE,
+    VOCABULARY_IDS_FILE,
+    VOCABULARY_DISPLACEMENTS_FILE,
+    VOCABULARY_METADATA_FILE,
+)
+# Words per bucket and share of used slots of the hash table
+BUCKET_SIZE = 4
+LOAD_FACTOR = 0.8
+
+
+def hash_bytes(
+    data: bytes, starts: np.ndarray, lengths: np.ndarray, seed: int
+) -> np.ndarray:
+    """Function returns a 64 bit hash of every word stored in a buffer of
+    UTF-8 encoded words: a polynomial over the bytes and the length, mixed
+    with the splitmix64 finalizer. Unsigned 64 bit arithmetic wraps around.
+
+    :param data: UTF-8 encoded words, optionally with separators
+    :type data: bytes
+    :param starts: offset of each word in data
+    :type starts: np.ndarray
+    :param lengths: length of each word in bytes
+    :type lengths: np.ndarray
+    :param seed: seed selecting the multiplier of the polynomial
+    :type seed: int
+    :return: hash of each word
+    :rtype: np.ndarray
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    starts = starts.astype(np.int64)
+    lengths = lengths.astype(np.int64)
+    # offset of every byte from the start of its word
+    word_starts = np.zeros(len(buffer), dtype=np.int64)
+    inside = starts < len(buffer)
+    word_starts[starts[inside]] = starts[inside]
+    offsets = np.arange(len(buffer)) - np.maximum.accumulate(word_starts)
+    powers = np.cumprod(np.full(
+        int(lengths.max(initial=0)) + 1, 0x100000001B3 + 2 * seed,
+        dtype=np.uint64,
+    ))
+    # prefix sums of the polynomial terms, differences give the words
+    sums = np.zeros(len(buffer) + 1, dtype=np.uint64)
+    np.cumsum(buffer * powers[offsets], out=sums[1:])
+    hashes = sums[starts + lengths] - sums[starts]
+    hashes += lengths.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def hash_words(words: list[bytes], seed: int) -> np.ndarray:
+    """Function returns the hash_bytes hash of every UTF-8 encoded word.
+
+    :param words: UTF-8 encoded words
+    :type words: list[bytes]
+    :param seed: seed selecting the multiplier of the polynomial
+    :type seed: int
+    :return: hash of each word
+    :rtype: np.ndarray
+    """
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    return hash_bytes(
+        b"".join(words), np.cumsum(lengths) - lengths, lengths, seed
+    )
+
+
+def bucket_of(hashes: np.ndarray, buckets: int) -> np.ndarray:
+    """Function returns the bucket of each hash.
+
+    :param hashes: hashes of the words
+    :type hashes: np.ndarray
+    :param buckets: number of buckets
+    :type buckets: int
+    :return: bucket of each hash
+    :rtype: np.ndarray
+    """
+    return (hashes >> np.uint64(40)) % np.uint64(buckets)
+
+
+def slot_of(
+    hashes: np.ndarray, displacements: np.ndarray, slots: int
+) -> np.ndarray:
+    """Function returns the slot of each hash for the displacement of its
+    bucket.
+
+    :param hashes: hashes of the words
+    :type hashes: np.ndarray
+    :param displacements: displacement of the bucket of each hash
+    :type displacements: np.ndarray
+    :param slots: number of slots of the table
+    :type slots: int
+    :return: slot of each hash
+    :rtype: np.ndarray
+    """
+    first = hashes % np.uint64(slots)
+    step = (hashes >> np.uint64(20)) % np.uint64(slots - 1) + np.uint64(1)
+    return (first + displacements.astype(np.uint64) * step) % np.uint64(slots)
+
+
+def build_table(
+    hashes: np.ndarray, buckets: int, slots: int, max_displacement: int
+):
+    """Function places every hash in its own slot. Buckets are placed from
+    the largest to the smallest, each with the first displacement whose
+    slots are all free.
+
+    :param hashes: distinct hashes of the words
+    :type hashes: np.ndarray
+    :param buckets: number of buckets
+    :type buckets: int
+    :param slots: number of slots of the table
+    :type slots: int
+    :param max_displacement: displacements tried per bucket
+    :type max_displacement: int
+    :return: displacement of each bucket and slot of each hash or None if a
+        bucket could not be placed
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    members = defaultdict(list)
+    for position, bucket in enumerate(bucket_of(hashes, buckets).tolist()):
+        members[bucket].append(position)
+
+    displacements = np.zeros(buckets, dtype=np.uint32)
+    positions = np.zeros(len(hashes), dtype=np.int64)
+    occupied = np.zeros(slots, dtype=bool)
+    for bucket in sorted(members, key=lambda b: -len(members[b])):
+        bucket_hashes = hashes[members[bucket]]
+        for displacement in range(max_displacement):
+            candidates = slot_of(
+                bucket_hashes,
+                np.full(len(bucket_hashes), displacement, dtype=np.uint32),
+                slots,
+            ).astype(np.int64)
+            if (
+                len(np.unique(candidates)) == len(candidates)
+                and not occupied[candidates].any()
+            ):
+                break
+        else:
+            return None
+        displacements[bucket] = displacement
+        occupied[candidates] = True
+        positions[members[bucket]] = candidates
+    return displacements, positions
+
+
+def export_vocabulary(
+    tokenizer, directory: str, max_seeds: int = 100,
+    max_displacement: int = 10000
+) -> dict:
+    """Function writes the vocabulary of a fitted Keras tokenizer as perfect
+    hash table. Seeds are tried until all words have distinct hashes and
+    every bucket could be placed.
+
+    :param tokenizer: fitted keras.preprocessing.text.Tokenizer
+    :param directory: directory of the model version
+    :type directory: str
+    :param max_seeds: seeds tried at most, defaults to 100
+    :type max_seeds: int, optional
+    :param max_displacement: displacements tried per bucket, defaults to
+        10000
+    :type max_displacement: int, optional
+    :raises RuntimeError: no seed produced a table
+    :return: metadata of the vocabulary
+    :rtype: dict
+    """
+    num_words = tokenizer.num_words
+    # texts_to_sequences drops words with ids from num_words on
+    words = [
+        (word.encode("utf-8"), index)
+        for word, index in tokenizer.word_index.items()
+        if not num_words or index < num_words
+    ]
+    buckets = max(len(words) // BUCKET_SIZE, 1)
+    slots = max(int(len(words) / LOAD_FACTOR), 2)
+    ids = np.array([index for _, index in words], dtype=np.int32)
+
+    for seed in range(max_seeds):
+        hashes = hash_words([word for word, _ in words], seed)
+        if len(np.unique(hashes)) < len(hashes):
+            continue
+        table = build_table(hashes, buckets, slots, max_displacement)
+        if table is not None:
+            break
+    else:
+        raise RuntimeError(f"No perfect hash table after {max_seeds} seeds")
+    displacements, positions = table
+
+    fingerprints = np.zeros(slots, dtype=np.uint64)
+    fingerprints[positions] = hashes
+    slot_ids = np.zeros(slots, dtype=np.int32)
+    slot_ids[positions] = ids
+    np.save(
+        os.path.join(directory, VOCABULARY_FINGERPRINTS_FILE), fingerprints
+    )
+    np.save(os.path.join(directory, VOCABULARY_IDS_FILE), slot_ids)
+    np.save(
+        os.path.join(directory, VOCABULARY_DISPLACEMENTS_FILE), displacements
+    )
+    metadata = {
+        "words": len(words),
+        "seed": seed,
+        "buckets": buckets,
+        "slots": slots,
+        "lower": bool(tokenizer.lower),
+        # id of unknown and dropped words, None removes them
+        "oov_id": tokenizer.word_index.get(tokenizer.oov_token),
+    }
+    with open(os.path.join(directory, VOCABULARY_METADATA_FILE), "w") as file:
+        json.dump(metadata, file, indent=2)
+    return metadata
+
+
+def vocabulary_exists(directory: str) -> bool:
+    """Function checks whether a model version has an exported vocabulary.
+
+    :param directory: directory of the model version
+    :type directory: str
+    :return: True if all vocabulary files exist
+    :rtype: bool
+    """
+    return all(
+        os.path.isfile(os.path.join(directory, file_name))
+        for file_name in VOCABULARY_FILES
+    )
+
+
+class Vocabulary:
+    """Memory mapped vocabulary of one model version. Encoding a batch hashes
+    all tokens at once, looks them up with a constant number of array
+    operations and writes the padded sequences directly into an int32
+    array. A token only gets the id of a word with the same 64 bit hash.
+    """
+
+    def __init__(self, directory: str):
+        """Map the vocabulary files of a model version.
+
+        :param directory: directory of the model version
+        :type directory: str
+        """
+        self.fingerprints = np.load(
+            os.path.join(directory, VOCABULARY_FINGERPRINTS_FILE),
+            mmap_mode="r",
+        )
+        self.ids = np.load(
+            os.path.join(directory, VOCABULARY_IDS_FILE), mmap_mode="r"
+        )
+        self.displacements = np.load(
+            os.path.join(directory, VOCABULARY_DISPLACEMENTS_FILE),
+            mmap_mode="r",
+        )
+        with open(os.path.join(directory, VOCABULARY_METADATA_FILE)) as file:
+            metadata = json.load(file)
+        self.words = metadata["words"]
+        self.seed = metadata["seed"]
+        self.buckets = metadata["buckets"]
+        self.slots = metadata["slots"]
+        self.lower = metadata["lower"]
+        self.oov_id = metadata["oov_id"]
+        self.file_bytes = sum(
+            os.path.getsize(os.path.join(directory, file_name))
+            for file_name in VOCABULARY_FILES
+        )
+
+    def __len__(self) -> int:
+        return self.words
+
+    def lookup(self, tokens: list[str]) -> np.ndarray:
+        """Return the id of every token, 0 for tokens without id.
+
+        :param tokens: tokens to look up
+        :type tokens: list[str]
+        :return: id of each token
+        :rtype: np.ndarray
+        """
+        if not tokens:
+            return np.zeros(0, dtype=np.int32)
+        text = "\n".join(tokens)
+        if text.count("\n") == len(tokens) - 1:
+            # lower case, encode and hash all tokens at once
+            if self.lower:
+                text = text.lower()
+            data = text.encode("utf-8")
+            separators = np.flatnonzero(
+                np.frombuffer(data, dtype=np.uint8) == ord("\n")
+            )
+            starts = np.concatenate(([0], separators + 1))
+            ends = np.concatenate((separators, [len(data)]))
+            hashes = hash_bytes(data, starts, ends - starts, self.seed)
+        else:
+            # tokens containing line breaks
+            if self.lower:
+                tokens = [token.lower() for token in tokens]
+            hashes = hash_words(
+                [token.encode("utf-8") for token in tokens], self.seed
+            )
+
+        slots = slot_of(
+            hashes,
+            self.displacements[bucket_of(hashes, self.buckets)],
+            self.slots,
+        )
+        found = self.fingerprints[slots] == hashes
+        return np.where(found, self.ids[slots], self.oov_id or 0).astype(
+            np.int32
+        )
+
+    def encode(
+        self, preprocessed_lyrics: list[list[str]], length: int,
+        out: np.ndarray = None
+    ) -> np.ndarray:
+        """Encode tokenized lyrics like keras texts_to_sequences followed by
+        pad_sequences with its defaults: tokens without id are dropped, zeros
+        are added and tokens removed at the beginning of a sequence.
+
+        :param preprocessed_lyrics: lemmatized tokens of each lyric
+        :type preprocessed_lyrics: list[list[str]]
+        :param length: length of the padded sequences
+        :type length: int
+        :param out: int32 array (batch x length) receiving the sequences,
+            defaults to a new array
+        :type out: np.ndarray, optional
+        :raises ValueError: out does not have the shape batch x length
+        :return: padded token sequences (batch x length)
+        :rtype: np.ndarray
+        """
+        batch = len(preprocessed_lyrics)
+        if out is None:
+            out = np.zeros((batch, length), dtype=np.int32)
+        elif out.shape != (batch, length):
+            raise ValueError(
+                f"out has shape {out.shape}, expected {(batch, length)}"
+            )
+        else:
+            out.fill(0)
+
+        ids = self.lookup(list(chain.from_iterable(preprocessed_lyrics)))
+        rows = np.repeat(
+            np.arange(batch),
+            np.fromiter(
+                map(len, preprocessed_lyrics), dtype=np.int64, count=batch
+            ),
+        )
+        kept = ids != 0
+        ids, rows = ids[kept], rows[kept]
+
+        # column of each token when the sequences are aligned to the end
+        ends = np.cumsum(np.bincount(rows, minlength=batch))
+        columns = np.arange(len(ids)) - ends[rows] + length
+        kept = columns >= 0
+        out[rows[kept], columns[kept]] = ids[kept]
+        return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Export the vocabulary of a model version's tokenizer."
+    )
+    parser.add_argument("version", help="model version, e.g. cnn_model_v3")
+    args = parser.parse_args()
+
+    from model_registry import TOKENIZER_FILE
+
+    directory = os.path.join(CNN_MODEL_DIRECTORY, args.version)
+    with open(os.path.join(directory, TOKENIZER_FILE), "rb") as handle:
+        tokenizer = pickle.load(handle)
+    print(json.dumps(export_vocabulary(tokenizer, directory), indent=2))
+
+
+if __name__ == "__main__":
+    main()
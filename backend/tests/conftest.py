@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the backend modules import each other as top level modules
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(BACKEND, "fastapi"))
+
+# the model versions are Keras 2 SavedModels, with Keras 3 installed
+# tf.keras has to be the tf_keras package to read and write them
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
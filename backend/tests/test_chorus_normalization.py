@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("spacy")
+
+import utils  # noqa: E402
+
+# inputs and outputs of the chorus normalization before the passes were
+# precompiled: hand picked cases for every pass and random combinations
+GOLDEN_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "chorus_normalization_golden.json",
+)
+
+with open(GOLDEN_FILE, encoding="utf-8") as golden_file:
+    GOLDEN = json.load(golden_file)
+
+
+@pytest.mark.parametrize(
+    "lyrics,expected",
+    [
+        # nested and unbalanced brackets
+        ("(x[y)z]", "(x"),
+        ("[a[b]c]", "c]"),
+        ("((a)b)", "b)"),
+        ("[abc", "[abc"),
+        ("abc)", "abc)"),
+        # ::..:: pass
+        ("a::b::c", "ac"),
+        ("::a:b::", "::a:b::"),
+        # chorus literals
+        ("verse\nchorus\nverse", "verseverse"),
+        ("[chorus", ""),
+        ("verse\nchorus", "verse"),
+        ("prechorus pre-chorus", " "),
+        ("a\nrepeat chorus\nb", "ab"),
+    ],
+)
+def test_chorus_normalization_cases(lyrics, expected):
+    assert utils.chorus_normalization(lyrics) == expected
+
+
+def test_chorus_normalization_golden():
+    mismatches = [
+        (lyrics, expected, utils.chorus_normalization(lyrics))
+        for lyrics, expected in GOLDEN
+        if utils.chorus_normalization(lyrics) != expected
+    ]
+    assert mismatches == []
+
+
+def test_chorus_normalization_batch_golden():
+    lyrics = [lyrics for lyrics, _ in GOLDEN]
+    expected = [expected for _, expected in GOLDEN]
+    assert utils.chorus_normalization_batch(iter(lyrics)) == expected
@@ -0,0 +1,85 @@
+import os
+import types
+
+import numpy as np
+import pytest
+
+from model_registry import (EMBEDDING_FILE, HEADLESS_DIRECTORY,
+                            LABELENCODER_FILE, SEQUENCE_LENGTH, ModelHandle,
+                            save_headless)
+from vocabulary import export_vocabulary
+
+tf = pytest.importorskip("tensorflow")
+
+WORDS = 200
+MOODS = ["calm", "happy", "sad"]
+
+
+@pytest.fixture(scope="module")
+def model_version(tmp_path_factory):
+    # small model with the layer types of the shipped versions
+    tf.keras.utils.set_random_seed(0)
+    keras_model = tf.keras.Sequential(
+        [
+            tf.keras.layers.Embedding(
+                WORDS, 16, input_length=SEQUENCE_LENGTH, trainable=False
+            ),
+            tf.keras.layers.Dropout(0.2),
+            tf.keras.layers.Conv1D(8, 3, padding="same"),
+            tf.keras.layers.MaxPooling1D(2),
+            tf.keras.layers.Conv1D(8, 3, padding="same"),
+            tf.keras.layers.GlobalMaxPooling1D(),
+            tf.keras.layers.Dense(8),
+            tf.keras.layers.Activation("relu"),
+            tf.keras.layers.Dense(len(MOODS)),
+            tf.keras.layers.Activation("softmax"),
+        ]
+    )
+    keras_model.build((None, SEQUENCE_LENGTH))
+    path = str(tmp_path_factory.mktemp("cnn_model_test"))
+    try:
+        keras_model.save(path)
+    except ValueError:
+        pytest.skip("tf.keras can not write SavedModels (Keras 3)")
+    np.save(os.path.join(path, LABELENCODER_FILE), np.array(MOODS))
+    tokenizer = types.SimpleNamespace(
+        num_words=None,
+        lower=True,
+        oov_token=None,
+        word_index={f"word{index}": index for index in range(1, WORDS)},
+    )
+    export_vocabulary(tokenizer, path)
+    return path
+
+
+def test_headless_model_matches_full_model(model_version):
+    full = ModelHandle("cnn_model_test", model_version, "keras")
+    assert full.embedding is None
+
+    full_model = tf.keras.models.load_model(model_version)
+    embedding = save_headless(full_model, model_version)
+    assert os.path.isfile(os.path.join(model_version, EMBEDDING_FILE))
+    assert os.path.isdir(os.path.join(model_version, HEADLESS_DIRECTORY))
+    headless = ModelHandle("cnn_model_test", model_version, "keras")
+
+    # only the layers after the embedding are loaded
+    assert isinstance(headless.embedding, np.memmap)
+    np.testing.assert_array_equal(headless.embedding, embedding)
+    assert not any(
+        isinstance(layer, tf.keras.layers.Embedding)
+        for layer in headless.model.layers
+    )
+    assert headless.weights_bytes == full.weights_bytes - embedding.nbytes
+
+    rng = np.random.default_rng(0)
+    sequences = rng.integers(0, WORDS, (64, SEQUENCE_LENGTH)).astype(
+        np.int32
+    )
+    sequences[:8, : SEQUENCE_LENGTH // 2] = 0
+    np.testing.assert_allclose(
+        headless.predict(sequences), full.predict(sequences), atol=1e-6
+    )
+    lyrics = [["word1", "word5", "unknown"], [], ["word199"] * 300]
+    assert [c["mood"] for c in headless.classify(lyrics)] == [
+        c["mood"] for c in full.classify(lyrics)
+    ]
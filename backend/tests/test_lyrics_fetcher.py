@@ -0,0 +1,174 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("lyricsgenius")
+
+from lyrics_fetcher import LyricsFetcher  # noqa: E402
+
+# songs of the fake Genius server: title, artist, lyrics and seconds the
+# lyrics page takes to load
+SONGS = {
+    1: ("Hello", "Adele", "Hello, it's me\nI was wondering", 0.0),
+    2: ("Slow Song", "Snail", "Slowly\nvery slowly", 1.0),
+    3: ("Fast Song", "Hare", "Quick\nquick", 0.0),
+}
+
+
+def song_info(song_id: int) -> dict:
+    title, artist, _, _ = SONGS[song_id]
+    return {
+        "id": song_id,
+        "title": title,
+        "primary_artist": {"name": artist},
+        "lyrics_state": "complete",
+        "url": f"https://genius.com/song-{song_id}-lyrics",
+        "path": f"/song-{song_id}-lyrics",
+    }
+
+
+class FakeGenius(BaseHTTPRequestHandler):
+    """Answers the search, song and lyrics page requests of lyricsgenius."""
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        with server.lock:
+            server.requests.append(url.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if url.path.startswith("/api/search"):
+                query = parse_qs(url.query).get("q", [""])[0]
+                term = " ".join(query.lower().split())
+                hits = [
+                    {"index": "song", "type": "song", "result": song_info(i)}
+                    for i, (title, artist, _, _) in SONGS.items()
+                    if term == f"{title} {artist}".lower()
+                ]
+                sections = [{"type": "song", "hits": hits}]
+                self.reply_json({"sections": sections, "hits": hits})
+            elif url.path.startswith("/songs/"):
+                song_id = int(url.path.rsplit("/", 1)[1])
+                self.reply_json({"song": song_info(song_id)})
+            elif url.path.startswith("/song-"):
+                song_id = int(url.path.split("-")[1])
+                _, _, lyrics, delay = SONGS[song_id]
+                time.sleep(delay)
+                body = lyrics.replace("\n", "<br/>")
+                self.reply(
+                    "text/html",
+                    f'<html><div data-lyrics-container="true">{body}</div>'
+                    "</html>",
+                )
+            else:
+                self.send_error(404)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply_json(self, response: dict) -> None:
+        self.reply("application/json", json.dumps({"response": response}))
+
+    def reply(self, content_type: str, body: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_genius():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGenius)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_fetcher(fake_genius, tmp_path):
+    token_path = tmp_path / "genius_api_secret"
+    token_path.write_text("fake-token\n")
+
+    def make_fetcher(**kwargs) -> LyricsFetcher:
+        fetcher = LyricsFetcher(
+            token_path=str(token_path),
+            base_url=f"http://127.0.0.1:{fake_genius.server_port}",
+            **kwargs,
+        )
+        # lyricsgenius sleeps after every request to respect rate limits
+        fetcher.client().sleep_time = 0
+        return fetcher
+
+    return make_fetcher
+
+
+def lyrics_pages(server) -> list:
+    return [path for path in server.requests if path.startswith("/song-")]
+
+
+def test_fetch_scrapes_lyrics(make_fetcher):
+    fetcher = make_fetcher()
+    song = asyncio.run(fetcher.fetch("hello", "adele"))
+    assert song.title == "Hello"
+    assert song.artist == "Adele"
+    assert song.lyrics == "Hello, it's me\nI was wondering"
+
+
+def test_concurrent_fetches_are_coalesced(make_fetcher, fake_genius):
+    fetcher = make_fetcher()
+
+    async def fetch_many():
+        return await asyncio.gather(
+            *[fetcher.fetch("Hello ", "ADELE") for _ in range(10)]
+        )
+
+    songs = asyncio.run(fetch_many())
+    assert {song.lyrics for song in songs} == {SONGS[1][2]}
+    assert fetcher.upstream_calls == 1
+    assert fetcher.stats()["coalesced"] == 9
+    assert lyrics_pages(fake_genius) == ["/song-1-lyrics"]
+
+
+def test_not_found_songs_are_cached(make_fetcher, fake_genius):
+    fetcher = make_fetcher()
+
+    async def fetch_twice():
+        return [await fetcher.fetch("unknown", "nobody") for _ in range(2)]
+
+    assert asyncio.run(fetch_twice()) == [None, None]
+    assert fetcher.upstream_calls == 1
+    assert fetcher.negative_hits == 1
+
+
+def test_timed_out_fetch_keeps_its_slot(make_fetcher, fake_genius):
+    fetcher = make_fetcher(max_concurrent=1, timeout=0.2)
+
+    async def fetch_after_timeout():
+        with pytest.raises(asyncio.TimeoutError):
+            await fetcher.fetch("slow song", "snail")
+        # waits until the abandoned scrape has finished
+        fetcher.timeout = 5
+        return await fetcher.fetch("fast song", "hare")
+
+    song = asyncio.run(fetch_after_timeout())
+    assert song.title == "Fast Song"
+    assert fetcher.timeouts == 1
+    assert fake_genius.max_in_flight == 1
+    assert lyrics_pages(fake_genius) == ["/song-2-lyrics", "/song-3-lyrics"]
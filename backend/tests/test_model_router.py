@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+import model_router
+from model_router import IncompatibleVersionError, ModelRouter, parse_split
+
+MOODS = {
+    "cnn_model_v1": ["aggression", "calm", "grief"],
+    "cnn_model_v2": ["calm", "happy", "sad"],
+    "cnn_model_v3": ["calm", "happy", "sad"],
+    "cnn_model_v4": ["calm", "happy", "sad"],
+}
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = model_router.registry
+    monkeypatch.setattr(registry, "active_version", "cnn_model_v3")
+    monkeypatch.setattr(registry, "available_versions", lambda: list(MOODS))
+    monkeypatch.setattr(
+        registry,
+        "moods",
+        lambda version=None: MOODS[version or registry.active_version],
+    )
+    monkeypatch.setattr(registry, "load", lambda version: None)
+    return registry
+
+
+@pytest.mark.parametrize(
+    "text, split",
+    [
+        ("", {}),
+        ("cnn_model_v3", {"cnn_model_v3": 1.0}),
+        (
+            "cnn_model_v3=90, cnn_model_v2=10,",
+            {"cnn_model_v3": 90.0, "cnn_model_v2": 10.0},
+        ),
+    ],
+)
+def test_parse_split(text, split):
+    assert parse_split(text) == split
+
+
+@pytest.mark.parametrize("text", ["cnn_model_v3=0", "cnn_model_v3=-1"])
+def test_parse_split_rejects_weights(text):
+    with pytest.raises(ValueError):
+        parse_split(text)
+
+
+def test_route_is_sticky_per_song(registry):
+    router = ModelRouter({"cnn_model_v3": 1, "cnn_model_v2": 1})
+    keys = [f"song {index}_artist" for index in range(200)]
+    routed = [router.route(None, key) for key in keys]
+
+    assert routed == [router.route(None, key) for key in keys]
+    # the same in every worker process
+    other_worker = ModelRouter(dict(router.split))
+    assert routed == [other_worker.route(None, key) for key in keys]
+    assert set(routed) == {"cnn_model_v3", "cnn_model_v2"}
+
+
+def test_route_follows_the_weights(registry):
+    router = ModelRouter({"cnn_model_v3": 9, "cnn_model_v2": 1})
+    routed = [router.route(None, f"song {index}") for index in range(2000)]
+
+    assert 0.05 < routed.count("cnn_model_v2") / len(routed) < 0.15
+
+
+def test_route_without_split_serves_the_active_version(registry):
+    assert ModelRouter().route(None, "song_artist") == "cnn_model_v3"
+    assert ModelRouter().route("cnn_model_v2") == "cnn_model_v2"
+
+
+def test_incompatible_versions_are_rejected(registry):
+    router = ModelRouter()
+    with pytest.raises(IncompatibleVersionError):
+        router.route("cnn_model_v1")
+    with pytest.raises(IncompatibleVersionError):
+        router.configure({"cnn_model_v3": 1, "cnn_model_v1": 1})
+    with pytest.raises(IncompatibleVersionError):
+        router.configure({}, shadow_version="cnn_model_v1")
+    with pytest.raises(IncompatibleVersionError):
+        ModelRouter({"cnn_model_v1": 1}).load()
+    with pytest.raises(FileNotFoundError):
+        router.route("cnn_model_v9")
+    assert router.split == {}
+    assert router.shadow_version is None
+
+
+async def classify(version, preprocessed_lyrics, shadow=False):
+    return {"mood": "calm", "mood_probabilities": [1.0, 0.0, 0.0]}
+
+
+def shadowed(router, served_version="cnn_model_v3"):
+    # start shadows on a running loop and wait for them
+    async def run():
+        router._shadow(served_version, [await classify(None, None)],
+                       classify, ["word"])
+        started = len(router._shadow_tasks)
+        await router.stop()
+        return started
+
+    return asyncio.run(run())
+
+
+def test_shadow_classifies_in_the_background(registry):
+    router = ModelRouter(shadow_version="cnn_model_v4", shadow_rate=1)
+
+    assert shadowed(router) == 1
+    assert router.stats()["agreement"]["cnn_model_v3/cnn_model_v4"][
+        "compared"
+    ] == 1
+
+
+def test_shadow_is_skipped(registry, monkeypatch):
+    # same version as served or rate 0
+    assert shadowed(ModelRouter(shadow_version="cnn_model_v3")) == 0
+    assert shadowed(
+        ModelRouter(shadow_version="cnn_model_v4", shadow_rate=0)
+    ) == 0
+
+    # too many shadows in flight
+    router = ModelRouter(
+        shadow_version="cnn_model_v4", shadow_max_in_flight=0
+    )
+    assert shadowed(router) == 0
+    assert router.shadow_dropped == 1
+
+    # served requests are waiting
+    monkeypatch.setattr(model_router.inference_batcher, "busy", lambda: True)
+    router = ModelRouter(shadow_version="cnn_model_v4")
+    assert shadowed(router) == 0
+    assert router.shadow_skipped_busy == 1
+    assert router.stats()["agreement"] == {}
@@ -0,0 +1,36 @@
+import asyncio
+
+import readiness
+
+LOADING = {"exists": True, "loading": True, "documents": 0}
+LOADED = {"exists": True, "loading": False, "documents": 10}
+
+
+def test_index_becomes_ready_after_the_deadline(monkeypatch):
+    statuses = [LOADING, {**LOADING, "error": "ConnectionError()"}, LOADING,
+                LOADED]
+    states = []
+
+    async def index_status():
+        states.append(dict(readiness.readiness.components["index"]))
+        return statuses.pop(0)
+
+    async def wait_loaded():
+        return await readiness.wait_for_index(
+            deadline=0, initial_delay=0.001, max_delay=0.002
+        )
+
+    monkeypatch.setattr(readiness, "index_status", index_status)
+    monkeypatch.setattr(
+        readiness, "readiness", readiness.Readiness(["index"])
+    )
+
+    assert asyncio.run(
+        readiness.prepare_component("index", wait_loaded)
+    )
+    assert not statuses
+    # reported as overdue while waiting, ready once loaded
+    assert states[-1]["state"] == "running"
+    assert states[-1]["overdue"] is True
+    assert readiness.readiness.components["index"]["state"] == "ready"
+    assert readiness.readiness.ready()
@@ -0,0 +1,97 @@
+import os
+import pickle
+import random
+
+import numpy as np
+import pytest
+
+from model_registry import SEQUENCE_LENGTH, TOKENIZER_FILE
+from vocabulary import Vocabulary
+
+# the pickled tokenizers reference keras.preprocessing.text, which Keras 3
+# dropped, tf_keras still provides the same classes
+try:
+    import keras.preprocessing.text  # noqa: F401
+    from keras.preprocessing.sequence import pad_sequences
+
+    KERAS_MODULE = None
+except ImportError:
+    sequence = pytest.importorskip("tf_keras.preprocessing.sequence")
+    pytest.importorskip("tf_keras.preprocessing.text")
+    pad_sequences = sequence.pad_sequences
+    KERAS_MODULE = "tf_keras"
+
+CNN_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "fastapi", "cnn"
+)
+VERSIONS = ["cnn_model_v1", "cnn_model_v2", "cnn_model_v3"]
+
+
+class TokenizerUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if KERAS_MODULE is not None and module.startswith("keras."):
+            module = KERAS_MODULE + module[len("keras"):]
+        return super().find_class(module, name)
+
+
+def load_tokenizer(version):
+    path = os.path.join(CNN_DIRECTORY, version, TOKENIZER_FILE)
+    with open(path, "rb") as handle:
+        return TokenizerUnpickler(handle).load()
+
+
+def sample_lyrics(tokenizer):
+    rng = random.Random(0)
+    words = list(tokenizer.word_index)
+    known = words[: tokenizer.num_words or len(words)]
+    # words the tokenizer knows but drops because of num_words
+    rare = words[len(known):] or ["unseen"]
+    vocabulary = known[:2000] + rare[:500] + [
+        "qzxv", "naïve", "déjà", "日本", "", " ", "a\nb", "\n",
+    ]
+    lyrics = [
+        [],
+        ["qzxv"],
+        [word.upper() for word in known[:50]],
+        [word.title() for word in known[:50]],
+        ["first\nline", known[0] + "\n", "\n" + known[1], known[2]],
+        known[:SEQUENCE_LENGTH],
+        known[: SEQUENCE_LENGTH + 1],
+        known[: 3 * SEQUENCE_LENGTH],
+        rare[:SEQUENCE_LENGTH] + known[:10],
+    ]
+    for _ in range(200):
+        lyrics.append(
+            rng.choices(vocabulary, k=rng.randint(0, 2 * SEQUENCE_LENGTH))
+        )
+    return lyrics
+
+
+@pytest.mark.parametrize("version", VERSIONS)
+def test_encode_matches_keras_tokenizer(version):
+    tokenizer = load_tokenizer(version)
+    vocabulary = Vocabulary(os.path.join(CNN_DIRECTORY, version))
+    lyrics = sample_lyrics(tokenizer)
+
+    expected = pad_sequences(
+        tokenizer.texts_to_sequences(lyrics), SEQUENCE_LENGTH
+    )
+    encoded = vocabulary.encode(lyrics, SEQUENCE_LENGTH)
+
+    assert encoded.dtype == np.int32
+    np.testing.assert_array_equal(encoded, expected)
+
+
+@pytest.mark.parametrize("version", VERSIONS)
+def test_encode_into_out_matches_keras_tokenizer(version):
+    tokenizer = load_tokenizer(version)
+    vocabulary = Vocabulary(os.path.join(CNN_DIRECTORY, version))
+    lyrics = sample_lyrics(tokenizer)[:20]
+    out = np.full((len(lyrics), SEQUENCE_LENGTH), -1, dtype=np.int32)
+
+    vocabulary.encode(lyrics, SEQUENCE_LENGTH, out)
+
+    np.testing.assert_array_equal(
+        out,
+        pad_sequences(tokenizer.texts_to_sequences(lyrics), SEQUENCE_LENGTH),
+    )
@@ -1,11 +1,434 @@
+import argparse
+import gzip
 import json
 import os
 import time
+from contextlib import contextmanager
+from itertools import islice
 
 from elasticsearch import helpers
 from elasticsearch import Elasticsearch
 import pandas as pd
 
+# Bulk loading can be tuned through environment variables: documents per
+# bulk request, number of threads sending requests and rows read from the csv
+# file at once
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "500"))
+BULK_THREAD_COUNT = int(os.environ.get("BULK_THREAD_COUNT", "4"))
+CSV_CHUNK_SIZE = int(os.environ.get("CSV_CHUNK_SIZE", "5000"))
+
+# Snapshots of the index are stored as gzip compressed json lines shards with
+# at most SNAPSHOT_SHARD_SIZE documents. After SNAPSHOT_MAX_INCREMENTS
+# incremental snapshots the next snapshot is a full one again.
+SNAPSHOT_DIRECTORY = os.environ.get(
+    "SNAPSHOT_DIRECTORY", "/opt/elasticsearch/snapshot"
+)
+SNAPSHOT_SHARD_SIZE = int(os.environ.get("SNAPSHOT_SHARD_SIZE", "10000"))
+SNAPSHOT_MAX_INCREMENTS = int(os.environ.get("SNAPSHOT_MAX_INCREMENTS", "20"))
+# indexed_at is stamped by the backend before the document reaches the index,
+# so a snapshot only covers the documents stamped at least SNAPSHOT_LAG
+# seconds before it and an increment also repeats the documents stamped
+# SNAPSHOT_OVERLAP seconds before the end of the previous snapshot. Restoring
+# a repeated document overwrites it with the same _id.
+SNAPSHOT_LAG = float(os.environ.get("SNAPSHOT_LAG", "60"))
+SNAPSHOT_OVERLAP = float(os.environ.get("SNAPSHOT_OVERLAP", "300"))
+MANIFEST_FILE = "manifest.json"
+
+# Seconds to wait at most for loaded documents to become searchable
+WAIT_DEADLINE = float(os.environ.get("WAIT_DEADLINE", "300"))
+
+# Mapping of the lyrics_mood_classification index. The fields after mood are
+# computed by the backend when a song is stored (or afterwards for the
+# initially loaded songs, see backend/fastapi/index_enrichment.py).
+index_mappings = {
+    "dynamic": "strict",
+    "properties": {
+        "song_name": {"type": "text"},
+        "artist_name": {"type": "text"},
+        "lyrics": {"type": "text"},
+        "mood": {"type": "text"},
+        "lyric_vector": {"type": "dense_vector", "dims": 300},
+        "vector_index": {"type": "keyword"},
+        "mood_probabilities": {"type": "float"},
+        "preprocessed_lyrics": {"type": "text"},
+        "model_version": {"type": "keyword"},
+        "indexed_at": {"type": "date", "format": "epoch_millis"},
+    },
+}
+
+
+def csv_documents(path_to_csv, index_name, chunk_size=CSV_CHUNK_SIZE):
+    """
+    Generator yielding the bulk actions for the songs of the ground truth csv file. The file is read in chunks of chunk_size rows, so the whole csv file is never held in memory.
+
+    :param path_to_csv: path to csv file containing the initial data
+    :type path_to_csv: str
+    :param index_name: name of the index the documents are added to
+    :type index_name: str
+    :param chunk_size: number of rows read at once
+    :type chunk_size: int
+    :return: bulk action per song, the row number is used as document id
+    :rtype: Iterator[dict]
+    """
+    columns = ["SName", "Artist", "Lyric", "Mood"]
+    for chunk in pd.read_csv(path_to_csv, usecols=columns, chunksize=chunk_size):
+        rows = zip(
+            chunk.index, chunk["SName"], chunk["Artist"], chunk["Lyric"], chunk["Mood"]
+        )
+        for id, song_name, artist_name, lyrics, mood in rows:
+            yield {
+                "_index": index_name,
+                "_id": f"{id}",
+                "_source": {
+                    "song_name": str(song_name),
+                    "artist_name": str(artist_name),
+                    "lyrics": str(lyrics),
+                    "mood": str(mood),
+                },
+            }
+
+
+def dump_documents(path, index_name):
+    """
+    Generator yielding the bulk actions for the documents of an elasticdump file or a snapshot shard (.gz), one json document per line.
+
+    :param path: path to dump file or snapshot shard
+    :type path: str
+    :param index_name: name of the index the documents are added to
+    :type index_name: str
+    :return: bulk action per document
+    :rtype: Iterator[dict]
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as json_file:
+        for line in json_file:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            yield {
+                "_index": index_name,
+                "_id": document["_id"],
+                "_source": document["_source"],
+            }
+
+
+@contextmanager
+def bulk_load_settings(es, index_name):
+    """
+    Context manager which disables refreshes and replicas of the index while documents are loaded into it. The previous settings are restored and the index is refreshed afterwards, also if loading failed.
+
+    :param es: elasticsearch client
+    :type es: Elasticsearch
+    :param index_name: name of the index
+    :type index_name: str
+    """
+    settings = es.indices.get_settings(index=index_name)[index_name]["settings"]
+    refresh_interval = settings["index"].get("refresh_interval")
+    number_of_replicas = settings["index"].get("number_of_replicas")
+    es.indices.put_settings(
+        index=index_name,
+        settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+    try:
+        yield
+    finally:
+        # None resets a setting to its default value
+        es.indices.put_settings(
+            index=index_name,
+            settings={
+                "index": {
+                    "refresh_interval": refresh_interval,
+                    "number_of_replicas": number_of_replicas,
+                }
+            },
+        )
+        es.indices.refresh(index=index_name)
+
+
+def bulk_load(
+    es, index_name, actions, chunk_size=BULK_CHUNK_SIZE, thread_count=BULK_THREAD_COUNT
+):
+    """
+    Stream bulk actions into an index with refreshes and replicas disabled. With more than one thread the chunks are sent in parallel via helpers.parallel_bulk, otherwise one after another via helpers.streaming_bulk. Throughput and errors are printed for every chunk.
+
+    :param es: elasticsearch client
+    :type es: Elasticsearch
+    :param index_name: name of the index
+    :type index_name: str
+    :param actions: bulk actions, e.g. from csv_documents or dump_documents
+    :type actions: Iterator[dict]
+    :param chunk_size: number of documents per bulk request
+    :type chunk_size: int
+    :param thread_count: number of threads sending bulk requests
+    :type thread_count: int
+    :return: number of successful operations and the failed operations
+    :rtype: tuple[int, list]
+    """
+    if thread_count > 1:
+        results = helpers.parallel_bulk(
+            es,
+            actions,
+            thread_count=thread_count,
+            chunk_size=chunk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+    else:
+        results = helpers.streaming_bulk(
+            es,
+            actions,
+            chunk_size=chunk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+
+    def report_chunk():
+        elapsed = time.perf_counter() - chunk_start
+        print(
+            f"Chunk {chunk}: {chunk_documents} documents in {elapsed:.2f}s "
+            f"({chunk_documents / elapsed:.0f} documents/s), {chunk_errors} errors"
+        )
+
+    successful_operations = 0
+    errors = []
+    chunk, chunk_documents, chunk_errors = 1, 0, 0
+    start = chunk_start = time.perf_counter()
+    with bulk_load_settings(es, index_name):
+        # results are returned per document in the order of the chunks
+        for ok, item in results:
+            chunk_documents += 1
+            if ok:
+                successful_operations += 1
+            else:
+                chunk_errors += 1
+                errors.append(item)
+            if chunk_documents == chunk_size:
+                report_chunk()
+                chunk, chunk_documents, chunk_errors = chunk + 1, 0, 0
+                chunk_start = time.perf_counter()
+        if chunk_documents:
+            report_chunk()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Loaded {successful_operations} documents in {elapsed:.2f}s "
+        f"({successful_operations / elapsed:.0f} documents/s), {len(errors)} errors"
+    )
+    return successful_operations, errors
+
+def read_manifest(directory=SNAPSHOT_DIRECTORY):
+    """
+    Read the manifest listing the snapshots in the snapshot directory.
+
+    :param directory: snapshot directory
+    :type directory: str
+    :return: manifest or None if no snapshot was taken yet
+    :rtype: dict
+    """
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest, directory=SNAPSHOT_DIRECTORY):
+    """
+    Write the manifest of the snapshot directory. The file is replaced atomically, so an interrupted snapshot never leaves a broken manifest.
+
+    :param manifest: manifest to write
+    :type manifest: dict
+    :param directory: snapshot directory
+    :type directory: str
+    """
+    path = os.path.join(directory, MANIFEST_FILE)
+    with open(f"{path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_shards(hits, directory, name, shard_size=SNAPSHOT_SHARD_SIZE):
+    """
+    Write search hits to gzip compressed json lines shards named <name>-<number>.ndjson.gz. Every line contains _id and _source of one document, like the lines of an elasticdump file.
+
+    :param hits: search hits, e.g. from helpers.scan
+    :type hits: Iterator[dict]
+    :param directory: snapshot directory
+    :type directory: str
+    :param name: name of the snapshot
+    :type name: str
+    :param shard_size: maximum number of documents per shard
+    :type shard_size: int
+    :return: file names of the shards and number of written documents
+    :rtype: tuple[list, int]
+    """
+    files = []
+    documents = 0
+    while True:
+        shard = list(islice(hits, shard_size))
+        if not shard:
+            break
+        file_name = f"{name}-{len(files):05d}.ndjson.gz"
+        with gzip.open(os.path.join(directory, file_name), "wt") as shard_file:
+            for hit in shard:
+                shard_file.write(
+                    json.dumps({"_id": hit["_id"], "_source": hit["_source"]}) + "\n"
+                )
+        files.append(file_name)
+        documents += len(shard)
+    return files, documents
+
+
+def create_snapshot(es, index_name, directory=SNAPSHOT_DIRECTORY, full=False):
+    """
+    Take a snapshot of the index via scroll. An incremental snapshot contains only the documents the backend wrote (indexed_at) since the previous snapshot, so its size scales with the changes and not with the corpus. Documents stamped within the last SNAPSHOT_LAG seconds are left to the next snapshot and the documents stamped SNAPSHOT_OVERLAP seconds before the previous snapshot are repeated, so documents which reached the index late are not missed. A full snapshot is taken if there is no previous one, if full is set or after SNAPSHOT_MAX_INCREMENTS increments; the files of the older snapshots are removed afterwards.
+
+    :param es: elasticsearch client
+    :type es: Elasticsearch
+    :param index_name: name of the index
+    :type index_name: str
+    :param directory: snapshot directory
+    :type directory: str
+    :param full: take a full snapshot, defaults to False
+    :type full: bool
+    :return: manifest entry of the snapshot or None if nothing changed
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    full = (
+        full
+        or manifest is None
+        or len(manifest["snapshots"]) > SNAPSHOT_MAX_INCREMENTS
+    )
+
+    # documents stamped before until have reached the index by now and are
+    # searchable after the refresh
+    until = int((time.time() - SNAPSHOT_LAG) * 1000)
+    es.indices.refresh(index=index_name)
+    if full:
+        query = {"match_all": {}}
+    else:
+        since = manifest["snapshots"][-1]["until"]
+        changed = es.count(
+            index=index_name,
+            query={"range": {"indexed_at": {"gt": since, "lte": until}}},
+        )["count"]
+        if changed == 0:
+            print("No documents written since the last snapshot")
+            return None
+        # repeat the end of the previous snapshot for late documents
+        query = {
+            "range": {
+                "indexed_at": {
+                    "gt": since - int(SNAPSHOT_OVERLAP * 1000),
+                    "lte": until,
+                }
+            }
+        }
+
+    snapshot_type = "full" if full else "incremental"
+    name = f"{snapshot_type}-{until}"
+    hits = helpers.scan(
+        es, index=index_name, query={"query": query}, size=BULK_CHUNK_SIZE
+    )
+    files, documents = write_shards(hits, directory, name)
+
+    snapshot = {
+        "name": name,
+        "type": snapshot_type,
+        "until": until,
+        "files": files,
+        "documents": documents,
+    }
+    if full:
+        previous = manifest["snapshots"] if manifest is not None else []
+        write_manifest({"index": index_name, "snapshots": [snapshot]}, directory)
+        for old_snapshot in previous:
+            for file_name in old_snapshot["files"]:
+                path = os.path.join(directory, file_name)
+                if os.path.isfile(path):
+                    os.remove(path)
+    else:
+        manifest["snapshots"].append(snapshot)
+        write_manifest(manifest, directory)
+
+    size = sum(os.path.getsize(os.path.join(directory, file_name)) for file_name in files)
+    print(
+        f"Took {snapshot_type} snapshot {name}: {documents} documents in "
+        f"{len(files)} shards ({size} bytes) in {time.perf_counter() - start:.2f}s"
+    )
+    return snapshot
+
+
+def restore_snapshot(es, index_name, directory=SNAPSHOT_DIRECTORY):
+    """
+    Create the index and restore the full snapshot and the following incremental snapshots of the snapshot directory. The shards of every snapshot are loaded with parallel bulk requests, the snapshots one after another, so later versions of a document overwrite earlier ones.
+
+    :param es: elasticsearch client
+    :type es: Elasticsearch
+    :param index_name: name of the index
+    :type index_name: str
+    :param directory: snapshot directory
+    :type directory: str
+    :return: number of successful operations and the failed operations
+    :rtype: tuple[int, list]
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise Exception(f"No snapshot found in {directory}")
+
+    es.indices.create(index=index_name, mappings=index_mappings)
+
+    successful_operations = 0
+    errors = []
+    for snapshot in manifest["snapshots"]:
+        print(f"Restoring snapshot {snapshot['name']} ({snapshot['documents']} documents)")
+        actions = (
+            action
+            for file_name in snapshot["files"]
+            for action in dump_documents(os.path.join(directory, file_name), index_name)
+        )
+        snapshot_operations, snapshot_errors = bulk_load(es, index_name, actions)
+        successful_operations += snapshot_operations
+        errors.extend(snapshot_errors)
+    return successful_operations, errors
+
+
+def wait_for_documents(es, index_name, expected, deadline=WAIT_DEADLINE):
+    """
+    Refresh the index and poll its document count with exponential backoff until it contains the expected number of documents.
+
+    :param es: elasticsearch client
+    :type es: Elasticsearch
+    :param index_name: name of the index
+    :type index_name: str
+    :param expected: number of documents the index has to contain
+    :type expected: int
+    :param deadline: seconds to wait at most
+    :type deadline: float
+    :raises TimeoutError: documents are not searchable before the deadline
+    :return: number of documents in the index
+    :rtype: int
+    """
+    end = time.monotonic() + deadline
+    delay = 0.5
+    while True:
+        es.indices.refresh(index=index_name)
+        count = es.count(index=index_name)["count"]
+        if count >= expected:
+            return count
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Only {count} of {expected} documents saved in {index_name} after {deadline}s"
+            )
+        print(f"Waiting {min(delay, remaining):.1f}s for documents to be saved in elasticsearch ({count}/{expected})..")
+        time.sleep(min(delay, remaining))
+        delay = min(2 * delay, 10)
+
+
 def create_es_index(path_to_csv):
     """
     Create elasticsearch index for our lyrics mood classification using the saved ground truth data in '../data_exploration/data/song-data-labels-cleaned-seven-moods.csv'.
@@ -28,61 +451,26 @@ def create_es_index(path_to_csv):
     index_name = "lyrics_mood_classification"
     es.indices.create(
         index=index_name,
-        mappings={
-            "dynamic": "strict",
-            "properties": {
-                "song_name": {"type": "text"},
-                "artist_name": {"type": "text"},
-                "lyrics": {"type": "text"},
-                "mood": {"type": "text"},
-            },
-        },
+        mappings=index_mappings,
     )
 
-    # load the document with the ground truth labels
-    ground_truth_df = pd.read_csv(path_to_csv)
-    ground_truth_df = ground_truth_df[["SName", "Artist", "Lyric", "Mood"]]
-
-    # create documents from df rows
-    df_iter = ground_truth_df.iterrows()
-    new_documents = []
-    for id, document in df_iter:
-        new_documents.append(
-            {
-                "_index": index_name,
-                "_type": "_doc",
-                "_id": f"{id}",
-                "_source": {
-                    "song_name": str(document["SName"]),
-                    "artist_name": str(document["Artist"]),
-                    "lyrics": str(document["Lyric"]),
-                    "mood": str(document["Mood"]),
-                },
-            }
-        )
-    successful_operations, errors = helpers.bulk(es, new_documents)
+    # stream the documents with the ground truth labels into the index
+    successful_operations, errors = bulk_load(
+        es, index_name, csv_documents(path_to_csv, index_name)
+    )
     print(f"Successful operations: {successful_operations}")
     print(f"Errors: {errors}")
 
     # wait till documents are saved in elasticsearch
-    while True:
-        if es.count(index=index_name)["count"] < len(ground_truth_df):
-            time.sleep(1)
-            print("Waiting one second for documents to be saved in elasticsearch..")
-            break
+    wait_for_documents(es, index_name, successful_operations)
 
-    # save elasticsearch index via elasticdump
-    index_file = os.path.abspath(
-        os.path.join(path_to_csv, "..", f"{index_name}_index.json")
-    )
-    os.system(
-        f"elasticdump --input={es_host}/{index_name} --output={index_file} --type=data"
-    )
+    # save a full snapshot of the elasticsearch index
+    create_snapshot(es, index_name, full=True)
 
 
 def load_es_index(path):
     """
-    Load the most current elasticsearch index from the '../data_exploration/data/lyrics_mood_classification.json' file. Similar to the create_es_index function but with better performance (will be used after dump.json is once created in initial startup).
+    Load the elasticsearch index from a dump.json file written by elasticdump. Only used to migrate a dump of an older setup, which is then replaced by a full snapshot.
     
     :param path: path to dump file containing the data that will be loaded into the es index.
     :type path: str
@@ -102,34 +490,47 @@ def load_es_index(path):
     # create empty index
     es.indices.create(
         index=index_name,
-        mappings={
-            "dynamic": "strict",
-            "properties": {
-                "song_name": {"type": "text"},
-                "artist_name": {"type": "text"},
-                "lyrics": {"type": "text"},
-                "mood": {"type": "text"},
-            },
-        },
+        mappings=index_mappings,
     )
 
-    # load last state from index via the json dump file
-    new_documents = []
-    with open(INDEX_FILE_PATH, "r") as json_file:
-        # load the documents from the json file
-        for line in json_file:
-            document = json.loads(line)
-            new_documents.append(document)
-    successful_operations, errors = helpers.bulk(es, new_documents)
+    # stream the last state of the index from the json dump file
+    successful_operations, errors = bulk_load(
+        es, index_name, dump_documents(INDEX_FILE_PATH, index_name)
+    )
     print(f"Successful operations: {successful_operations}")
     print(f"Errors: {errors}")
 
+    # replace the dump by a full snapshot once all documents are saved
+    wait_for_documents(es, index_name, successful_operations)
+    create_snapshot(es, index_name, full=True)
+
 
 if __name__ == "__main__":
     from os.path import exists
 
-    # check if dump exists
-    if exists("/opt/elasticsearch/dump.json"):
+    parser = argparse.ArgumentParser(
+        description="Create or restore the lyrics_mood_classification index."
+    )
+    parser.add_argument(
+        "--snapshot", action="store_true",
+        help="take a snapshot of the running index instead of loading it"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="take a full snapshot"
+    )
+    args = parser.parse_args()
+
+    index_name = "lyrics_mood_classification"
+    es = Elasticsearch(hosts="http://localhost:9200")
+
+    if args.snapshot:
+        create_snapshot(es, index_name, full=args.full)
+    elif read_manifest() is not None:
+        # restore the last snapshot
+        successful_operations, errors = restore_snapshot(es, index_name)
+        print(f"Successful operations: {successful_operations}")
+        print(f"Errors: {errors}")
+    elif exists("/opt/elasticsearch/dump.json"):
         load_es_index("/opt/elasticsearch/dump.json")
     else:
         # if not, use the csv file containing the initial preprocessed kaggle data when creating elasticsearch index
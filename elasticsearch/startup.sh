@@ -4,4 +4,8 @@ chmod -R 777 /opt/
 chown -R elasticsearch:elasticsearch /opt/
 /bin/tini /usr/local/bin/docker-entrypoint.sh -- &
 /opt/elasticsearch/wait-for-it.sh -t 60 localhost:9200 -- python3 /opt/elasticsearch/create_load_save_es_index.py
-while true; do sleep 100; done
+# take an incremental snapshot of the songs added since the last one
+while true; do
+    sleep "${SNAPSHOT_INTERVAL:-300}"
+    python3 /opt/elasticsearch/create_load_save_es_index.py --snapshot
+done